@@ -0,0 +1,102 @@
+import os
+import threading
+from contextlib import contextmanager
+
+LOW = 'low'
+NORMAL = 'normal'
+HIGH = 'high'
+PRIORITIES = (LOW, NORMAL, HIGH)
+
+
+class AdmissionController:
+    """Decides whether a webhook is handled now or deferred to a provider retry.
+
+    The process counts as overloaded when any pressure signal is over its
+    threshold: in-flight requests, queued inbound work, recent MySQL pool
+    wait or outbound queue depth. While overloaded, low-priority work
+    (rewards summaries, delivery receipts) is shed. Normal work is shed once
+    ``max_in_flight`` requests are running, which keeps ``high_reserve``
+    slots free for checkout and payment confirmation; high-priority work is
+    only shed beyond that reserve. A threshold of 0 disables that signal.
+    """
+
+    def __init__(self, signals, max_in_flight=32, high_reserve=8, max_pool_wait_ms=250.0,
+                 max_outbound_depth=500, max_inbound_depth=200):
+        self.signals = signals
+        self.max_in_flight = max_in_flight
+        self.high_reserve = high_reserve
+        self.max_pool_wait_ms = max_pool_wait_ms
+        self.max_outbound_depth = max_outbound_depth
+        self.max_inbound_depth = max_inbound_depth
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._admitted = dict.fromkeys(PRIORITIES, 0)
+        self._shed = dict.fromkeys(PRIORITIES, 0)
+        self._reasons = {}
+
+    @classmethod
+    def from_env(cls, signals):
+        return cls(
+            signals,
+            max_in_flight=int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "32")),
+            high_reserve=int(os.getenv("ADMISSION_HIGH_RESERVE", "8")),
+            max_pool_wait_ms=float(os.getenv("ADMISSION_MAX_POOL_WAIT_MS", "250")),
+            max_outbound_depth=int(os.getenv("ADMISSION_MAX_OUTBOUND_DEPTH", "500")),
+            max_inbound_depth=int(os.getenv("ADMISSION_MAX_INBOUND_DEPTH", "200")),
+        )
+
+    def _pressure(self, in_flight):
+        """Name of the first signal over its threshold, or None."""
+        if self.max_in_flight and in_flight >= self.max_in_flight:
+            return 'in_flight'
+        checks = (
+            ('pool_wait', self.max_pool_wait_ms, self.signals.get('pool_wait_ms')),
+            ('outbound_depth', self.max_outbound_depth, self.signals.get('outbound_depth')),
+            ('inbound_depth', self.max_inbound_depth, self.signals.get('inbound_depth')),
+        )
+        for name, limit, read in checks:
+            if limit and read is not None and read() >= limit:
+                return name
+        return None
+
+    def _decide(self, priority, in_flight):
+        if priority == HIGH:
+            if self.max_in_flight and in_flight >= self.max_in_flight + self.high_reserve:
+                return 'in_flight'
+            return None
+        if priority == NORMAL:
+            if self.max_in_flight and in_flight >= self.max_in_flight:
+                return 'in_flight'
+            return None
+        return self._pressure(in_flight)
+
+    @contextmanager
+    def admit(self, priority=NORMAL):
+        """Yield True and count the block as in flight, or yield False if it should be shed."""
+        with self._lock:
+            reason = self._decide(priority, self._in_flight)
+            if reason is None:
+                self._in_flight += 1
+                self._admitted[priority] += 1
+            else:
+                self._shed[priority] += 1
+                key = f"{priority}:{reason}"
+                self._reasons[key] = self._reasons.get(key, 0) + 1
+        if reason is not None:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": self._in_flight,
+                "overloaded": self._pressure(self._in_flight),
+                "admitted": dict(self._admitted),
+                "shed": dict(self._shed),
+                "shed_reasons": dict(self._reasons),
+            }
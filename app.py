@@ -1,8 +1,7 @@
-from flask import Flask, jsonify, request, render_template, session, redirect, url_for
+from flask import Flask, g, jsonify, request, render_template, session, redirect, url_for
 import requests
 import json
 from datetime import datetime, timedelta
-import pymysql
 import urllib3
 import re
 import os
@@ -12,6 +11,26 @@ import logging
 from dotenv import load_dotenv
 import random
 import string
+import atexit
+import threading
+import time
+from pymysql.constants.ER import DUP_ENTRY as ER_DUP_ENTRY
+from pymysql.err import IntegrityError
+from database import ConnectionPool, current_session, add_statement_observer, add_connection_observer, is_transient
+from dedupe import MessageDeduplicator
+from inbound import ShardedExecutor
+from inbox import Inbox
+from admission import AdmissionController, LOW, NORMAL, HIGH
+from dispatch import OutboundQueue, RetryableSendError
+from cache import TTLCache
+from catalog import CatalogCache
+from conversation import ConversationStore, ConvState, StaleConversation
+from logwriter import LogWriter, StatusWriter
+from metrics import Registry, statement_family
+from pincodes import PincodeIndex
+from tracing import Tracer
+from querybudget import QueryBudget
+from rmlconnect import RMLClient, MESSAGES_URL, CATALOG_URL, normalize_phone
 
 # Configure logging
 logging.basicConfig(
@@ -26,22 +45,80 @@ app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", os.urandom(24))
 load_dotenv()
 
-# Validate environment variables
+# Validated by create_app(); nothing below connects or starts threads at import time.
 required_env = ["MYSQL_HOST", "MYSQL_USER", "MYSQL_PASSWORD", "MYSQL_DB", "AUTH_KEY", "RAZORPAY_KEY_ID", "RAZORPAY_KEY_SECRET"]
-for var in required_env:
-    if not os.getenv(var):
-        logging.error(f"Missing environment variable: {var}")
-        exit(1)
 
 aws_host = os.getenv("MYSQL_HOST")
 usr = os.getenv("MYSQL_USER")
 pas = os.getenv("MYSQL_PASSWORD")
 db = os.getenv("MYSQL_DB")
 authkey = os.getenv("AUTH_KEY")
-razorpay_client = razorpay.Client(auth=(
-    os.getenv("RAZORPAY_KEY_ID"),
-    os.getenv("RAZORPAY_KEY_SECRET")
-))
+db_pool = ConnectionPool.from_env(user=usr, password=pas, host=aws_host, database=db)
+
+registry = Registry("balutedaar")
+message_seconds = registry.histogram(
+    "message_seconds", "Time to handle one inbound message, by conversation branch.", ("branch", "outcome"))
+outbound_seconds = registry.histogram(
+    "outbound_seconds", "rmlconnect send latency, by message type.", ("extra", "outcome"))
+razorpay_seconds = registry.histogram(
+    "razorpay_seconds", "Razorpay API latency.", ("call", "outcome"))
+sql_seconds = registry.histogram(
+    "sql_seconds", "MySQL statement latency, by statement family.", ("family",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+request_seconds = registry.histogram(
+    "request_seconds", "HTTP request latency, by endpoint and status.", ("endpoint", "status"))
+scope_queries = registry.histogram(
+    "scope_queries", "MySQL round trips per webhook and funnel step.", ("scope",),
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89))
+scope_connections = registry.histogram(
+    "scope_connections", "Pool checkouts per webhook and funnel step.", ("scope",), buckets=(0, 1, 2, 3, 5, 8))
+tracer = Tracer.from_env()
+
+def report_scope(scope):
+    scope_queries.observe(scope.queries, scope.name)
+    scope_connections.observe(scope.connections, scope.name)
+
+query_budget = QueryBudget.from_env(report=report_scope)
+
+def observe_statement(sql, seconds, rows):
+    family = statement_family(sql)
+    sql_seconds.observe(seconds, family)
+    tracer.record(family, seconds, rows=rows)
+    query_budget.on_statement(sql, seconds, rows)
+
+add_statement_observer(observe_statement)
+add_connection_observer(query_budget.on_connection)
+
+rml_client = RMLClient.from_env(authkey)
+log_writer = LogWriter.from_env(db_pool)
+status_writer = StatusWriter.from_env(db_pool)
+RAZORPAY_TIMEOUT = float(os.getenv("RAZORPAY_TIMEOUT", "10"))
+_razorpay_client = None
+_razorpay_lock = threading.Lock()
+
+class TimeoutSession(requests.Session):
+    """requests session with a default timeout; the razorpay client never sets one."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(*args, **kwargs)
+
+def get_razorpay_client():
+    global _razorpay_client
+    if _razorpay_client is None:
+        with _razorpay_lock:
+            if _razorpay_client is None:
+                # RAZORPAY_BASE_URL points payment links at a local stub (bench/loadgen.py).
+                options = {"base_url": os.getenv("RAZORPAY_BASE_URL")} if os.getenv("RAZORPAY_BASE_URL") else {}
+                _razorpay_client = razorpay.Client(session=TimeoutSession(RAZORPAY_TIMEOUT), auth=(
+                    os.getenv("RAZORPAY_KEY_ID"),
+                    os.getenv("RAZORPAY_KEY_SECRET")
+                ), **options)
+    return _razorpay_client
 
 # Admin credentials
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "admin")
@@ -101,10 +178,7 @@ r2 = '''*Hi {name}!* 👋
 Please enter your *6-digit pincode* to continue. 📍'''
 r3 = '''*Sorry, this pincode is not served yet!* 😔  
 We currently deliver to these areas:  
-• *411038*  
-• *411052*  
-• *411058*    
-• *411041*  
+{areas}
 Please enter a valid pincode from the list above. 📍'''
 r4 = '''*Invalid pincode!* ⚠️  
 Please enter only a *6-digit pincode* (e.g., 411038). 📍'''
@@ -123,6 +197,22 @@ FALLBACK_COMBOS = {
     "dm4ngkc9xr": {"name": "Amaranth - लाल माठ", "price": 380.00}
 }
 
+catalog = CatalogCache.from_env(db_pool, FALLBACK_COMBOS)
+pincode_index = PincodeIndex.from_env(db_pool, SUPPORTED_PINCODES)
+
+rewards_cache = TTLCache(maxsize=int(os.getenv("REWARDS_CACHE_SIZE", "10000")),
+                         ttl=float(os.getenv("REWARDS_CACHE_TTL", "30")))
+conversations = ConversationStore.from_env(db_pool)
+dedupe = MessageDeduplicator.from_env(db_pool)
+# Per-phone serialisation: one worker thread per shard in this process, and a
+# MySQL named lock per phone across processes.
+inbound = ShardedExecutor.from_env()
+INBOUND_TIMEOUT = float(os.getenv("INBOUND_TIMEOUT", "30"))
+# Fast-ack mode: persist the webhook to the local inbox, answer 200 at once
+# and run the conversation in the background.
+INBOUND_FAST_ACK = os.getenv("INBOUND_FAST_ACK", "0") == "1"
+CONVERSATION_LOCK_TIMEOUT = int(os.getenv("CONVERSATION_LOCK_TIMEOUT", "10"))
+
 TIERED_DISCOUNTS = {
     1: 0.10,  # 10% off for 1 successful referral
     2: 0.20,  # 20% off for 2 successful referrals
@@ -132,396 +222,315 @@ TIERED_DISCOUNTS = {
 }
 
 def get_combo_availability():
-    try:
-        cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        cursor.execute("SELECT combo_id, combo_name, total_boxes FROM combo_inventory")
-        inventory = cursor.fetchall()
-        cnx.close()
-        message = "🌱 *Fresh Greens Await!* 🌱\nDive into our vibrant combos:\n\n"
-        for combo_id, combo_name, total_boxes in inventory:
-            message += f"🥗 *{combo_name}* - {total_boxes} boxes ready!\n"
-        message += "\n🌟 Pick your favorite and order now! 🌟"
-        return message if inventory else "No combos available."
-    except Exception as e:
-        logging.error(f"Failed to fetch combo availability: {e}")
-        message = "🌱 *Fresh Greens Await!* 🌱\nDive into our vibrant combos:\n\n"
+    inventory = catalog.availability()
+    message = "🌱 *Fresh Greens Await!* 🌱\nDive into our vibrant combos:\n\n"
+    if inventory is None:
         for combo_id, combo_data in FALLBACK_COMBOS.items():
             message += f"🥗 *{combo_data['name']}* - 0 boxes ready!\n"
         message += "\n🌟 Pick your favorite and order now! 🌟"
         return message
+    for combo_id, combo_name, total_boxes in inventory:
+        message += f"🥗 *{combo_name}* - {total_boxes} boxes ready!\n"
+    message += "\n🌟 Pick your favorite and order now! 🌟"
+    return message if inventory else "No combos available."
 
-def check_inventory(combo_id, quantity):
+def check_inventory(lines):
+    """Return the names of the (combo_id, quantity) lines that current stock cannot cover."""
+    requested = {}
+    for combo_id, quantity in lines:
+        requested[combo_id] = requested.get(combo_id, 0) + quantity
     try:
-        cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        cursor.execute("SELECT total_boxes, combo_name FROM combo_inventory WHERE combo_id = %s", (combo_id,))
-        result = cursor.fetchone()
-        cnx.close()
-        if result and result[0] >= quantity:
-            return True, result[1]
-        return False, result[1] if result else get_combo_name(combo_id)
+        with db_pool.session() as dbs:
+            cursor = dbs.cursor()
+            placeholders = ", ".join(["%s"] * len(requested))
+            cursor.execute(
+                f"SELECT combo_id, combo_name, total_boxes FROM combo_inventory WHERE combo_id IN ({placeholders})",
+                tuple(requested)
+            )
+            stock = {combo_id: (combo_name, total_boxes) for combo_id, combo_name, total_boxes in cursor.fetchall()}
     except Exception as e:
-        logging.error(f"Failed to check inventory for combo_id {combo_id}: {e}")
-        return False, get_combo_name(combo_id)
+        logging.error(f"Failed to check inventory for {list(requested)}: {e}")
+        stock = {}
+    unavailable = []
+    for combo_id, quantity in requested.items():
+        combo_name, total_boxes = stock.get(combo_id, (None, 0))
+        if total_boxes < quantity:
+            unavailable.append(combo_name or get_combo_name(combo_id))
+    return unavailable
+
+@tracer.traced
+def build_cart(phone, lines):
+    """Replace the user's cart with the (combo_id, quantity) lines of a catalog order.
+
+    Stock for every line is checked with one query. If anything is short,
+    the cart is left empty and the names of all short combos are returned;
+    otherwise the priced lines are written with a single executemany.
+    Returns (unavailable_names, cart_rows).
+    """
+    with db_pool.session() as dbs:
+        cursor = dbs.cursor()
+        cursor.execute("DELETE FROM user_cart WHERE phone_number = %s", (phone,))
+        if not lines:
+            return [], []
+        unavailable = check_inventory(lines)
+        if unavailable:
+            return unavailable, []
+        cart_rows = []
+        for combo_id, quantity in lines:
+            item_price = get_combo_price(combo_id)
+            selected_combo = get_combo_name(combo_id)
+            if selected_combo != "Unknown Combo" and item_price > 0:
+                cart_rows.append((phone, combo_id, selected_combo, quantity, item_price))
+        if cart_rows:
+            cursor.executemany(
+                "INSERT INTO user_cart (phone_number, combo_id, combo_name, quantity, price) VALUES (%s, %s, %s, %s, %s)",
+                cart_rows
+            )
+        return [], cart_rows
+
+class InventoryError(Exception):
+    def __init__(self, failed):
+        super().__init__(f"Insufficient stock for {', '.join(name for _, name, _ in failed)}")
+        self.failed = failed
 
-def update_inventory(combo_id, quantity):
+@tracer.traced
+def reserve_inventory(lines):
+    """Reserve stock for every (combo_id, combo_name, quantity) line, or for none of them.
+
+    Each line is a conditional decrement, so concurrent buyers can never push
+    total_boxes below zero. Rows are locked in combo_id order so two
+    multi-item checkouts cannot deadlock on each other. Lines with nothing
+    to reserve are skipped: their UPDATE would change no row and read as
+    out of stock. Returns the lines that could not be reserved; if any
+    failed, the whole reservation is rolled back.
+    """
+    failed = []
     try:
-        cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        cursor.execute(
-            "UPDATE combo_inventory SET booked = booked + %s, total_boxes = total_boxes - %s WHERE combo_id = %s",
-            (quantity, quantity, combo_id)
-        )
-        cnx.commit()
-        cnx.close()
-    except Exception as e:
-        logging.error(f"Failed to update inventory for combo_id {combo_id}: {e}")
-        cnx.rollback()
-        cnx.close()
+        with db_pool.session() as dbs, dbs.savepoint():
+            cursor = dbs.cursor()
+            for combo_id, combo_name, quantity in sorted(line for line in lines if line[2] > 0):
+                reserved = cursor.execute(
+                    "UPDATE combo_inventory SET booked = booked + %s, total_boxes = total_boxes - %s "
+                    "WHERE combo_id = %s AND total_boxes >= %s",
+                    (quantity, quantity, combo_id, quantity)
+                )
+                if not reserved:
+                    failed.append((combo_id, combo_name, quantity))
+            if failed:
+                raise InventoryError(failed)
+    except InventoryError:
+        pass
+    return failed
+
+REFERRAL_CODE_ATTEMPTS = 10
 
+@tracer.traced
 def generate_referral_code(user_phone):
+    """Allocate a fresh 5-character code for ``user_phone``.
+
+    Candidates are inserted directly and the unique key on
+    referral_codes.referral_code rejects collisions, so there is no
+    check-then-insert race and no lookup per candidate.
+    """
     try:
-        cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        month_year = datetime.now().strftime('%Y-%m')
-        while True:
-            code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
-            cursor.execute("SELECT COUNT(*) FROM referral_codes WHERE referral_code = %s", (code,))
-            if cursor.fetchone()[0] == 0:
-                break
-        cursor.execute(
-            "INSERT INTO referral_codes (user_phone, referral_code, month_year, usage_count, is_active, created_at) "
-            "VALUES (%s, %s, %s, %s, %s, %s)",
-            (user_phone, code, month_year, 0, True, datetime.now())
-        )
-        cnx.commit()
-        cnx.close()
-        return code
+        with db_pool.session() as dbs:
+            cursor = dbs.cursor()
+            month_year = datetime.now().strftime('%Y-%m')
+            for _ in range(REFERRAL_CODE_ATTEMPTS):
+                code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
+                try:
+                    cursor.execute(
+                        "INSERT INTO referral_codes (user_phone, referral_code, month_year, usage_count, is_active, created_at) "
+                        "VALUES (%s, %s, %s, %s, %s, %s)",
+                        (user_phone, code, month_year, 0, True, datetime.now())
+                    )
+                    cursor.execute(
+                        "INSERT INTO rewards_summary (user_phone, month_year, current_code, usage_count, points_month) "
+                        "VALUES (%s, %s, %s, 0, 0) ON DUPLICATE KEY UPDATE current_code = VALUES(current_code), usage_count = 0",
+                        (user_phone, month_year, code)
+                    )
+                    dbs.after_commit(lambda: rewards_cache.pop((user_phone, month_year)))
+                    return code
+                except IntegrityError as e:
+                    if e.args[0] != ER_DUP_ENTRY:
+                        raise
+            raise RuntimeError(f"no free referral code after {REFERRAL_CODE_ATTEMPTS} attempts")
     except Exception as e:
+        if is_transient(e):
+            raise
         logging.error(f"Failed to generate referral code for {user_phone}: {e}")
-        cnx.close()
         return None
 
+@tracer.traced
 def validate_referral_code(referral_code, friend_phone):
     try:
-        cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        month_year = datetime.now().strftime('%Y-%m')
-        expiry_date = datetime.now() - timedelta(days=30)
-        cursor.execute(
-            "SELECT user_phone, usage_count, created_at FROM referral_codes WHERE referral_code = %s AND month_year = %s AND is_active = %s",
-            (referral_code, month_year, True)
-        )
-        result = cursor.fetchone()
-        if not result:
-            cnx.close()
-            return False, "Code invalid or expired"
-        user_phone, usage_count, created_at = result
-        if user_phone == friend_phone:
-            cnx.close()
-            return False, "You cannot use your own referral code"
-        if created_at < expiry_date:
-            cursor.execute("UPDATE referral_codes SET is_active = %s WHERE referral_code = %s", (False, referral_code))
-            cnx.commit()
-            cnx.close()
-            return False, "Code has expired"
-        if usage_count >= 5:
-            cnx.close()
-            return False, "Code has reached its usage limit"
-        cursor.execute(
-            "SELECT COUNT(*) FROM referral_rewards WHERE referral_code = %s AND friend_phone = %s",
-            (referral_code, friend_phone)
-        )
-        if cursor.fetchone()[0] > 0:
-            cnx.close()
-            return False, "You have already used this code"
-        cnx.close()
-        return True, user_phone
+        with db_pool.session() as dbs:
+            cursor = dbs.cursor()
+            month_year = datetime.now().strftime('%Y-%m')
+            expiry_date = datetime.now() - timedelta(days=30)
+            cursor.execute(
+                "SELECT user_phone, usage_count, created_at FROM referral_codes WHERE referral_code = %s AND month_year = %s AND is_active = %s",
+                (referral_code, month_year, True)
+            )
+            result = cursor.fetchone()
+            if not result:
+                return False, "Code invalid or expired"
+            user_phone, usage_count, created_at = result
+            if user_phone == friend_phone:
+                return False, "You cannot use your own referral code"
+            if created_at < expiry_date:
+                cursor.execute("UPDATE referral_codes SET is_active = %s WHERE referral_code = %s", (False, referral_code))
+                return False, "Code has expired"
+            if usage_count >= 5:
+                return False, "Code has reached its usage limit"
+            cursor.execute(
+                "SELECT COUNT(*) FROM referral_rewards WHERE referral_code = %s AND friend_phone = %s",
+                (referral_code, friend_phone)
+            )
+            if cursor.fetchone()[0] > 0:
+                return False, "You have already used this code"
+            return True, user_phone
     except Exception as e:
+        if is_transient(e):
+            raise
         logging.error(f"Failed to validate referral code {referral_code}: {e}")
         return False, "Error validating code"
 
+@tracer.traced
 def assign_referral_rewards(user_phone, referral_code, friend_phone, order_id):
+    """Credit the referrer once for a friend's order, in the caller's transaction.
+
+    The referrer's notifications are queued through send_message, so they
+    go out only after the order commits.
+    """
     try:
-        cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        cursor.execute(
-            "UPDATE referral_codes SET usage_count = usage_count + 1 WHERE referral_code = %s",
-            (referral_code,)
-        )
-        cursor.execute("SELECT usage_count FROM referral_codes WHERE referral_code = %s", (referral_code,))
-        usage_count = cursor.fetchone()[0]
-        if usage_count >= 5:
-            cursor.execute("UPDATE referral_codes SET is_active = %s WHERE referral_code = %s", (False, referral_code))
-        cursor.execute(
-            "INSERT INTO referral_rewards (user_phone, referral_code, friend_phone, points_earned, order_id, created_at) "
-            "VALUES (%s, %s, %s, %s, %s, %s)",
-            (user_phone, referral_code, friend_phone, 50, order_id, datetime.now())
-        )
-        cursor.execute(
-            "UPDATE users SET balutedaar_points = balutedaar_points + %s WHERE phone_number = %s",
-            (50, user_phone)
-        )
-        cursor.execute(
-            "SELECT COUNT(*) FROM referral_rewards WHERE referral_code = %s",
-            (referral_code,)
-        )
-        referral_count = cursor.fetchone()[0]
-        if referral_count == 5:
+        with db_pool.session() as dbs, dbs.savepoint():
+            cursor = dbs.cursor()
+            cursor.execute(
+                "UPDATE referral_codes SET usage_count = usage_count + 1, is_active = (usage_count < 5) WHERE referral_code = %s",
+                (referral_code,)
+            )
+            cursor.execute("SELECT usage_count, month_year FROM referral_codes WHERE referral_code = %s", (referral_code,))
+            usage_count, code_month = cursor.fetchone()
+            cursor.execute(
+                "INSERT INTO referral_stats (user_phone, month_year, referral_count) VALUES (%s, %s, 1) "
+                "ON DUPLICATE KEY UPDATE referral_count = referral_count + 1",
+                (user_phone, code_month)
+            )
+            dbs.cache.pop(('referral_count', user_phone, code_month), None)
             cursor.execute(
-                "INSERT INTO rewards (user_phone, reward_type, status, created_at) "
-                "VALUES (%s, %s, %s, %s)",
-                (user_phone, 'Free Veggie Box', 'Pending', datetime.now())
+                "INSERT INTO referral_rewards (user_phone, referral_code, friend_phone, points_earned, order_id, created_at) "
+                "VALUES (%s, %s, %s, %s, %s, %s)",
+                (user_phone, referral_code, friend_phone, 50, order_id, datetime.now())
             )
+            cursor.execute(
+                "INSERT INTO rewards_summary (user_phone, month_year, current_code, usage_count, points_month) "
+                "VALUES (%s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE points_month = points_month + VALUES(points_month), "
+                "usage_count = IF(current_code = VALUES(current_code), VALUES(usage_count), usage_count)",
+                (user_phone, code_month, referral_code, usage_count, 50)
+            )
+            cursor.execute(
+                "UPDATE users SET balutedaar_points = balutedaar_points + %s, pending_free_boxes = pending_free_boxes + %s "
+                "WHERE phone_number = %s",
+                (50, 1 if usage_count == 5 else 0, user_phone)
+            )
+            dbs.after_commit(lambda: rewards_cache.pop((user_phone, code_month)))
+            if usage_count == 5:
+                cursor.execute(
+                    "INSERT INTO rewards (user_phone, reward_type, status, created_at) "
+                    "VALUES (%s, %s, %s, %s)",
+                    (user_phone, 'Free Veggie Box', 'Pending', datetime.now())
+                )
+                send_message(user_phone, 
+                    f"🎉 Amazing job! Your code {referral_code} has been used by 5 friends, unlocking a FREE ₹200 Veggie Box! We'll notify you when it's ready to redeem.",
+                    "free_box_unlocked"
+                )
             send_message(user_phone, 
-                f"🎉 Amazing job! Your code {referral_code} has been used by 5 friends, unlocking a FREE ₹200 Veggie Box! We'll notify you when it's ready to redeem.",
-                "free_box_unlocked"
+                f"🎉 Great news! Your friend used your code {referral_code} and you’ve earned ₹50 Balutedaar Points! {max(5 - usage_count, 0)} more referrals to unlock a FREE ₹200 Veggie Box!",
+                "referral_reward"
             )
-        cnx.commit()
-        send_message(user_phone, 
-            f"🎉 Great news! Your friend used your code {referral_code} and you’ve earned ₹50 Balutedaar Points! {5 - usage_count} more referrals to unlock a FREE ₹200 Veggie Box!",
-            "referral_reward"
-        )
-        cnx.close()
     except Exception as e:
+        if is_transient(e):
+            raise
         logging.error(f"Failed to assign referral rewards for {user_phone}: {e}")
-        cnx.rollback()
-        cnx.close()
 
-def send_message(rcvr, body, message):
-    url = "https://apis.rmlconnect.net/wba/v1/messages?source=UI"
-    if not rcvr.startswith('+'):
-        rcvr = f"+91{rcvr.strip()[-10:]}"
-    payload = json.dumps({
-        "phone": rcvr,
-        "text": body,
-        "enable_acculync": True,
-        "extra": message
-    })
-    headers = {
-        'Content-Type': "application/json",
-        'Authorization': authkey,
-        'referer': 'https://myaccount.rmlconnect.net/'
-    }
-    try:
-        response = requests.post(url, data=payload.encode('utf-8'), headers=headers, verify=False)
+def queue_outbound(payload, message, url=MESSAGES_URL):
+    rcvr = payload["phone"]
+    job = {"phone": rcvr, "url": url, "payload": payload, "extra": message, "trace": tracer.context()}
+    dbs = current_session()
+    if dbs is not None:
+        # Hold the message until the conversation state it announces is committed.
+        dbs.after_commit(lambda: outbound.enqueue(rcvr, job))
+    else:
+        outbound.enqueue(rcvr, job)
+
+def deliver_outbound(job):
+    # Sends run after the webhook has answered, so each one is its own trace linked to the webhook's.
+    with tracer.span("outbound.send", context=job.get("trace"), extra=job["extra"]) as span:
+        started = time.perf_counter()
+        try:
+            response = rml_client.post(job["payload"], url=job.get("url", MESSAGES_URL))
+        except (requests.Timeout, requests.ConnectionError) as e:
+            outbound_seconds.observe(time.perf_counter() - started, job["extra"], type(e).__name__)
+            raise RetryableSendError(str(e))
+        outbound_seconds.observe(time.perf_counter() - started, job["extra"], str(response.status_code))
+        if span is not None:
+            span.attrs["status"] = response.status_code
+        if response.status_code >= 500 or response.status_code == 429:
+            raise RetryableSendError(f"HTTP {response.status_code} from rmlconnect")
         response.raise_for_status()
-        savesentlog(rcvr, response.text, response.status_code, message)
-        return response.text
-    except requests.RequestException as e:
-        logging.error(f"Failed to send message: {e}")
-        return None
+        savesentlog(job["phone"], response.text, response.status_code, job["extra"])
+
+outbound = OutboundQueue.from_env(deliver_outbound)
+
+def send_message(rcvr, body, message):
+    queue_outbound(RMLClient.text_message(rcvr, body, message), message)
 
 def send_referral_prompt_with_button(rcvr, body, message):
-    url = "https://apis.rmlconnect.net/wba/v1/messages?source=UI"
-    if not rcvr.startswith('+'):
-        rcvr = f"+91{rcvr.strip()[-10:]}"
-    payload = json.dumps({
-        "phone": rcvr,
-        "enable_acculync": False,
-        "extra": message,
-        "media": {
-            "type": "interactive_list",
-            "body": body,
-            "button_text": "Choose an Option",
-            "button": [
-                {
-                    "section_title": "Referral Options",
-                    "row": [
-                        {
-                            "id": "skip_button",
-                            "title": "Skip",
-                            "description": "Skip referral and browse combos"
-                        }
-                    ]
-                }
-            ]
-        }
-    })
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': authkey,
-        'referer': 'https://myaccount.rmlconnect.net/'
-    }
-    try:
-        logging.debug(f"Sending referral prompt to {rcvr} with payload: {payload}")
-        response = requests.post(url, data=payload.encode('utf-8'), headers=headers, verify=False)
-        response.raise_for_status()
-        logging.debug(f"Referral prompt sent successfully to {rcvr}, response: {response.text}")
-        savesentlog(rcvr, response.text, response.status_code, message)
-        return response.text
-    except requests.RequestException as e:
-        logging.error(f"Failed to send referral prompt to {rcvr}: {e}")
-        return None
+    payload = RMLClient.interactive_list(rcvr, body, "Choose an Option", [
+        ("Referral Options", [("skip_button", "Skip", "Skip referral and browse combos")])
+    ], message)
+    logging.debug(f"Queueing referral prompt to {payload['phone']} with payload: {payload}")
+    queue_outbound(payload, message)
 
 def savesentlog(frm, response, statuscode, Body):
     try:
         response_data = json.loads(response) if response else {}
-        message_id = response_data.get("messages", [{}])[0].get("id", "unknown")
+        message_id = response_data.get("messages", [{}])[0].get("id") or None
         now = str(datetime.now())
-        add_data = "INSERT INTO tbl_logs(sender_id, timestamp1, message_id, status, messagebody) VALUES (%s, %s, %s, %s, %s)"
-        val = (str(frm), str(now), message_id, str(statuscode), Body)
-        cnx = pymysql.connect(user=usr, max_allowed_packet=1073741824, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        cursor.execute(add_data, val)
-        cnx.commit()
-        cnx.close()
+        log_writer.add((str(frm), str(now), message_id, str(statuscode), Body))
     except Exception as e:
         logging.error(f"Failed to save log: {e}")
 
 def interactive_template_with_2button(rcvr, body, message):
-    url = "https://apis.rmlconnect.net/wba/v1/messages?source=UI"
-    if not rcvr.startswith('+'):
-        rcvr = f"+91{rcvr.strip()[-10:]}"
-    payload = json.dumps({
-        "phone": rcvr,
-        "enable_acculync": False,
-        "extra": message,
-        "media": {
-            "type": "interactive_list",
-            "body": body,
-            "button_text": "Choose an Option",
-            "button": [
-                {
-                    "section_title": "Order Actions",
-                    "row": [
-                        {
-                            "id": "1",
-                            "title": "Confirm",
-                            "description": "Confirm your order"
-                        }
-                    ]
-                },
-                {
-                    "section_title": "Menu Options",
-                    "row": [
-                        {
-                            "id": "2",
-                            "title": "Main Menu",
-                            "description": "Return to main menu"
-                        }
-                    ]
-                }
-            ]
-        }
-    })
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': authkey,
-        'referer': 'https://myaccount.rmlconnect.net/'
-    }
-    try:
-        response = requests.post(url, data=payload.encode('utf-8'), headers=headers, verify=False)
-        response.raise_for_status()
-        savesentlog(rcvr, response.text, response.status_code, "order_summary")
-        return response.text
-    except requests.RequestException as e:
-        logging.error(f"Interactive 2-button failed: {e}")
-        return None
+    payload = RMLClient.interactive_list(rcvr, body, "Choose an Option", [
+        ("Order Actions", [("1", "Confirm", "Confirm your order")]),
+        ("Menu Options", [("2", "Main Menu", "Return to main menu")])
+    ], message)
+    queue_outbound(payload, "order_summary")
 
 def interactive_template_with_3button(frm, body, message):
     if not authkey:
         logging.error(f"Skipping interactive_template_with_3button to {frm}: No authkey provided")
         return None
-    url = "https://apis.rmlconnect.net/wba/v1/messages?source=UI"
-    if not frm.startswith('+'):
-        frm = f"+91{frm.strip()[-10:]}"
     if message == "payment":
-        payload = json.dumps({
-            "phone": frm,
-            "enable_acculync": False,
-            "extra": message,
-            "media": {
-                "type": "interactive_list",
-                "body": body,
-                "button_text": "Choose Payment",
-                "button": [
-                    {
-                        "section_title": "Cash on Delivery",
-                        "row": [
-                            {
-                                "id": "3",
-                                "title": "COD",
-                                "description": "Pay cash on delivery"
-                            }
-                        ]
-                    },
-                    {
-                        "section_title": "Online Payment",
-                        "row": [
-                            {
-                                "id": "5",
-                                "title": "Pay Now",
-                                "description": "Pay via UPI or Card"
-                            }
-                        ]
-                    }
-                ]
-            }
-        })
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': authkey,
-        'referer': 'myaccount.rmlconnect.net'
-    }
-    try:
-        response = requests.post(url, headers=headers, data=payload.encode('utf-8'), verify=False, timeout=10)
-        response.raise_for_status()
-        savesentlog(frm, response.text, response.status_code, message)
-        return response.text
-    except requests.RequestException as e:
-        logging.error(f"Interactive 3-button failed: {e}")
-        return None
+        payload = RMLClient.interactive_list(frm, body, "Choose Payment", [
+            ("Cash on Delivery", [("3", "COD", "Pay cash on delivery")]),
+            ("Online Payment", [("5", "Pay Now", "Pay via UPI or Card")])
+        ], message)
+        queue_outbound(payload, message)
 
 def send_multi_product_message(rcvr, catalog_id, message):
-    url = "https://apis.rmlconnect.net/wba/v1/messages"
-    if not rcvr.startswith('+'):
-        rcvr = f"+91{rcvr.strip()[-10:]}"
-    payload = json.dumps({
-        "phone": rcvr,
-        "catalog": {
-            "type": "product_list",
-            "header": {
-                "type": "text",
-                "text": "Explore Our Fresh Veggie Combos! 🥗"
-            },
-            "body": {
-                "text": "Select a combo for farm-fresh vegetables delivered to you! 🚜"
-            },
-            "action": {
-                "catalog_id": catalog_id,
-                "sections": [
-                    {
-                        "title": "Fresh Vegetable Combos",
-                        "product_items": [
-                            {"product_retailer_id": "D-9011"},
-                            {"product_retailer_id": "A-9011"},
-                            {"product_retailer_id": "E-9011"},
-                            {"product_retailer_id": "B-9011"},
-                            {"product_retailer_id": "C-9011"},
-                            {"product_retailer_id": "xzwqdyrcl9"},
-                            {"product_retailer_id": "7e8sbb1xg8"},
-                            {"product_retailer_id": "dm4ngkc9xr"}
-                        ]
-                    }
-                ]
-            }
-        }
-    })
-    headers = {
-        'Content-Type': 'application/json',
-        'Authorization': authkey
-    }
-    try:
-        response = requests.post(url, headers=headers, data=payload.encode('utf-8'), verify=False, timeout=10)
-        response.raise_for_status()
-        savesentlog(rcvr, response.text, response.status_code, message)
-        return response.text
-    except requests.RequestException as e:
-        logging.error(f"Multi-product message failed: {e}")
-        return None
+    payload = RMLClient.product_list(
+        rcvr, catalog_id,
+        "Explore Our Fresh Veggie Combos! 🥗",
+        "Select a combo for farm-fresh vegetables delivered to you! 🚜",
+        "Fresh Vegetable Combos",
+        ["D-9011", "A-9011", "E-9011", "B-9011", "C-9011", "xzwqdyrcl9", "7e8sbb1xg8", "dm4ngkc9xr"]
+    )
+    queue_outbound(payload, message, url=CATALOG_URL)
 
+@tracer.traced
 def send_payment_message(frm, name, address, pincode, items, order_amount, reference_id, referral_code=None, discount_percentage=0):
     try:
         final_amount = order_amount * (1 - discount_percentage)
@@ -532,7 +541,7 @@ def send_payment_message(frm, name, address, pincode, items, order_amount, refer
             "description": "Balutedaar Vegetable Combo Order",
             "customer": {
                 "name": name,
-                "contact": frm if frm.startswith('+') else f"+91{frm[-10:]}"
+                "contact": normalize_phone(frm)
             },
             "notify": {
                 "sms": True,
@@ -543,7 +552,14 @@ def send_payment_message(frm, name, address, pincode, items, order_amount, refer
             "callback_url": os.getenv("PAYMENT_CALLBACK_URL", "http://13.202.207.66:5000/payment-callback"),
             "callback_method": "get"
         }
-        payment_link = razorpay_client.payment_link.create(payment_link_data)
+        outcome = 'error'
+        started = time.perf_counter()
+        try:
+            with tracer.span("razorpay.payment_link.create"):
+                payment_link = get_razorpay_client().payment_link.create(payment_link_data)
+            outcome = 'ok'
+        finally:
+            razorpay_seconds.observe(time.perf_counter() - started, "payment_link.create", outcome)
         payment_url = payment_link.get("short_url", "")
         if not payment_url:
             logging.error(f"Failed to generate payment URL for user {frm}: Empty short_url")
@@ -565,159 +581,188 @@ def send_payment_message(frm, name, address, pincode, items, order_amount, refer
         message += f"Click here to pay: {payment_url}\n\n"
         message += "Complete the payment to confirm your order!"
 
-        url = "https://apis.rmlconnect.net/wba/v1/messages?source=UI"
-        payload = json.dumps({
-            "phone": frm if frm.startswith('+') else f"+91{frm[-10:]}",
-            "text": message,
-            "enable_acculync": True,
-            "extra": "payment_link"
-        })
-        headers = {
-            'Content-Type': "application/json",
-            'Authorization': authkey,
-            'referer': 'myaccount.rmlconnect.net'
-        }
-        response = requests.post(url, data=payload.encode('utf-8'), headers=headers, verify=False, timeout=10)
-        response.raise_for_status()
-        savesentlog(frm, response.text, response.status_code, "payment_link")
+        queue_outbound(RMLClient.text_message(frm, message, "payment_link"), "payment_link")
         return payment_url
     except razorpay.errors.BadRequestError as e:
         logging.error(f"Razorpay BadRequestError for user {frm}: {str(e)}")
         return None
-    except requests.RequestException as e:
-        logging.error(f"Failed to send payment message to {frm}: {str(e)}")
-        return None
     except Exception as e:
         logging.error(f"Unexpected error in send_payment_message for user {frm}: {str(e)}")
         return None
 
+@tracer.traced
 def get_tiered_discount(user_phone):
     try:
-        cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        month_year = datetime.now().strftime('%Y-%m')
-        cursor.execute(
-            "SELECT COUNT(*) FROM referral_rewards WHERE user_phone = %s AND referral_code IN "
-            "(SELECT referral_code FROM referral_codes WHERE month_year = %s)",
-            (user_phone, month_year)
-        )
-        referral_count = cursor.fetchone()[0]
-        cnx.close()
+        with db_pool.session() as dbs:
+            month_year = datetime.now().strftime('%Y-%m')
+            key = ('referral_count', user_phone, month_year)
+            if key not in dbs.cache:
+                cursor = dbs.cursor()
+                cursor.execute(
+                    "SELECT referral_count FROM referral_stats WHERE user_phone = %s AND month_year = %s",
+                    (user_phone, month_year)
+                )
+                row = cursor.fetchone()
+                dbs.cache[key] = row[0] if row else 0
+            referral_count = dbs.cache[key]
         return TIERED_DISCOUNTS.get(referral_count, 0)
     except Exception as e:
+        if is_transient(e):
+            raise
         logging.error(f"Failed to get tiered discount for {user_phone}: {e}")
         return 0
 
-def checkout(rcvr, name, address, pincode, payment_method, cnx, cursor, reference_id=None):
+@tracer.traced
+def get_rewards_summary(phone):
+    """This month's rewards for ``phone`` from the rewards_summary projection.
+
+    One read joins the user row with the (phone, month) summary row; repeated
+    taps within REWARDS_CACHE_TTL seconds are answered from memory.
+    """
+    month_year = datetime.now().strftime('%Y-%m')
+    summary = rewards_cache.get((phone, month_year))
+    if summary is not None:
+        return summary
+    with db_pool.session() as dbs:
+        cursor = dbs.cursor()
+        cursor.execute(
+            "SELECT s.current_code, s.usage_count, s.points_month, u.balutedaar_points, u.pending_free_boxes "
+            "FROM users u LEFT JOIN rewards_summary s ON s.user_phone = u.phone_number AND s.month_year = %s "
+            "WHERE u.phone_number = %s",
+            (month_year, phone)
+        )
+        row = cursor.fetchone() or (None, None, None, None, None)
+    summary = {
+        "code": row[0] or "None",
+        "usage_count": row[1] or 0,
+        "points_month": row[2] or 0,
+        "lifetime_points": row[3] or 0,
+        "pending_free_boxes": row[4] or 0,
+    }
+    rewards_cache.set((phone, month_year), summary)
+    return summary
+
+REBUILD_REFERRAL_STATS = (
+    "INSERT INTO referral_stats (user_phone, month_year, referral_count) "
+    "SELECT rr.user_phone, rc.month_year, COUNT(*) FROM referral_rewards rr "
+    "JOIN referral_codes rc ON rc.referral_code = rr.referral_code "
+    "GROUP BY rr.user_phone, rc.month_year"
+)
+
+REBUILD_REWARDS_SUMMARY = (
+    "INSERT INTO rewards_summary (user_phone, month_year, current_code, usage_count, points_month) "
+    "SELECT rc.user_phone, rc.month_year, rc.referral_code, rc.usage_count, "
+    "(SELECT COALESCE(SUM(rr.points_earned), 0) FROM referral_rewards rr "
+    " JOIN referral_codes m ON m.referral_code = rr.referral_code "
+    " WHERE rr.user_phone = rc.user_phone AND m.month_year = rc.month_year) "
+    "FROM referral_codes rc WHERE rc.created_at = ("
+    " SELECT MAX(l.created_at) FROM referral_codes l WHERE l.user_phone = rc.user_phone AND l.month_year = rc.month_year) "
+    "ON DUPLICATE KEY UPDATE current_code = VALUES(current_code), usage_count = VALUES(usage_count), "
+    "points_month = VALUES(points_month)"
+)
+
+def rebuild_referral_stats():
+    """Recompute referral_stats and rewards_summary from referral_rewards in one transaction."""
+    with db_pool.session() as dbs:
+        cursor = dbs.cursor()
+        cursor.execute("DELETE FROM referral_stats")
+        cursor.execute(REBUILD_REFERRAL_STATS)
+        rows = cursor.rowcount
+        cursor.execute("DELETE FROM rewards_summary")
+        cursor.execute(REBUILD_REWARDS_SUMMARY)
+    rewards_cache.clear()
+    return rows
+
+@app.cli.command('rebuild-referral-stats')
+def rebuild_referral_stats_command():
+    """Recompute the per-user monthly referral counters and rewards summaries."""
+    rows = rebuild_referral_stats()
+    print(f"Rebuilt referral_stats: {rows} rows")
+
+class CheckoutError(Exception):
+    pass
+
+@tracer.traced
+@query_budget.scoped
+def checkout(rcvr, name, address, pincode, payment_method, reference_id=None):
     try:
-        cursor.execute("SELECT name, address, pincode, referral_code FROM users WHERE phone_number = %s", (rcvr,))
-        user_data = cursor.fetchone()
-        if not user_data or not all(user_data[:3]):
-            return {"total": 0, "message": "Error: User data incomplete. Please provide name, address, and pincode."}
-        referral_code = user_data[3]
-        
-        cursor.execute("SELECT combo_id, combo_name, quantity, price FROM user_cart WHERE phone_number = %s", (rcvr,))
-        cart_items = cursor.fetchall()
-        if not cart_items:
-            return {"total": 0, "message": "Error: No valid order details found. Please select a combo."}
-        
-        total = 0
-        order_ids = []
-        delivery_date = (datetime.now() + timedelta(days=1)).date()
-        for item in cart_items:
-            combo_id, combo_name, quantity, price = item
-            is_available, _ = check_inventory(combo_id, quantity)
-            if not is_available:
-                return {"total": 0, "message": f"Error: {combo_name} is out of stock or insufficient quantity."}
-            subtotal = float(price) * quantity
-            total += subtotal
-            cursor.execute(
+        with db_pool.session() as dbs, dbs.savepoint():
+            cursor = dbs.cursor()
+            cursor.execute("SELECT name, address, pincode, referral_code FROM users WHERE phone_number = %s", (rcvr,))
+            user_data = cursor.fetchone()
+            if not user_data or not all(user_data[:3]):
+                raise CheckoutError("Error: User data incomplete. Please provide name, address, and pincode.")
+            referral_code = user_data[3]
+            
+            cursor.execute("SELECT combo_id, combo_name, quantity, price FROM user_cart WHERE phone_number = %s", (rcvr,))
+            cart_items = cursor.fetchall()
+            if not cart_items:
+                raise CheckoutError("Error: No valid order details found. Please select a combo.")
+            
+            failed = reserve_inventory([(combo_id, combo_name, quantity) for combo_id, combo_name, quantity, _ in cart_items])
+            if failed:
+                names = ", ".join(combo_name for _, combo_name, _ in failed)
+                verb = "is" if len(failed) == 1 else "are"
+                raise CheckoutError(f"Error: {names} {verb} out of stock or insufficient quantity.")
+            
+            total = 0
+            order_rows = []
+            payment_status = 'Pending' if payment_method != 'COD' else 'Completed'
+            delivery_date = (datetime.now() + timedelta(days=1)).date()
+            for item in cart_items:
+                combo_id, combo_name, quantity, price = item
+                subtotal = float(price) * quantity
+                total += subtotal
+                order_rows.append((rcvr, name, combo_id, combo_name, float(price), quantity, subtotal, address, pincode, payment_method,
+                                   payment_status, 'Placed', reference_id, referral_code, delivery_date))
+            cursor.executemany(
                 "INSERT INTO orders (user_phone, customer_name, combo_id, combo_name, price, quantity, total_amount, address, pincode, payment_method, payment_status, order_status, reference_id, referral_code, delivery_date) "
                 "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                (rcvr, name, combo_id, combo_name, float(price), quantity, subtotal, address, pincode, payment_method,
-                 'Pending' if payment_method != 'COD' else 'Completed', 'Placed', reference_id, referral_code, delivery_date)
+                order_rows
             )
-            update_inventory(combo_id, quantity)
-            order_ids.append(cursor.lastrowid)
-        
-        discount_percentage = get_tiered_discount(rcvr)
-        if referral_code:
-            is_valid, user_phone = validate_referral_code(referral_code, rcvr)
-            if is_valid:
-                total = max(total - 20, 0)
-                for order_id in order_ids:
+            # A multi-row INSERT reports the id of its first row; the reward points at that row.
+            order_id = cursor.lastrowid
+            
+            discount_percentage = get_tiered_discount(rcvr)
+            if referral_code:
+                is_valid, user_phone = validate_referral_code(referral_code, rcvr)
+                if is_valid:
+                    total = max(total - 20, 0)
                     assign_referral_rewards(user_phone, referral_code, rcvr, order_id)
-        total = max(total * (1 - discount_percentage), 0)
-        
-        cursor.execute("DELETE FROM user_cart WHERE phone_number = %s", (rcvr,))
-        cursor.execute("UPDATE users SET pincode = NULL, referral_code = NULL WHERE phone_number = %s", (rcvr,))
-        cnx.commit()
-        new_referral_code = generate_referral_code(rcvr)
+            total = max(total * (1 - discount_percentage), 0)
+            
+            cursor.execute("DELETE FROM user_cart WHERE phone_number = %s", (rcvr,))
+            new_referral_code = generate_referral_code(rcvr)
         return {
             "total": total,
             "message": f"Order placed! Total: ₹{total:.2f}\nYour order will be delivered to {address}, Pincode: {pincode} by tomorrow 9 AM.",
             "referral_code": new_referral_code,
             "discount_percentage": discount_percentage
         }
+    except CheckoutError as e:
+        return {"total": 0, "message": str(e)}
     except Exception as e:
+        if is_transient(e):
+            # The whole webhook transaction is gone; fail the message so it is retried, not half-applied.
+            raise
         logging.error(f"Checkout failed for user {rcvr}: {e}")
-        cnx.rollback()
         return {"total": 0, "message": f"Error during checkout: {str(e)}. Please try again."}
 
 def check_pincode(pincode):
-    try:
-        cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        cursor.execute("SELECT pincode FROM pincodes WHERE pincode = %s", (pincode,))
-        result = cursor.fetchone()
-        cnx.close()
-        return result is not None
-    except Exception as e:
-        logging.error(f"Pincode check failed: {e}")
-        return False
+    return pincode in pincode_index
+
+def pincode_error_message():
+    return r3.format(areas="\n".join(f"• *{p}*  " for p in pincode_index.sorted()))
 
 def get_combo_price(combo_id):
-    try:
-        if combo_id in FALLBACK_COMBOS:
-            return float(FALLBACK_COMBOS[combo_id].get("price", 0))
-        cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        cursor.execute("SELECT price FROM combos WHERE combo_id = %s", (combo_id,))
-        result = cursor.fetchone()
-        cnx.close()
-        return float(result[0]) if result else 0
-    except Exception as e:
-        logging.error(f"Failed to fetch price for combo_id {combo_id}: {e}")
-        return float(FALLBACK_COMBOS.get(combo_id, {}).get("price", 0))
+    return catalog.price(combo_id.strip())
 
 def get_combo_name(combo_id):
-    combo_id = combo_id.strip()
-    try:
-        cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        cursor.execute("SELECT combo_name FROM combos WHERE combo_id = %s", (combo_id,))
-        result = cursor.fetchone()
-        cnx.close()
-        return result[0] if result else FALLBACK_COMBOS.get(combo_id, {}).get("name", "Unknown Combo")
-    except Exception as e:
-        logging.error(f"Failed to fetch name for combo_id {combo_id}: {e}")
-        return FALLBACK_COMBOS.get(combo_id, {}).get("name", "Unknown Combo")
+    return catalog.name(combo_id.strip())
 
-def reset_user_flags(frm, cnx, cursor):
-    try:
-        reset_query = """UPDATE users SET 
-            is_info = '0', main_menu = '0', is_main = '0', 
-            is_temp = '0', sub_menu = '0', is_submenu = '0',
-            selected_combo = NULL, quantity = NULL, 
-            address = NULL, payment_method = NULL, order_amount = NULL,
-            combo_id = NULL, pincode = NULL, is_referral = '0', referral_code = NULL
-            WHERE phone_number = %s"""
-        cursor.execute(reset_query, (frm,))
-        cursor.execute("DELETE FROM user_cart WHERE phone_number = %s", (frm,))
-        cnx.commit()
-    except Exception as e:
-        logging.error(f"Reset flags failed: {e}")
-        cnx.rollback()
+def clear_cart(frm):
+    with db_pool.session() as dbs:
+        dbs.cursor().execute("DELETE FROM user_cart WHERE phone_number = %s", (frm,))
 
 def is_valid_name(resp1):
     if resp1.lower() in greeting_word:
@@ -743,18 +788,18 @@ def is_valid_address(address):
         return False
     return True
 
+@tracer.traced
 def get_cart_summary(phone, name, address=None):
     try:
-        cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        cursor.execute("SELECT referral_code FROM users WHERE phone_number = %s", (phone,))
-        referral_code = cursor.fetchone()[0]
-        cursor.execute("SELECT combo_id, combo_name, quantity, price FROM user_cart WHERE phone_number = %s", (phone,))
-        cart_items = cursor.fetchall()
+        with db_pool.session() as dbs:
+            cursor = dbs.cursor()
+            cursor.execute("SELECT referral_code FROM users WHERE phone_number = %s", (phone,))
+            referral_code = cursor.fetchone()[0]
+            cursor.execute("SELECT combo_id, combo_name, quantity, price FROM user_cart WHERE phone_number = %s", (phone,))
+            cart_items = cursor.fetchall()
         total = 0
         item_count = 0
         if not cart_items:
-            cnx.close()
             return "No order details found! Please select a combo to proceed.", 0, 0
         
         cart_message = f"Hi *{name}*, 👋\n\nHere’s your Order Summary:\n\n"
@@ -775,7 +820,6 @@ def get_cart_summary(phone, name, address=None):
         cart_message += f"\n💰 Total Amount: ₹{total:.2f}"
         if address:
             cart_message += f"\n📍 Delivery Address: {address}"
-        cnx.close()
         return cart_message, total, item_count
     except Exception as e:
         logging.error(f"Error in get_cart_summary for {phone}: {e}")
@@ -798,23 +842,22 @@ def admin_dashboard():
     if not session.get('logged_in'):
         return redirect(url_for('admin_login'))
     try:
-        cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        today = datetime.now().date()
-        tomorrow = today + timedelta(days=1)
-        cursor.execute(
-            "SELECT order_id, user_phone, customer_name, combo_name, quantity, total_amount, address, pincode, order_status, payment_status "
-            "FROM orders WHERE delivery_date IN (%s, %s)",
-            (today, tomorrow)
-        )
-        orders = cursor.fetchall()
-        cursor.execute("SELECT combo_id, combo_name, total_boxes, booked, total_boxes - booked AS remaining FROM combo_inventory")
-        inventory = cursor.fetchall()
-        cursor.execute("SELECT pincode FROM pincodes")
-        pincodes = [row[0] for row in cursor.fetchall()]
-        cursor.execute("SELECT combo_id, combo_name FROM combos")
-        combos = cursor.fetchall()
-        cnx.close()
+        with db_pool.session() as dbs:
+            cursor = dbs.cursor()
+            today = datetime.now().date()
+            tomorrow = today + timedelta(days=1)
+            cursor.execute(
+                "SELECT order_id, user_phone, customer_name, combo_name, quantity, total_amount, address, pincode, order_status, payment_status "
+                "FROM orders WHERE delivery_date IN (%s, %s)",
+                (today, tomorrow)
+            )
+            orders = cursor.fetchall()
+            cursor.execute("SELECT combo_id, combo_name, total_boxes, booked, total_boxes - booked AS remaining FROM combo_inventory")
+            inventory = cursor.fetchall()
+            cursor.execute("SELECT pincode FROM pincodes")
+            pincodes = [row[0] for row in cursor.fetchall()]
+            cursor.execute("SELECT combo_id, combo_name FROM combos")
+            combos = cursor.fetchall()
         return render_template('admin_dashboard.html', orders=orders, inventory=inventory, pincodes=pincodes, combos=combos)
     except Exception as e:
         logging.error(f"Admin dashboard error: {e}")
@@ -825,34 +868,431 @@ def update_inventory_route():
     if not session.get('logged_in'):
         return redirect(url_for('admin_login'))
     try:
-        cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        for combo_id in request.form:
-            if combo_id.startswith('quantity_'):
-                combo_id = combo_id.replace('quantity_', '')
-                total_boxes = int(request.form.get(f'quantity_{combo_id}', 0))
-                combo_name = get_combo_name(combo_id)
-                cursor.execute(
-                    "INSERT INTO combo_inventory (combo_id, combo_name, total_boxes, booked) "
-                    "VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE total_boxes = %s, booked = booked",
-                    (combo_id, combo_name, total_boxes, 0, total_boxes)
-                )
-        cnx.commit()
-        cnx.close()
+        with db_pool.session() as dbs:
+            cursor = dbs.cursor()
+            for combo_id in request.form:
+                if combo_id.startswith('quantity_'):
+                    combo_id = combo_id.replace('quantity_', '')
+                    total_boxes = int(request.form.get(f'quantity_{combo_id}', 0))
+                    combo_name = get_combo_name(combo_id)
+                    cursor.execute(
+                        "INSERT INTO combo_inventory (combo_id, combo_name, total_boxes, booked) "
+                        "VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE total_boxes = %s, booked = booked",
+                        (combo_id, combo_name, total_boxes, 0, total_boxes)
+                    )
+            catalog.invalidate()
         return redirect(url_for('admin_dashboard'))
     except Exception as e:
         logging.error(f"Update inventory error: {e}")
         return render_template('admin_dashboard.html', error=str(e))
 
+@app.route('/admin/pincodes/refresh', methods=['POST'])
+def refresh_pincodes_route():
+    if not session.get('logged_in'):
+        return redirect(url_for('admin_login'))
+    pincode_index.refresh()
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/pool_stats', methods=['GET'])
+def pool_stats_route():
+    if not session.get('logged_in'):
+        return redirect(url_for('admin_login'))
+    return jsonify(dict(db_pool.stats(), worker=startup_stats))
+
+@app.route('/admin/outbound_stats', methods=['GET'])
+def outbound_stats_route():
+    if not session.get('logged_in'):
+        return redirect(url_for('admin_login'))
+    return jsonify({"outbound": outbound.stats(), "tbl_logs": log_writer.stats(),
+                    "tbl_logs_status": status_writer.stats(), "dedupe": dedupe.stats(),
+                    "inbound": inbound.stats(), "inbox": inbox.stats() if INBOUND_FAST_ACK else None,
+                    "admission": admission.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    token = os.getenv("METRICS_TOKEN")
+    scraper = token and request.headers.get('Authorization') == f"Bearer {token}"
+    if not (scraper or session.get('logged_in')):
+        return redirect(url_for('admin_login'))
+    return registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 @app.route('/admin/logout', methods=['GET'])
 def admin_logout():
     session.pop('logged_in', None)
     return redirect(url_for('admin_login'))
 
+def ingest_statuses(statuses):
+    """Queue delivery receipts for the batched tbl_logs upsert; nothing is written inline."""
+    for status in statuses or []:
+        message_id = status.get("id")
+        if not message_id or not status.get("status"):
+            continue
+        try:
+            timestamp = datetime.fromtimestamp(int(status["timestamp"]))
+        except (KeyError, TypeError, ValueError):
+            timestamp = datetime.now()
+        status_writer.add((str(status.get("recipient_id", "")), message_id, status["status"], str(timestamp)))
+
+def send_rewards_summary(frm):
+    summary = get_rewards_summary(frm)
+    code = summary["code"]
+    usage_count = summary["usage_count"]
+    points_earned = summary["points_month"]
+    total_points = summary["lifetime_points"]
+    discount_percentage = TIERED_DISCOUNTS.get(usage_count, 0) * 100
+    status_message = f"Refer {5 - usage_count} more friends for a FREE ₹200 Veggie Box!" if usage_count < 5 else "You unlocked a FREE ₹200 Veggie Box!"
+    message = (
+        f"🌟 Your Rewards Summary:\n"
+        f"📊 Current Code: {code} (Used by {usage_count}/5 friends)\n"
+        f"💰 Points This Month: ₹{points_earned}\n"
+        f"💸 Total Points: ₹{total_points}\n"
+        f"🎁 Your Next Order Discount: {discount_percentage}% OFF\n"
+        f"🎁 {status_message}\n"
+    )
+    if summary["pending_free_boxes"]:
+        message += f"📦 Free Veggie Boxes waiting: {summary['pending_free_boxes']}\n"
+    message += "👉 Type ‘Redeem’ to use points!"
+    send_message(frm, message, "rewards_summary")
+
+def on_greeting(frm, conv, payload):
+    profile_name = payload.get("contacts", [{}])[0].get("profile", {}).get("name", "").strip()
+    if not (profile_name and is_valid_name(profile_name)):
+        profile_name = None
+    if conv is None:
+        if profile_name:
+            conversations.create(frm, ConvState.AWAITING_PINCODE, name=profile_name)
+            send_message(frm, wl.format(name=profile_name), 'pincode')
+        else:
+            conversations.create(frm, ConvState.AWAITING_NAME)
+            send_message(frm, wl_fallback, 'welcome_message')
+        return
+    clear_cart(frm)
+    name = conv.name or profile_name
+    if name:
+        conversations.transition(conv, ConvState.AWAITING_PINCODE, name=name,
+                                 pincode=None, address=None, referral_code=None)
+        send_message(frm, r2.format(name=name), 'pincode')
+    else:
+        conversations.transition(conv, ConvState.AWAITING_NAME, pincode=None, address=None, referral_code=None)
+        send_message(frm, wl_fallback, 'welcome_message')
+
+def on_name(conv, msg_type, resp1, payload):
+    if is_valid_name(resp1):
+        conversations.transition(conv, ConvState.AWAITING_PINCODE, name=resp1)
+        send_message(conv.phone, r2.format(name=resp1), 'pincode')
+    else:
+        send_message(conv.phone, invalid_name, "invalid_name")
+
+def on_pincode(conv, msg_type, resp1, payload):
+    frm = conv.phone
+    if not (resp1.isdigit() and len(resp1) == 6):
+        send_message(frm, r4, 'invalid_pincode')
+    elif not check_pincode(resp1):
+        send_message(frm, pincode_error_message(), 'pincode_error')
+    else:
+        conversations.transition(conv, ConvState.AWAITING_REFERRAL, pincode=resp1)
+        combo_list = get_combo_availability()
+        send_message(frm, m1.format(combo_list=combo_list), 'combo_availability')
+        send_referral_prompt_with_button(frm, referral_prompt, 'referral_code')
+
+def on_referral(conv, msg_type, resp1, payload):
+    frm = conv.phone
+    if msg_type == 'interactive' and resp1 == 'skip_button':
+        conversations.transition(conv, ConvState.BROWSING)
+        send_multi_product_message(frm, CATALOG_ID, 'menu')
+        return
+    is_valid, _ = validate_referral_code(resp1, frm)
+    if is_valid:
+        conversations.transition(conv, ConvState.BROWSING, referral_code=resp1)
+        send_message(frm, referral_success, 'referral_success')
+        send_multi_product_message(frm, CATALOG_ID, 'menu')
+    else:
+        send_referral_prompt_with_button(frm, invalid_referral.format(code=resp1), 'invalid_referral')
+
+def on_catalog_order(conv, msg_type, resp1, payload):
+    frm = conv.phone
+    if msg_type != 'order':
+        return
+    order = payload["messages"][0]["order"]
+    if 'product_items' not in order:
+        send_multi_product_message(frm, CATALOG_ID, 'menu')
+        return
+    lines = [(item.get("product_retailer_id", "").strip(), int(item.get("quantity", 1)))
+             for item in order["product_items"]]
+    unavailable, cart_rows = build_cart(frm, lines)
+    if unavailable:
+        send_message(frm, out_of_stock.format(combo_name=", ".join(unavailable)), "out_of_stock")
+        send_multi_product_message(frm, CATALOG_ID, 'menu')
+    elif cart_rows:
+        conversations.transition(conv, ConvState.AWAITING_ADDRESS, address=None)
+        send_message(frm, m3, "ask_address")
+    else:
+        send_multi_product_message(frm, CATALOG_ID, 'menu')
+        send_message(frm, "Sorry, none of the selected products are available. Please choose another combo.", "illegal_combo")
+
+def on_address(conv, msg_type, resp1, payload):
+    frm = conv.phone
+    if msg_type == 'order':
+        on_catalog_order(conv, msg_type, resp1, payload)
+        return
+    if not is_valid_address(resp1):
+        send_message(frm, invalid_address, 'invalid_address')
+        return
+    order_summary, total, item_count = get_cart_summary(frm, conv.name, resp1)
+    if item_count == 0:
+        conversations.transition(conv, ConvState.BROWSING, address=resp1)
+        send_message(frm, order_summary, "no_order")
+        send_multi_product_message(frm, CATALOG_ID, 'menu')
+    else:
+        conversations.transition(conv, ConvState.ORDER_REVIEW, address=resp1)
+        order_summary += "\n\nPlease confirm your order or go back to the menu to make changes."
+        interactive_template_with_2button(frm, order_summary, "order_summary")
+
+def on_review(conv, msg_type, resp1, payload):
+    frm = conv.phone
+    if msg_type == 'order':
+        on_catalog_order(conv, msg_type, resp1, payload)
+    elif resp1 == "1":
+        interactive_template_with_3button(frm, "💳 Please select your preferred payment method to continue:", "payment")
+    elif resp1 == "2":
+        clear_cart(frm)
+        conversations.transition(conv, ConvState.BROWSING, address=None)
+        send_multi_product_message(frm, CATALOG_ID, "menu")
+    else:
+        payment_method = {"3": "COD", "5": "Pay Now"}.get(resp1)
+        if payment_method:
+            place_order(conv, payment_method)
+
+@tracer.traced
+@query_budget.scoped
+def place_order(conv, payment_method):
+    frm, name, address, pincode = conv.phone, conv.name, conv.address, conv.pincode
+    with db_pool.session() as dbs:
+        cursor = dbs.cursor()
+        cursor.execute("SELECT combo_id, combo_name, quantity, price FROM user_cart WHERE phone_number = %s", (frm,))
+        cart_items = cursor.fetchall()
+        if not cart_items:
+            send_message(frm, "No order details found! Please select a combo to proceed.", "no_order")
+            return
+
+        total_amount = sum(float(item[3]) * item[2] for item in cart_items)
+        items = [(item[0], item[1], float(item[3]), item[2]) for item in cart_items]
+        discount_percentage = get_tiered_discount(frm)
+        reference_id = f"q9{uuid.uuid4().hex[:8]}"
+        checkout_result = checkout(frm, name, address, pincode, payment_method, reference_id)
+        if checkout_result["total"] == 0:
+            send_message(frm, checkout_result["message"], "invalid_order")
+            return
+
+        if payment_method == "Pay Now":
+            conversations.transition(conv, ConvState.IDLE, pincode=None, referral_code=None)
+            # Commit the order and its stock reservation before calling Razorpay, so the
+            # combo_inventory row locks are not held for the length of the HTTP call.
+            dbs.after_commit(lambda: send_payment_link(frm, name, address, pincode, items, total_amount, reference_id,
+                                                       conv.referral_code, discount_percentage))
+            return
+
+        cursor.execute(
+            "SELECT combo_id, combo_name, price, quantity, total_amount, address, referral_code "
+            "FROM orders WHERE user_phone = %s AND reference_id = %s AND payment_method = 'COD' AND order_status = 'Placed'",
+            (frm, reference_id)
+        )
+        items = cursor.fetchall()
+        if not items:
+            send_message(frm, "Error: No order found. Please try again.", "no_order")
+            return
+        conversations.transition(conv, ConvState.IDLE, pincode=None, referral_code=None)
+
+    total = checkout_result["total"]
+    new_referral_code = checkout_result["referral_code"]
+    discount_percentage = checkout_result["discount_percentage"]
+    confirmation = f"Dear *{name}*,\n\nThank you for your order with Balutedaar! Below is your order confirmation:\n\n📦 *Order Details*:\n"
+    for item in items:
+        combo_id, combo_name, price, quantity, item_total, address, order_referral_code = item
+        subtotal = float(price) * quantity
+        confirmation += f"🛒 {combo_name} x{quantity}: ₹{subtotal:.2f}\n"
+    if order_referral_code:
+        confirmation += f"🎁 Referral Discount: -₹20.00\n"
+    if discount_percentage > 0:
+        confirmation += f"🎁 Tiered Discount ({int(discount_percentage * 100)}%): -₹{(item_total - total):.2f}\n"
+    confirmation += f"\n💰 Total Amount: ₹{total:.2f}\n📍 Delivery Address: {address}\n"
+    confirmation += f"🚚 Delivery Schedule: Your order will be delivered to your doorstep by tomorrow 9 AM.\n\n"
+    confirmation += f"🎉 Here’s your unique referral code: {new_referral_code}\nRefer your friends to earn ₹50 per order they place!\n\n"
+    confirmation += f"We appreciate your support for fresh, sustainable produce. If you’ve any questions, reach out!\n\nBest regards,\nThe Balutedaar Team"
+    send_message(frm, confirmation, "order_confirmation")
+    gamified_prompt = (
+        f"🎯 Mission Veggie-Star: UNLOCK REWARDS!\n"
+        f"Share your code *{new_referral_code}* with up to 5 friends this month and get:\n"
+        f"🥕 ₹50 Balutedaar Points per friend\n"
+        f"🥬 Friends get 10% OFF\n"
+        f"🎁 Refer 5 friends = FREE ₹200 Veggie Box!\n"
+        f"📤 Tap to Share: Tap here to get the message: https://wa.me/+917477751777?text=Use+my+code+%22{new_referral_code}%22+to+get+fresh+veggies!%0Awith+Bot+number:+917477751777%0ASend+%22Hi%22+to+Start."
+    )
+    send_message(frm, gamified_prompt, "gamified_prompt")
+
+def send_payment_link(frm, name, address, pincode, items, total_amount, reference_id, referral_code, discount_percentage):
+    if send_payment_message(frm, name, address, pincode, items, total_amount, reference_id, referral_code, discount_percentage):
+        return
+    if cancel_unpaid_order(frm, reference_id):
+        interactive_template_with_3button(frm, "⚠️ We couldn't generate your payment link. Your items are back in your cart; "
+                                               "please select a payment method again:", "payment_error")
+    else:
+        send_message(frm, "Error generating payment link. Your order has been cancelled; please place it again.", "payment_error")
+
+@tracer.traced
+def cancel_unpaid_order(frm, reference_id):
+    """Undo a Pay Now order whose payment link could not be created.
+
+    The order rows are marked failed and their stock goes back to
+    combo_inventory. If the user has not moved on since placing it, the lines
+    are put back in the cart and the conversation returns to order review so
+    they can pick a payment method again. Returns True when the cart was
+    restored.
+    """
+    with db_pool.session() as dbs:
+        cursor = dbs.cursor()
+        cursor.execute(
+            "SELECT combo_id, combo_name, quantity, price, pincode, referral_code FROM orders "
+            "WHERE user_phone = %s AND reference_id = %s AND payment_status = 'Pending' ORDER BY combo_id FOR UPDATE",
+            (frm, reference_id)
+        )
+        lines = cursor.fetchall()
+        if not lines:
+            return False
+        cursor.execute(
+            "UPDATE orders SET payment_status = 'Failed', order_status = 'Cancelled' WHERE reference_id = %s AND payment_status = 'Pending'",
+            (reference_id,)
+        )
+        # Same combo_id order as reserve_inventory, so the two cannot deadlock.
+        for combo_id, _, quantity, _, _, _ in lines:
+            cursor.execute(
+                "UPDATE combo_inventory SET booked = booked - %s, total_boxes = total_boxes + %s WHERE combo_id = %s",
+                (quantity, quantity, combo_id)
+            )
+        conv = conversations.load(frm)
+        if conv is None or conv.state != ConvState.IDLE:
+            return False
+        try:
+            conversations.transition(conv, ConvState.ORDER_REVIEW, pincode=lines[0][4], referral_code=lines[0][5])
+        except StaleConversation:
+            return False
+        cursor.execute("DELETE FROM user_cart WHERE phone_number = %s", (frm,))
+        cursor.executemany(
+            "INSERT INTO user_cart (phone_number, combo_id, combo_name, quantity, price) VALUES (%s, %s, %s, %s, %s)",
+            [(frm, combo_id, combo_name, quantity, price) for combo_id, combo_name, quantity, price, _, _ in lines]
+        )
+    return True
+
+STATE_HANDLERS = {
+    ConvState.AWAITING_NAME: on_name,
+    ConvState.AWAITING_PINCODE: on_pincode,
+    ConvState.AWAITING_REFERRAL: on_referral,
+    ConvState.BROWSING: on_catalog_order,
+    ConvState.AWAITING_ADDRESS: on_address,
+    ConvState.ORDER_REVIEW: on_review,
+}
+
+@tracer.traced
+@query_budget.scoped
+def handle_message(frm, msg_type, resp1, payload):
+    """Advance ``frm``'s conversation by one inbound message."""
+    started = time.perf_counter()
+    branch, outcome = 'load', 'error'
+    try:
+        if resp1.lower() == 'my rewards':
+            branch = 'my_rewards'
+            send_rewards_summary(frm)
+        else:
+            conv = conversations.load(frm)
+            if resp1 in greeting_word:
+                branch = 'greeting'
+                on_greeting(frm, conv, payload)
+            elif conv is None:
+                branch = 'unknown_user'
+            else:
+                branch = conv.state.value.lower()
+                handler = STATE_HANDLERS.get(conv.state)
+                if handler:
+                    handler(conv, msg_type, resp1, payload)
+        outcome = 'ok'
+    finally:
+        tracer.annotate(branch=branch)
+        query_budget.rename(branch)
+        message_seconds.observe(time.perf_counter() - started, branch, outcome)
+
+def process_message(message_id, frm, msg_type, resp1, payload):
+    """Handle one message in its own transaction, retrying once from a fresh read if the cached state was
+    stale or MySQL rolled the transaction back on a deadlock or lock wait timeout.
+
+    Runs on the phone's inbound shard while holding the phone's named lock,
+    so no two workers in any process handle the same user at once.
+    Redeliveries of an already processed ``message_id`` are dropped.
+    """
+    if message_id and dedupe.seen(message_id):
+        return
+    for attempt in range(2):
+        try:
+            with db_pool.session() as dbs:
+                dbs.lock(f"conv:{frm}", CONVERSATION_LOCK_TIMEOUT)
+                if message_id and not dedupe.claim(message_id):
+                    return
+                handle_message(frm, msg_type, resp1, payload)
+            return
+        except StaleConversation:
+            if attempt:
+                raise
+            logging.info(f"Conversation state for {frm} changed underneath us, retrying")
+        except Exception as e:
+            if attempt or not is_transient(e):
+                raise
+            # Reads cached during the rolled-back transaction may include writes that never committed.
+            conversations.invalidate(frm)
+            logging.warning(f"Transaction for {frm} rolled back by MySQL ({e}), retrying")
+
+def parse_message(payload):
+    """(message_id, frm, msg_type, resp1) for the first message of a webhook payload."""
+    message = payload["messages"][0]
+    frm = str(message["from"])
+    msg_type = message["type"]
+    if msg_type == "interactive":
+        interactive_data = message["interactive"]
+        resp1 = interactive_data.get("button_reply", {}).get("id", interactive_data.get("list_reply", {}).get("id", ""))
+    elif msg_type == 'text':
+        resp1 = message["text"]["body"]
+    elif msg_type == 'order':
+        resp1 = message["order"].get("product_items", [{}])[0].get("product_retailer_id", "")
+    else:
+        resp1 = ''
+    return message.get("id"), frm, msg_type, resp1
+
+def consume_inbox(payload):
+    message_id, frm, msg_type, resp1 = parse_message(payload)
+    with tracer.span("inbox.message", message_id=message_id), query_budget.scope("inbox.message"):
+        process_message(message_id, frm, msg_type, resp1, payload)
+
+inbox = Inbox.from_env(consume_inbox, inbound)
+admission = AdmissionController.from_env({
+    "pool_wait_ms": db_pool.recent_wait_ms,
+    "outbound_depth": outbound.depth,
+    "inbound_depth": inbound.depth,
+})
+
+def message_priority(frm, resp1):
+    if resp1.lower() == 'my rewards':
+        return LOW
+    if conversations.peek_state(frm) in (ConvState.AWAITING_ADDRESS, ConvState.ORDER_REVIEW):
+        return HIGH
+    return NORMAL
+
+def shed_response():
+    return jsonify({"error": "Busy, retry later"}), 503, {"Retry-After": os.getenv("ADMISSION_RETRY_AFTER", "5")}
+
 @app.route('/', methods=['POST', 'GET'])
 def Get_Message():
-    cnx = None
-    cursor = None
+    with tracer.span("webhook", method=request.method), query_budget.scope("webhook"):
+        return handle_webhook()
+
+def handle_webhook():
     logging.info(f"Incoming request: {request.method} {request.url} from {request.remote_addr}")
     try:
         if request.method == 'GET':
@@ -866,331 +1306,41 @@ def Get_Message():
             return jsonify({"error": "Invalid JSON payload"}), 400
         
         if 'statuses' in response:
+            with admission.admit(LOW) as admitted:
+                if not admitted:
+                    return shed_response()
+                ingest_statuses(response['statuses'])
             return 'Success', 200
         
         if 'messages' not in response:
             return jsonify({"error": "Missing 'messages' key"}), 400
         
-        frm = str(response["messages"][0]["from"])
-        msg_type = response["messages"][0]["type"]
-        if msg_type == "interactive":
-            interactive_data = response["messages"][0]["interactive"]
-            resp1 = interactive_data.get("button_reply", {}).get("id", interactive_data.get("list_reply", {}).get("id", ""))
-        elif msg_type == 'text':
-            resp1 = response["messages"][0]["text"]["body"]
-        elif msg_type == 'order':
-            resp1 = response["messages"][0]["order"].get("product_items", [{}])[0].get("product_retailer_id", "")
-        else:
-            resp1 = ''
-            
-        cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-        cursor = cnx.cursor()
-        check_already_valid = "SELECT name, pincode, selected_combo, quantity, address, payment_method, is_valid, order_amount, is_info, main_menu, is_main, is_temp, sub_menu, is_submenu, combo_id, is_referral, referral_code FROM users WHERE phone_number = %s"
-        cursor.execute(check_already_valid, (frm,))
-        result = cursor.fetchone()
-
-        if result is None:
-            camp_id = '0'
-            is_valid = '0'
-            name = None
-            pincode = None
-            selected_combo = None
-            quantity = None
-            address = None
-            payment_method = None
-            order_amount = None
-            is_info = '0'
-            main_menu = '0'
-            is_main = '0'
-            is_temp = '0'
-            sub_menu = '0'
-            is_submenu = '0'
-            combo_id = None
-            is_referral = '0'
-            referral_code = None
-        else:
-            name, pincode, selected_combo, quantity, address, payment_method, is_valid, order_amount, is_info, main_menu, is_main, is_temp, sub_menu, is_submenu, combo_id, is_referral, referral_code = result
-            camp_id = '1'
-
-        if (msg_type == 'text' or msg_type == 'interactive' or msg_type == 'order') and len(frm) == 12:
-            if resp1.lower() == 'my rewards':
-                cursor.execute(
-                    "SELECT referral_code, usage_count FROM referral_codes WHERE user_phone = %s AND month_year = %s",
-                    (frm, datetime.now().strftime('%Y-%m'))
-                )
-                code_data = cursor.fetchone()
-                code = code_data[0] if code_data else "None"
-                usage_count = code_data[1] if code_data else 0
-                cursor.execute(
-                    "SELECT SUM(points_earned) FROM referral_rewards WHERE user_phone = %s AND referral_code IN "
-                    "(SELECT referral_code FROM referral_codes WHERE month_year = %s)",
-                    (frm, datetime.now().strftime('%Y-%m'))
-                )
-                points_earned = cursor.fetchone()[0] or 0
-                cursor.execute("SELECT balutedaar_points FROM users WHERE phone_number = %s", (frm,))
-                total_points = cursor.fetchone()[0] or 0
-                discount_percentage = TIERED_DISCOUNTS.get(usage_count, 0) * 100
-                status_message = f"Refer {5 - usage_count} more friends for a FREE ₹200 Veggie Box!" if usage_count < 5 else "You unlocked a FREE ₹200 Veggie Box!"
-                message = (
-                    f"🌟 Your Rewards Summary:\n"
-                    f"📊 Current Code: {code} (Used by {usage_count}/5 friends)\n"
-                    f"💰 Points This Month: ₹{points_earned}\n"
-                    f"💸 Total Points: ₹{total_points}\n"
-                    f"🎁 Your Next Order Discount: {discount_percentage}% OFF\n"
-                    f"🎁 {status_message}\n"
-                    f"👉 Type ‘Redeem’ to use points!"
-                )
-                send_message(frm, message, "rewards_summary")
-                cnx.commit()
-                cnx.close()
-                return 'Success'
-
-            if resp1 in greeting_word:
-                profile_name = response.get("contacts", [{}])[0].get("profile", {}).get("name", "").strip()
-                if result is None:
-                    if profile_name and is_valid_name(profile_name):
-                        name = profile_name
-                        cursor.execute(
-                            "INSERT INTO users (phone_number, camp_id, is_valid, name, is_main, balutedaar_points) VALUES (%s, %s, %s, %s, %s, %s)",
-                            (frm, '1', '1', name, '1', 0)
-                        )
-                        cnx.commit()
-                        send_message(frm, wl.format(name=name), 'pincode')
-                    else:
-                        cursor.execute("INSERT INTO users (phone_number, camp_id, is_valid, is_info, balutedaar_points) VALUES (%s, %s, %s, %s, %s)",
-                                      (frm, '1', '1', '1', 0))
-                        cnx.commit()
-                        send_message(frm, wl_fallback, 'welcome_message')
+        message_id, frm, msg_type, resp1 = parse_message(response)
+        if msg_type in ('text', 'interactive', 'order') and len(frm) == 12:
+            if message_id and dedupe.seen(message_id):
+                return 'Success', 200
+            with admission.admit(message_priority(frm, resp1)) as admitted:
+                if not admitted:
+                    return shed_response()
+                if INBOUND_FAST_ACK:
+                    inbox.accept(frm, response)
                 else:
-                    if name:
-                        reset_user_flags(frm, cnx, cursor)
-                        cursor.execute("UPDATE users SET is_main = '1', is_valid = '1' WHERE phone_number = %s", (frm,))
-                        cnx.commit()
-                        send_message(frm, r2.format(name=name), 'pincode')
-                    else:
-                        if profile_name and is_valid_name(profile_name):
-                            name = profile_name
-                            cursor.execute(
-                                "UPDATE users SET name = %s, is_main = %s, is_valid = %s WHERE phone_number = %s",
-                                (name, '1', '1', frm)
-                            )
-                            cnx.commit()
-                            send_message(frm, r2.format(name=name), 'pincode')
-                        else:
-                            cursor.execute("UPDATE users SET is_info = '1', is_valid = '1' WHERE phone_number = %s", (frm,))
-                            cnx.commit()
-                            send_message(frm, wl_fallback, 'welcome_message')
-            
-            if camp_id == '1':
-                if is_info == '1' and pincode is None:
-                    if is_valid_name(resp1):
-                        name = resp1
-                        cursor.execute("UPDATE users SET name = %s, is_main = %s, is_info = %s WHERE phone_number = %s",
-                                      (name, '1', '0', frm))
-                        cnx.commit()
-                        send_message(frm, r2.format(name=name), 'pincode')
-                    else:
-                        send_message(frm, invalid_name, "invalid_name")
-                
-                if is_main == '1' and pincode is None:
-                    pincode = resp1
-                    if pincode.isdigit() and len(pincode) == 6:
-                        if check_pincode(pincode):
-                            cursor.execute("UPDATE users SET pincode = %s, is_referral = %s, is_main = %s WHERE phone_number = %s",
-                                          (pincode, '1', '0', frm))
-                            cnx.commit()
-                            combo_list = get_combo_availability()
-                            send_message(frm, m1.format(combo_list=combo_list), 'combo_availability')
-                            send_referral_prompt_with_button(frm, referral_prompt, 'referral_code')
-                        else:
-                            send_message(frm, r3, 'pincode_error')
-                    else:
-                        send_message(frm, r4, 'invalid_pincode')
-                
-                if is_referral == '1':
-                    if msg_type == 'interactive' and resp1 == 'skip_button':
-                        cursor.execute("UPDATE users SET is_referral = %s, main_menu = %s WHERE phone_number = %s", ('0', '1', frm))
-                        cnx.commit()
-                        send_multi_product_message(frm, CATALOG_ID, 'menu')
-                    else:
-                        is_valid, message = validate_referral_code(resp1, frm)
-                        if is_valid:
-                            cursor.execute("UPDATE users SET referral_code = %s, is_referral = %s, main_menu = %s WHERE phone_number = %s",
-                                          (resp1, '0', '1', frm))
-                            cnx.commit()
-                            send_message(frm, referral_success, 'referral_success')
-                            send_multi_product_message(frm, CATALOG_ID, 'menu')
-                        else:
-                            send_referral_prompt_with_button(frm, invalid_referral.format(code=resp1), 'invalid_referral')
-                
-                if is_temp == '1' and address is None:
-                    if is_valid_address(resp1):
-                        address = resp1
-                        cursor.execute("UPDATE users SET address = %s, is_submenu = %s WHERE phone_number = %s", (address, '1', frm))
-                        cnx.commit()
-                        order_summary, total, item_count = get_cart_summary(frm, name, address)
-                        if item_count == 0:
-                            send_message(frm, order_summary, "no_order")
-                            send_multi_product_message(frm, CATALOG_ID, 'menu')
-                        else:
-                            order_summary += "\n\nPlease confirm your order or go back to the menu to make changes."
-                            interactive_template_with_2button(frm, order_summary, "order_summary")
-                    else:
-                        send_message(frm, invalid_address, 'invalid_address')
-                
-                elif main_menu == '1' and msg_type == 'order':
-                    if 'product_items' in response["messages"][0]["order"]:
-                        product_items = response["messages"][0]["order"]["product_items"]
-                        total_amount = 0
-                        valid_selection = False
-                        cursor.execute("DELETE FROM user_cart WHERE phone_number = %s", (frm,))
-                        cnx.commit()
-                        for item in product_items:
-                            combo_id = item.get("product_retailer_id", "").strip()
-                            quantity = int(item.get("quantity", 1))
-                            is_available, combo_name = check_inventory(combo_id, quantity)
-                            if not is_available:
-                                send_message(frm, out_of_stock.format(combo_name=combo_name), "out_of_stock")
-                                send_multi_product_message(frm, CATALOG_ID, 'menu')
-                                cnx.commit()
-                                cnx.close()
-                                return 'Success'
-                            item_price = get_combo_price(combo_id)
-                            selected_combo = get_combo_name(combo_id)
-                            if selected_combo != "Unknown Combo" and item_price > 0:
-                                total_amount += item_price * quantity
-                                valid_selection = True
-                                cursor.execute(
-                                    "INSERT INTO user_cart (phone_number, combo_id, combo_name, quantity, price) VALUES (%s, %s, %s, %s, %s)",
-                                    (frm, combo_id, selected_combo, quantity, item_price)
-                                )
-                                cnx.commit()
-                        if valid_selection:
-                            cursor.execute("UPDATE users SET is_temp = '1' WHERE phone_number = %s", (frm,))
-                            cnx.commit()
-                            send_message(frm, m3, "ask_address")
-                        else:
-                            send_multi_product_message(frm, CATALOG_ID, 'menu')
-                            send_message(frm, "Sorry, none of the selected products are available. Please choose another combo.", "illegal_combo")
-                    else:
-                        send_multi_product_message(frm, CATALOG_ID, 'menu')
-                
-                elif is_submenu == '1' and payment_method is None:
-                    if resp1 == "1":
-                        cursor.execute("UPDATE users SET is_submenu = '1' WHERE phone_number = %s", (frm,))
-                        cnx.commit()
-                        interactive_template_with_3button(frm, "💳 Please select your preferred payment method to continue:", "payment")
-                    elif resp1 == "2":
-                        reset_user_flags(frm, cnx, cursor)
-                        cursor.execute("UPDATE users SET main_menu = '1' WHERE phone_number = %s", (frm,))
-                        cnx.commit()
-                        send_multi_product_message(frm, CATALOG_ID, "menu")
-                    else:
-                        payment_method = {"3": "COD", "5": "Pay Now"}.get(resp1)
-                        if payment_method:
-                            cursor.execute("UPDATE users SET payment_method = %s WHERE phone_number = %s", (payment_method, frm))
-                            cnx.commit()
-                            cursor.execute("SELECT combo_id, combo_name, quantity, price FROM user_cart WHERE phone_number = %s", (frm,))
-                            cart_items = cursor.fetchall()
-                            if not cart_items:
-                                send_message(frm, "No order details found! Please select a combo to proceed.", "no_order")
-                                cursor.execute("UPDATE users SET payment_method = NULL WHERE phone_number = %s", (frm,))
-                                cnx.commit()
-                                cnx.close()
-                                return 'Success'
-                            
-                            total_amount = sum(float(item[3]) * item[2] for item in cart_items)
-                            items = [(item[0], item[1], float(item[3]), item[2]) for item in cart_items]
-                            discount_percentage = get_tiered_discount(frm)
-                            
-                            if payment_method == "COD":
-                                reference_id = f"q9{uuid.uuid4().hex[:8]}"
-                                checkout_result = checkout(frm, name, address, pincode, payment_method, cnx, cursor, reference_id)
-                                if checkout_result["total"] == 0:
-                                    send_message(frm, checkout_result["message"], "invalid_order")
-                                    cursor.execute("UPDATE users SET payment_method = NULL WHERE phone_number = %s", (frm,))
-                                    cnx.commit()
-                                    cnx.close()
-                                    return 'Success'
-                                
-                                cursor.execute(
-                                    "SELECT combo_id, combo_name, price, quantity, total_amount, address, referral_code "
-                                    "FROM orders WHERE user_phone = %s AND reference_id = %s AND payment_method = 'COD' AND order_status = 'Placed'",
-                                    (frm, reference_id)
-                                )
-                                items = cursor.fetchall()
-                                if not items:
-                                    send_message(frm, "Error: No order found. Please try again.", "no_order")
-                                    cursor.execute("UPDATE users SET payment_method = NULL WHERE phone_number = %s", (frm,))
-                                    cnx.commit()
-                                    cnx.close()
-                                    return 'Success'
-                                
-                                total = checkout_result["total"]
-                                new_referral_code = checkout_result["referral_code"]
-                                discount_percentage = checkout_result["discount_percentage"]
-                                confirmation = f"Dear *{name}*,\n\nThank you for your order with Balutedaar! Below is your order confirmation:\n\n📦 *Order Details*:\n"
-                                for item in items:
-                                    combo_id, combo_name, price, quantity, item_total, address, order_referral_code = item
-                                    subtotal = float(price) * quantity
-                                    confirmation += f"🛒 {combo_name} x{quantity}: ₹{subtotal:.2f}\n"
-                                if order_referral_code:
-                                    confirmation += f"🎁 Referral Discount: -₹20.00\n"
-                                if discount_percentage > 0:
-                                    confirmation += f"🎁 Tiered Discount ({int(discount_percentage * 100)}%): -₹{(item_total - total):.2f}\n"
-                                confirmation += f"\n💰 Total Amount: ₹{total:.2f}\n📍 Delivery Address: {address}\n"
-                                confirmation += f"🚚 Delivery Schedule: Your order will be delivered to your doorstep by tomorrow 9 AM.\n\n"
-                                confirmation += f"🎉 Here’s your unique referral code: {new_referral_code}\nRefer your friends to earn ₹50 per order they place!\n\n"
-                                confirmation += f"We appreciate your support for fresh, sustainable produce. If you’ve any questions, reach out!\n\nBest regards,\nThe Balutedaar Team"
-                                send_message(frm, confirmation, "order_confirmation")
-                                gamified_prompt = (
-                                    f"🎯 Mission Veggie-Star: UNLOCK REWARDS!\n"
-                                    f"Share your code *{new_referral_code}* with up to 5 friends this month and get:\n"
-                                    f"🥕 ₹50 Balutedaar Points per friend\n"
-                                    f"🥬 Friends get 10% OFF\n"
-                                    f"🎁 Refer 5 friends = FREE ₹200 Veggie Box!\n"
-                                    f"📤 Tap to Share: Tap here to get the message: https://wa.me/+917477751777?text=Use+my+code+%22{new_referral_code}%22+to+get+fresh+veggies!%0Awith+Bot+number:+917477751777%0ASend+%22Hi%22+to+Start."
-                                )
-                                send_message(frm, gamified_prompt, "gamified_prompt")
-                                cursor.execute("UPDATE users SET is_submenu = '0', payment_method = NULL WHERE phone_number = %s", (frm,))
-                                cnx.commit()
-                                cnx.close()
-                                return 'Success'
-                            elif payment_method == "Pay Now":
-                                reference_id = f"q9{uuid.uuid4().hex[:8]}"
-                                checkout_result = checkout(frm, name, address, pincode, payment_method, cnx, cursor, reference_id)
-                                if checkout_result["total"] == 0:
-                                    send_message(frm, checkout_result["message"], "invalid_order")
-                                    cursor.execute("UPDATE users SET payment_method = NULL WHERE phone_number = %s", (frm,))
-                                    cnx.commit()
-                                    cnx.close()
-                                    return 'Success'
-                                
-                                payment_url = send_payment_message(frm, name, address, pincode, items, total_amount, reference_id, referral_code, discount_percentage)
-                                if not payment_url:
-                                    send_message(frm, "Error generating payment link. Please try again.", "payment_error")
-                                    cursor.execute("UPDATE users SET payment_method = NULL WHERE phone_number = %s", (frm,))
-                                    cnx.commit()
-                                    cnx.close()
-                                    return 'Success'
-                                
-                                cursor.execute("UPDATE users SET is_submenu = '0' WHERE phone_number = %s", (frm,))
-                                cnx.commit()
-                                cnx.close()
-                                return 'Success'
-
-        cnx.commit()
-        cnx.close()
+                    inbound.submit(frm, tracer.wrap(query_budget.wrap(process_message)), message_id, frm, msg_type, resp1, response).result(INBOUND_TIMEOUT)
         return 'Success', 200
     except Exception as e:
         logging.error(f"Main handler error: {str(e)}")
-        if cnx:
-            cnx.rollback()
-            cnx.close()
         return jsonify({"error": str(e)}), 400
 
 @app.route('/payment-callback', methods=['GET'])
 def payment_callback():
+    with tracer.span("payment_callback", status=request.args.get('razorpay_payment_link_status')), \
+            query_budget.scope("payment_callback"), admission.admit(HIGH) as admitted:
+        if not admitted:
+            return ("We are busy confirming payments. Please refresh this page in a few seconds.", 503,
+                    {"Retry-After": os.getenv("ADMISSION_RETRY_AFTER", "5")})
+        return handle_payment_callback()
+
+def handle_payment_callback():
     try:
         payment_id = request.args.get('razorpay_payment_id')
         payment_link_id = request.args.get('razorpay_payment_link_id')
@@ -1199,78 +1349,165 @@ def payment_callback():
         signature = request.args.get('razorpay_signature')
 
         if payment_link_status == 'paid':
-            cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-            cursor = cnx.cursor()
-            cursor.execute(
-                "UPDATE orders SET payment_status = 'Completed', order_status = 'Confirmed' WHERE reference_id = %s",
-                (payment_link_reference_id,)
-            )
-            cursor.execute(
-                "SELECT user_phone, customer_name, address, pincode, combo_id, combo_name, price, quantity, total_amount, referral_code "
-                "FROM orders WHERE reference_id = %s",
-                (payment_link_reference_id,)
-            )
-            items = cursor.fetchall()
-            
-            if items:
-                frm = items[0][0]
-                cursor.execute("UPDATE users SET pincode = NULL WHERE phone_number = %s", (frm,))
-                new_referral_code = generate_referral_code(frm)
-                frm, name, address, pincode = items[0][0:4]
-                total = 0
-                confirmation = f"Dear *{name}*,\n\nThank you for your payment! Your order has been confirmed:\n\n📦 *Order Details*:\n"
-                referral_code = items[0][9]
-                discount_percentage = get_tiered_discount(frm)
-                for item in items:
-                    combo_name, price, quantity = item[5:8]
-                    subtotal = float(price) * quantity
-                    total += subtotal
-                    confirmation += f"🛒 {combo_name} x{quantity}: ₹{subtotal:.2f}\n"
-                if referral_code:
-                    confirmation += f"🎁 Referral Discount: -₹20.00\n"
-                    total = max(total - 20, 0)
-                if discount_percentage > 0:
-                    discount_amount = total * discount_percentage
-                    confirmation += f"🎁 Tiered Discount ({int(discount_percentage * 100)}%): -₹{discount_amount:.2f}\n"
-                    total = max(total * (1 - discount_percentage), 0)
-                confirmation += f"\n💰 Total Amount: ₹{total:.2f}\n📍 Delivery Address: {address}\n"
-                confirmation += f"🚚 Your order will be delivered by tomorrow 9 AM.\n\n"
-                confirmation += f"🎉 Here’s your unique referral code: {new_referral_code}\nRefer your friends to earn ₹50 per order they place!\n\n"
-                confirmation += "We appreciate your support for fresh, sustainable produce!\nBest regards,\nThe Balutedaar Team"
-                send_message(frm, confirmation, "payment_confirmation")
-                gamified_prompt = (
-                    f"🎯 Mission Veggie-Star: UNLOCK REWARDS!\n"
-                    f"Share your code *{new_referral_code}* with up to 5 friends this month and get:\n"
-                    f"🥕 ₹50 Balutedaar Points per friend\n"
-                    f"🥬 Friends get 10% OFF\n"
-                    f"🎁 Refer 5 friends = FREE ₹200 Veggie Box!\n"
-                    f"📤 Tap to Share: Tap here to get the message: https://wa.me/+917477751777?text=Use+my+code+%22{new_referral_code}%22+to+get+fresh+veggies!%0Awith+Bot+number:+917477751777%0ASend+%22Hi%22+to+Start."
+            with db_pool.session() as dbs:
+                cursor = dbs.cursor()
+                cursor.execute(
+                    "UPDATE orders SET payment_status = 'Completed', order_status = 'Confirmed' WHERE reference_id = %s",
+                    (payment_link_reference_id,)
                 )
-                send_message(frm, gamified_prompt, "gamified_prompt")
+                cursor.execute(
+                    "SELECT user_phone, customer_name, address, pincode, combo_id, combo_name, price, quantity, total_amount, referral_code "
+                    "FROM orders WHERE reference_id = %s",
+                    (payment_link_reference_id,)
+                )
+                items = cursor.fetchall()
             
-            cnx.commit()
-            cnx.close()
+                if items:
+                    frm = items[0][0]
+                    new_referral_code = generate_referral_code(frm)
+                    frm, name, address, pincode = items[0][0:4]
+                    total = 0
+                    confirmation = f"Dear *{name}*,\n\nThank you for your payment! Your order has been confirmed:\n\n📦 *Order Details*:\n"
+                    referral_code = items[0][9]
+                    discount_percentage = get_tiered_discount(frm)
+                    for item in items:
+                        combo_name, price, quantity = item[5:8]
+                        subtotal = float(price) * quantity
+                        total += subtotal
+                        confirmation += f"🛒 {combo_name} x{quantity}: ₹{subtotal:.2f}\n"
+                    if referral_code:
+                        confirmation += f"🎁 Referral Discount: -₹20.00\n"
+                        total = max(total - 20, 0)
+                    if discount_percentage > 0:
+                        discount_amount = total * discount_percentage
+                        confirmation += f"🎁 Tiered Discount ({int(discount_percentage * 100)}%): -₹{discount_amount:.2f}\n"
+                        total = max(total * (1 - discount_percentage), 0)
+                    confirmation += f"\n💰 Total Amount: ₹{total:.2f}\n📍 Delivery Address: {address}\n"
+                    confirmation += f"🚚 Your order will be delivered by tomorrow 9 AM.\n\n"
+                    confirmation += f"🎉 Here’s your unique referral code: {new_referral_code}\nRefer your friends to earn ₹50 per order they place!\n\n"
+                    confirmation += "We appreciate your support for fresh, sustainable produce!\nBest regards,\nThe Balutedaar Team"
+                    send_message(frm, confirmation, "payment_confirmation")
+                    gamified_prompt = (
+                        f"🎯 Mission Veggie-Star: UNLOCK REWARDS!\n"
+                        f"Share your code *{new_referral_code}* with up to 5 friends this month and get:\n"
+                        f"🥕 ₹50 Balutedaar Points per friend\n"
+                        f"🥬 Friends get 10% OFF\n"
+                        f"🎁 Refer 5 friends = FREE ₹200 Veggie Box!\n"
+                        f"📤 Tap to Share: Tap here to get the message: https://wa.me/+917477751777?text=Use+my+code+%22{new_referral_code}%22+to+get+fresh+veggies!%0Awith+Bot+number:+917477751777%0ASend+%22Hi%22+to+Start."
+                    )
+                    send_message(frm, gamified_prompt, "gamified_prompt")
             return "Payment successful! Your order is confirmed." if items else ("Error: Order not found", 400)
         else:
-            cnx = pymysql.connect(user=usr, password=pas, host=aws_host, database=db)
-            cursor = cnx.cursor()
-            cursor.execute(
-                "SELECT user_phone, customer_name FROM orders WHERE reference_id = %s",
-                (payment_link_reference_id,)
-            )
-            result = cursor.fetchone()
-            cnx.close()
+            with db_pool.session() as dbs:
+                cursor = dbs.cursor()
+                cursor.execute(
+                    "SELECT user_phone, customer_name FROM orders WHERE reference_id = %s",
+                    (payment_link_reference_id,)
+                )
+                result = cursor.fetchone()
             if result:
                 frm, name = result
                 send_message(frm, f"Dear *{name}*, your payment was not completed. Please try again.", "payment_failed")
             return "Payment failed or cancelled. Please try again."
     except Exception as e:
         logging.error(f"Payment callback error: {str(e)}")
-        if 'cnx' in locals():
-            cnx.rollback()
-            cnx.close()
         return jsonify({"error": str(e)}), 500
 
+_worker_lock = threading.Lock()
+_worker_pid = None
+_shutdown_done = False
+startup_stats = {}
+
+def check_env():
+    missing = [var for var in required_env if not os.getenv(var)]
+    if missing:
+        raise RuntimeError(f"Missing environment variables: {', '.join(missing)}")
+
+def init_worker():
+    """Start this process's background workers and warm its caches.
+
+    Runs once per process, after any fork: from gunicorn's post_fork hook
+    in production, or lazily on the first request under the dev server.
+    """
+    global _worker_pid, _shutdown_done
+    if _worker_pid == os.getpid():
+        return
+    with _worker_lock:
+        if _worker_pid == os.getpid():
+            return
+        started = time.perf_counter()
+        log_writer.start()
+        status_writer.start()
+        outbound.start()
+        inbound.start()
+        if INBOUND_FAST_ACK:
+            inbox.start()
+        dedupe.start()
+        try:
+            db_pool.warm(int(os.getenv("MYSQL_POOL_WARM", "2")))
+        except Exception as e:
+            logging.error(f"Failed to warm MySQL pool: {e}")
+        pincode_index.start()
+        catalog.snapshot()
+        _shutdown_done = False
+        _worker_pid = os.getpid()
+        atexit.register(shutdown)
+        startup_stats["pid"] = _worker_pid
+        startup_stats["init_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        logging.info(f"Worker {_worker_pid} ready in {startup_stats['init_ms']} ms")
+
+def shutdown(timeout=10.0):
+    """Drain in dependency order: inbound work first, then the messages and log rows it produced."""
+    global _shutdown_done
+    with _worker_lock:
+        if _shutdown_done or _worker_pid != os.getpid():
+            return
+        _shutdown_done = True
+        inbox.stop()
+        if inbound.stop(timeout):
+            inbox.close()
+        else:
+            logging.warning("Inbound workers still running; leaving the inbox open for them")
+        outbound.stop(timeout)
+        log_writer.stop(timeout)
+        status_writer.stop(timeout)
+        dedupe.stop()
+        pincode_index.stop()
+        rml_client.close()
+        db_pool.close_all()
+        logging.info(f"Worker {os.getpid()} shut down")
+
+@app.before_request
+def ensure_worker():
+    init_worker()
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        request_seconds.observe(time.perf_counter() - started, request.endpoint or 'unmatched', str(response.status_code))
+    return response
+
+registry.register_stats("db_pool", db_pool.stats)
+registry.register_stats("outbound", outbound.stats)
+registry.register_stats("inbound", inbound.stats)
+registry.register_stats("inbox", lambda: inbox.stats() if INBOUND_FAST_ACK else {})
+registry.register_stats("tbl_logs", log_writer.stats)
+registry.register_stats("tbl_logs_status", status_writer.stats)
+registry.register_stats("dedupe", dedupe.stats)
+registry.register_stats("admission", admission.stats)
+registry.register_stats("conversation_cache", conversations.cache.stats)
+registry.register_stats("rewards_cache", rewards_cache.stats)
+registry.register_stats("pincodes", pincode_index.stats)
+registry.register_stats("worker", lambda: startup_stats)
+registry.register_stats("tracing", tracer.stats)
+registry.register_stats("query_budget", query_budget.stats)
+
+def create_app():
+    """Validate configuration and return the WSGI app. See wsgi.py and gunicorn.conf.py."""
+    check_env()
+    return app
+
 if __name__ == '__main__':
-    app.debug = True
-    app.run(host='0.0.0.0', port=5000)
+    create_app().run(host='0.0.0.0', port=5000, debug=os.getenv("FLASK_DEBUG", "0") == "1")
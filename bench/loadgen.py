@@ -0,0 +1,364 @@
+"""End-to-end load generator for the WhatsApp ordering funnel.
+
+    python -m bench.loadgen --users 200 --rounds 2 --think 1.5
+    python -m bench.loadgen --target http://127.0.0.1:5000 --users 500
+
+Each simulated user walks the whole funnel through the webhook with
+provider-shaped JSON and random think times between steps:
+
+    greeting -> name -> pincode -> referral (skip or code) -> catalog order
+    -> address -> confirm ("1") -> COD ("3") or Pay Now ("5") + payment callback
+
+By default the app is served in-process on a threaded werkzeug server,
+wired to bench/stubs.py for rmlconnect and Razorpay, against a freshly
+seeded BENCH_MYSQL_* database (see bench/seed.py). With --target the app
+is already running elsewhere; start it with RML_BASE_URL and
+RAZORPAY_BASE_URL pointing at ``python -m bench.stubs`` and MYSQL_* at the
+seeded database, which the generator reads directly.
+
+The report gives throughput, per-step latency percentiles, error and shed
+(503) rates, and the anomalies that matter before a promotion: oversold
+stock, stock that moved without a matching order, duplicate order lines,
+more orders than finished funnels, and paid links left unconfirmed.
+"""
+import argparse
+import json
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pymysql
+import requests
+
+from bench import seed
+from bench.run import configure, git_commit, summarize
+from bench.stubs import StubServer
+
+FIRST_NAMES = ["Rushikesh", "Priya", "Amit", "Sneha", "Rahul", "Anjali", "Vikram", "Pooja", "अमित", "स्नेहा"]
+STREETS = ["Baner Road", "Aundh Road", "Pashan Sus Road", "Balewadi High Street", "Mahalunge Lane"]
+STEPS = ["greeting", "name", "pincode", "referral", "order", "address", "confirm", "payment_method", "payment_callback"]
+
+
+class Recorder:
+    """Thread-safe per-step latency samples and outcome counters."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.counts = {}
+
+    def record(self, step, seconds, outcome):
+        with self.lock:
+            if outcome == 'ok':
+                self.samples.setdefault(step, []).append(seconds)
+            counts = self.counts.setdefault(step, {"ok": 0, "error": 0, "shed": 0})
+            counts[outcome] += 1
+
+    def report(self):
+        steps = {}
+        for step in STEPS:
+            counts = self.counts.get(step)
+            if not counts:
+                continue
+            total = sum(counts.values())
+            stats = summarize(self.samples[step]) if self.samples.get(step) else {}
+            stats.update(counts, requests=total,
+                         error_rate=round(counts["error"] / total, 4), shed_rate=round(counts["shed"] / total, 4))
+            steps[step] = stats
+        return steps
+
+
+class Database:
+    """Direct reads against the app's database, one autocommit connection per thread."""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.local = threading.local()
+
+    def query(self, sql, args=()):
+        cnx = getattr(self.local, 'cnx', None)
+        if cnx is None:
+            cnx = self.local.cnx = pymysql.connect(charset='utf8mb4', autocommit=True, **self.settings)
+        with cnx.cursor() as cursor:
+            cursor.execute(sql, args)
+            return cursor.fetchall()
+
+
+class VirtualUser:
+    def __init__(self, index, target, db, recorder, rng, args, codes):
+        self.phone = f"91{8000000000 + index}"
+        self.target = target
+        self.db = db
+        self.recorder = recorder
+        self.rng = rng
+        self.args = args
+        self.codes = codes
+        self.http = requests.Session()
+        self.funnels = 0
+        self.checkouts = 0
+        self.earlier = set()
+        self.references = set()
+        self.paid = []
+
+    def envelope(self, message, profile_name=None):
+        message.update({"from": self.phone, "id": f"wamid.{uuid.uuid4().hex}", "timestamp": str(int(time.time()))})
+        return {
+            "contacts": [{"profile": {"name": profile_name or ""}, "wa_id": self.phone}],
+            "messages": [message],
+        }
+
+    def text(self, body, profile_name=None):
+        return self.envelope({"type": "text", "text": {"body": body}}, profile_name)
+
+    def reply(self, row_id, title):
+        return self.envelope({"type": "interactive",
+                              "interactive": {"type": "list_reply", "list_reply": {"id": row_id, "title": title}}})
+
+    def order(self):
+        combos = self.rng.sample(seed.COMBOS, self.rng.randint(1, 3))
+        return self.envelope({"type": "order", "order": {
+            "catalog_id": "1221166119417288",
+            "product_items": [{"product_retailer_id": combo_id, "quantity": str(self.rng.randint(1, 2)),
+                               "item_price": str(price), "currency": "INR"} for combo_id, _, price in combos],
+        }})
+
+    def think(self):
+        if self.args.think > 0:
+            time.sleep(self.rng.expovariate(1.0 / self.args.think))
+
+    def send(self, step, method, path, **kwargs):
+        """One request, retried after Retry-After while the app sheds load. Returns True on success."""
+        for attempt in range(self.args.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                response = self.http.request(method, self.target + path, timeout=self.args.timeout, **kwargs)
+            except requests.RequestException:
+                self.recorder.record(step, time.perf_counter() - started, 'error')
+                return False
+            elapsed = time.perf_counter() - started
+            if response.status_code == 503:
+                self.recorder.record(step, elapsed, 'shed')
+                retry_after = float(response.headers.get("Retry-After") or 1)
+                time.sleep(min(retry_after, self.args.retry_cap))
+                continue
+            ok = response.status_code == 200
+            self.recorder.record(step, elapsed, 'ok' if ok else 'error')
+            return ok
+        return False
+
+    def post(self, step, payload):
+        ok = self.send(step, "POST", "/", json=payload)
+        self.think()
+        return ok
+
+    def new_reference(self):
+        """The reference_id of the order this funnel just placed, polling while the app catches up."""
+        deadline = time.monotonic() + self.args.settle
+        while True:
+            rows = self.db.query("SELECT DISTINCT reference_id FROM orders WHERE user_phone = %s", (self.phone,))
+            fresh = {row[0] for row in rows} - self.references - self.earlier
+            if fresh or time.monotonic() >= deadline:
+                self.references |= fresh
+                return fresh.pop() if fresh else None
+            time.sleep(0.2)
+
+    def funnel(self):
+        named = self.rng.random() < self.args.named
+        name = f"{self.rng.choice(FIRST_NAMES)} {self.phone[-4:]}"
+        self.post("greeting", self.text(self.rng.choice(["Hi", "hi", "Hello", "Hii"]), name if named else None))
+        if not named and not self.checkouts:
+            # Returning users are greeted by the name they gave on their first visit.
+            self.post("name", self.text(name))
+        self.post("pincode", self.text(self.rng.choice(seed.SERVICEABLE)))
+        if self.codes and self.rng.random() < self.args.referral_rate:
+            self.post("referral", self.text(self.rng.choice(self.codes)))
+        else:
+            self.post("referral", self.reply("skip_button", "Skip"))
+        self.post("order", self.order())
+        address = f"Flat {self.rng.randint(1, 900)}, {self.rng.choice(STREETS)}, Pune"
+        self.post("address", self.text(address))
+        self.post("confirm", self.reply("1", "Confirm"))
+        pay_now = self.rng.random() < self.args.pay_now
+        self.checkouts += 1
+        self.post("payment_method", self.reply("5", "Pay Now") if pay_now else self.reply("3", "COD"))
+        reference_id = self.new_reference()
+        if reference_id is None:
+            return False
+        if pay_now:
+            params = {
+                "razorpay_payment_id": f"pay_{uuid.uuid4().hex[:14]}",
+                "razorpay_payment_link_id": f"plink_{uuid.uuid4().hex[:14]}",
+                "razorpay_payment_link_reference_id": reference_id,
+                "razorpay_payment_link_status": "paid",
+                "razorpay_signature": uuid.uuid4().hex,
+            }
+            if self.send("payment_callback", "GET", "/payment-callback", params=params):
+                self.paid.append(reference_id)
+        self.funnels += 1
+        return True
+
+    def run(self, start_delay):
+        # Orders left by an earlier run against the same database are not this run's.
+        self.earlier = {row[0] for row in self.db.query(
+            "SELECT DISTINCT reference_id FROM orders WHERE user_phone = %s", (self.phone,))}
+        time.sleep(start_delay)
+        for _ in range(self.args.rounds):
+            self.funnel()
+        return self
+
+
+def snapshot(db):
+    inventory = {combo_id: (total, booked) for combo_id, total, booked in
+                 db.query("SELECT combo_id, total_boxes, booked FROM combo_inventory")}
+    last_order_id = db.query("SELECT COALESCE(MAX(order_id), 0) FROM orders")[0][0]
+    return inventory, last_order_id
+
+
+def anomalies(db, before, users):
+    inventory_before, last_order_id = before
+    inventory_after, _ = snapshot(db)
+    ordered = {combo_id: int(quantity) for combo_id, quantity in db.query(
+        "SELECT combo_id, SUM(quantity) FROM orders WHERE order_id > %s GROUP BY combo_id", (last_order_id,))}
+    oversold = sorted(combo_id for combo_id, (total, _) in inventory_after.items() if total < 0)
+    stock_mismatch = {}
+    for combo_id, (_, booked) in inventory_after.items():
+        moved = booked - inventory_before.get(combo_id, (0, 0))[1]
+        if moved != ordered.get(combo_id, 0):
+            stock_mismatch[combo_id] = {"booked": moved, "ordered": ordered.get(combo_id, 0)}
+    duplicate_lines = [
+        {"reference_id": reference_id, "combo_id": combo_id, "rows": rows}
+        for reference_id, combo_id, rows in db.query(
+            "SELECT reference_id, combo_id, COUNT(*) FROM orders WHERE order_id > %s "
+            "GROUP BY reference_id, combo_id HAVING COUNT(*) > 1", (last_order_id,))
+    ]
+    extra_orders = {user.phone: {"checkouts": user.checkouts, "orders": len(user.references)}
+                    for user in users if len(user.references) > user.checkouts}
+    unconfirmed = []
+    for user in users:
+        for reference_id in user.paid:
+            rows = db.query("SELECT COUNT(*) FROM orders WHERE reference_id = %s AND payment_status <> 'Completed'",
+                            (reference_id,))
+            if rows[0][0]:
+                unconfirmed.append(reference_id)
+    return {
+        "oversold": oversold,
+        "stock_mismatch": stock_mismatch,
+        "duplicate_order_lines": duplicate_lines,
+        "extra_orders": extra_orders,
+        "unconfirmed_payments": unconfirmed,
+    }
+
+
+def serve_in_process(port):
+    import app
+    from werkzeug.serving import make_server
+    app.init_worker()
+    server = make_server('127.0.0.1', port, app.create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, name="loadgen-app", daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, app, f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", help="base URL of an already running app; default serves it in-process")
+    parser.add_argument("--users", type=int, default=100, help="concurrent simulated users")
+    parser.add_argument("--rounds", type=int, default=1, help="funnels walked by each user")
+    parser.add_argument("--think", type=float, default=1.0, help="mean think time between steps, seconds")
+    parser.add_argument("--ramp", type=float, default=10.0, help="seconds over which users start")
+    parser.add_argument("--named", type=float, default=0.7, help="share of users with a WhatsApp profile name")
+    parser.add_argument("--referral-rate", type=float, default=0.2, help="share of funnels entering a referral code")
+    parser.add_argument("--pay-now", type=float, default=0.5, help="share of checkouts paying online")
+    parser.add_argument("--stock", type=int, default=100000, help="boxes per combo when seeding")
+    parser.add_argument("--stub-latency", type=float, default=0.05, help="seconds added by the provider stubs")
+    parser.add_argument("--timeout", type=float, default=35.0)
+    parser.add_argument("--max-retries", type=int, default=3, help="retries of a shed (503) request")
+    parser.add_argument("--retry-cap", type=float, default=2.0, help="longest Retry-After to honour, seconds")
+    parser.add_argument("--settle", type=float, default=10.0, help="seconds to wait for an order to appear")
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--output", default="loadgen_results.json")
+    args = parser.parse_args()
+
+    stub = server = app = None
+    if args.target:
+        target = args.target.rstrip('/')
+        sizes = None
+    else:
+        stub = StubServer(latency=args.stub_latency).start()
+        configure(stub, tempfile.mkdtemp(prefix="balutedaar-loadgen-"))
+        sizes = seed.prepare(stock=args.stock)
+        server, app, target = serve_in_process(0)
+
+    db = Database(seed.mysql_settings())
+    month_year = datetime.now().strftime('%Y-%m')
+    codes = [row[0] for row in db.query(
+        "SELECT referral_code FROM referral_codes WHERE month_year = %s AND is_active = %s AND usage_count < 4",
+        (month_year, True))]
+    before = snapshot(db)
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    users = [VirtualUser(i, target, db, recorder, random.Random(rng.random()), args, codes)
+             for i in range(args.users)]
+
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.users, thread_name_prefix="vu") as pool:
+            futures = [pool.submit(user.run, args.ramp * i / max(args.users, 1)) for i, user in enumerate(users)]
+            for future in futures:
+                future.result()
+        wall = time.perf_counter() - started
+        found = anomalies(db, before, users)
+    finally:
+        if server is not None:
+            server.shutdown()
+            app.shutdown()
+        if stub is not None:
+            stub.stop()
+
+    steps = recorder.report()
+    requests_total = sum(step["requests"] for step in steps.values())
+    errors_total = sum(step["error"] for step in steps.values())
+    funnels = sum(user.funnels for user in users)
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "commit": git_commit(),
+            "target": args.target or "in-process",
+            "users": args.users,
+            "rounds": args.rounds,
+            "think": args.think,
+            "sizes": sizes,
+        },
+        "throughput": {
+            "wall_seconds": round(wall, 2),
+            "requests_per_sec": round(requests_total / wall, 2),
+            "funnels_completed": funnels,
+            "funnels_per_sec": round(funnels / wall, 3),
+            "funnels_incomplete": args.users * args.rounds - funnels,
+            "error_rate": round(errors_total / requests_total, 4) if requests_total else 0,
+        },
+        "steps": steps,
+        "anomalies": found,
+        "stub_messages": stub.sent_by_type() if stub is not None else None,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print(f"{requests_total} requests in {wall:.1f}s ({report['throughput']['requests_per_sec']} req/s), "
+          f"{funnels} funnels completed, {report['throughput']['funnels_incomplete']} incomplete")
+    for step, stats in steps.items():
+        print(f"{step:17} n={stats['requests']:6}  p50 {stats.get('p50_ms', 0):8.1f}  p95 {stats.get('p95_ms', 0):8.1f}  "
+              f"p99 {stats.get('p99_ms', 0):8.1f} ms  errors {stats['error_rate']:.2%}  shed {stats['shed_rate']:.2%}")
+    flagged = {name: value for name, value in found.items() if value}
+    for name, value in flagged.items():
+        print(f"ANOMALY {name}: {json.dumps(value, ensure_ascii=False)[:500]}")
+    return 1 if flagged else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
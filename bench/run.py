@@ -0,0 +1,245 @@
+"""Micro-benchmarks for the hot helpers in app.py.
+
+    python -m bench.run --users 5000 --orders 50000 --iterations 2000
+    python -m bench.run --compare bench_results.json --max-regression 0.25
+
+Runs offline: MySQL is a local MySQL-compatible server (see bench/seed.py
+for the BENCH_MYSQL_* settings; the database is recreated on every run)
+and rmlconnect / Razorpay are answered by bench/stubs.py. Each case is
+timed per call with perf_counter and summarised as min/mean/p50/p95/p99
+in milliseconds plus calls per second. Results are written as JSON to
+--output; with --compare, any case whose p50 grew by more than
+--max-regression over the baseline file is reported and the exit status
+is 1, so the run can gate a change in CI. The catalog-order and checkout
+steps are also run under app.query_budget.assert_within with the
+QUERY_BUDGETS below; going over a budget fails the run the same way.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from bench import seed
+from bench.stubs import StubServer
+
+NAMES = ["Rushikesh", "Priya Patil", "अमित", "sneha_k", "hi", "Rahul@Baner", "Anil Kumar 2", "okay!"]
+ADDRESSES = [
+    "Flat 12, Baner Road, Pune",
+    "Plot 7 Sector 4",
+    "B-204 Sai Krupa Society, Aundh, Pune 411007",
+    "House no 5",
+    "near the temple",
+    "Tower 3, Apartment 1102, Hinjewadi Phase 1",
+]
+
+# MySQL round trips and connection checkouts allowed per funnel step,
+# counting SAVEPOINT/RELEASE and named-lock statements. Raise these
+# deliberately, in the same change that needs the extra queries.
+QUERY_BUDGETS = {
+    # DELETE the old cart, one stock check, one multi-row INSERT.
+    "order": {"max_queries": 3, "max_connections": 1},
+    # User and cart reads, one conditional stock UPDATE per cart line (up to
+    # 3, hence the allowed repeats), the order INSERT, discount, cart DELETE,
+    # the new code and its summary row, plus SAVEPOINT/RELEASE for checkout
+    # and for the stock reservation.
+    "checkout": {"max_queries": 14, "max_connections": 1, "allow_n_plus_one": True},
+}
+
+
+def configure(stub, workdir):
+    settings = seed.mysql_settings()
+    os.environ.update({
+        "MYSQL_HOST": settings["host"],
+        "MYSQL_PORT": str(settings["port"]),
+        "MYSQL_USER": settings["user"],
+        "MYSQL_PASSWORD": settings["password"],
+        "MYSQL_DB": settings["database"],
+        "AUTH_KEY": "bench",
+        "RAZORPAY_KEY_ID": "rzp_test_bench",
+        "RAZORPAY_KEY_SECRET": "bench",
+        "RML_BASE_URL": stub.url,
+        "RAZORPAY_BASE_URL": f"{stub.url}/v1",
+        "OUTBOUND_SPOOL_PATH": os.path.join(workdir, "outbox.db"),
+        "LOG_SPOOL_PATH": os.path.join(workdir, "tbl_logs.spool"),
+        "STATUS_SPOOL_PATH": os.path.join(workdir, "tbl_logs_status.spool"),
+        "INBOX_PATH": os.path.join(workdir, "inbox.db"),
+    })
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    n = len(samples)
+
+    def pct(p):
+        return samples[min(n - 1, int(round(p / 100.0 * (n - 1))))] * 1000
+
+    total = sum(samples)
+    return {
+        "calls": n,
+        "min_ms": round(samples[0] * 1000, 4),
+        "mean_ms": round(total / n * 1000, 4),
+        "p50_ms": round(pct(50), 4),
+        "p95_ms": round(pct(95), 4),
+        "p99_ms": round(pct(99), 4),
+        "ops_per_sec": round(n / total, 1) if total else None,
+    }
+
+
+def measure(fn, args_for, iterations, setup=None):
+    """Time ``fn(*args_for(i))`` ``iterations`` times; ``setup(i)`` runs untimed before each call."""
+    samples = []
+    for i in range(iterations):
+        if setup is not None:
+            setup(i)
+        args = args_for(i)
+        started = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def fetch(app, sql, args=()):
+    with app.db_pool.session() as dbs:
+        cursor = dbs.cursor()
+        cursor.execute(sql, args)
+        return cursor.fetchall()
+
+
+def cases(app, rng, iterations):
+    month_year = datetime.now().strftime('%Y-%m')
+    phones = [row[0] for row in fetch(app, "SELECT phone_number FROM users")]
+    cart_phones = [row[0] for row in fetch(app, "SELECT DISTINCT phone_number FROM user_cart")] or phones[:1]
+    codes = [row[0] for row in fetch(
+        app, "SELECT referral_code FROM referral_codes WHERE month_year = %s AND is_active = %s", (month_year, True))]
+    combo_ids = list(app.FALLBACK_COMBOS)
+    pincodes = app.SUPPORTED_PINCODES + ["411001", "560001", "abcdef"]
+    buyers = phones[-max(1, min(len(phones) // 10, iterations)):]
+
+    def cart_for(i):
+        lines = [(combo_id, rng.randint(1, 2)) for combo_id in rng.sample(combo_ids, rng.randint(1, 3))]
+        app.build_cart(buyers[i % len(buyers)], lines)
+
+    return [
+        ("is_valid_name", app.is_valid_name, lambda i: (NAMES[i % len(NAMES)],), None),
+        ("is_valid_address", app.is_valid_address, lambda i: (ADDRESSES[i % len(ADDRESSES)],), None),
+        ("check_pincode", app.check_pincode, lambda i: (pincodes[i % len(pincodes)],), None),
+        ("get_combo_name", app.get_combo_name, lambda i: (combo_ids[i % len(combo_ids)],), None),
+        ("get_combo_price", app.get_combo_price, lambda i: (combo_ids[i % len(combo_ids)],), None),
+        ("get_combo_availability", app.get_combo_availability, lambda i: (), None),
+        ("get_tiered_discount", app.get_tiered_discount, lambda i: (rng.choice(phones),), None),
+        ("validate_referral_code", app.validate_referral_code,
+         lambda i: (rng.choice(codes) if codes else "NOCODE", rng.choice(phones)), None),
+        ("get_cart_summary", app.get_cart_summary, lambda i: (cart_phones[i % len(cart_phones)], "Bench"), None),
+        ("checkout", app.checkout,
+         lambda i: (buyers[i % len(buyers)], "Bench", "Flat 1, Baner Road, Pune", "411038", "COD"), cart_for),
+    ]
+
+
+def check_budgets(app, rng, buyers, combo_ids, rounds=50):
+    """Run the catalog-order and checkout steps under their QUERY_BUDGETS; returns the failures."""
+    failures = {}
+    for i in range(rounds):
+        phone = buyers[i % len(buyers)]
+        lines = [(combo_id, 1) for combo_id in rng.sample(combo_ids, rng.randint(1, 3))]
+        steps = (
+            ("order", app.build_cart, (phone, lines)),
+            ("checkout", app.checkout, (phone, "Bench", "Flat 1, Baner Road, Pune", "411038", "COD")),
+        )
+        for step, fn, args in steps:
+            # Let the catalog run its periodic catalog_version check now, outside the measured scope.
+            app.catalog.snapshot()
+            try:
+                with app.query_budget.assert_within(**QUERY_BUDGETS[step]):
+                    fn(*args)
+            except AssertionError as e:
+                failures.setdefault(step, str(e))
+    return failures
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, max_regression):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)["cases"]
+    regressions = []
+    for name, stats in results.items():
+        before = baseline.get(name)
+        if not before or not before.get("p50_ms"):
+            continue
+        change = stats["p50_ms"] / before["p50_ms"] - 1
+        stats["p50_change"] = round(change, 3)
+        if change > max_regression:
+            regressions.append((name, before["p50_ms"], stats["p50_ms"], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--orders", type=int, default=50000)
+    parser.add_argument("--referrals", type=int, default=20000)
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="baseline results file to check for regressions")
+    parser.add_argument("--max-regression", type=float, default=0.25,
+                        help="allowed p50 growth over the baseline, as a fraction")
+    args = parser.parse_args()
+
+    stub = StubServer().start()
+    workdir = tempfile.mkdtemp(prefix="balutedaar-bench-")
+    configure(stub, workdir)
+    sizes = seed.prepare(users=args.users, orders=args.orders, referrals=args.referrals)
+
+    import app
+    app.init_worker()
+    rng = random.Random(args.seed)
+    results = {}
+    try:
+        for name, fn, args_for, setup in cases(app, rng, args.iterations):
+            results[name] = measure(fn, args_for, args.iterations, setup)
+            print(f"{name:24} p50 {results[name]['p50_ms']:9.3f} ms  p99 {results[name]['p99_ms']:9.3f} ms  "
+                  f"{results[name]['ops_per_sec']} ops/s")
+        phones = [row[0] for row in fetch(app, "SELECT phone_number FROM users LIMIT 100")]
+        over_budget = check_budgets(app, rng, phones, list(app.FALLBACK_COMBOS))
+    finally:
+        app.shutdown()
+        stub.stop()
+
+    regressions = compare(results, args.compare, args.max_regression) if args.compare else []
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "iterations": args.iterations,
+            "sizes": sizes,
+            "baseline": args.compare,
+        },
+        "cases": results,
+        "regressions": [name for name, *_ in regressions],
+        "query_budgets": QUERY_BUDGETS,
+        "over_budget": over_budget,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    for name, before, after, change in regressions:
+        print(f"REGRESSION {name}: p50 {before:.3f} ms -> {after:.3f} ms (+{change:.0%})")
+    for step, problem in over_budget.items():
+        print(f"OVER BUDGET {step}: {problem}")
+    return 1 if regressions or over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
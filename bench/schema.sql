@@ -0,0 +1,117 @@
+-- Baseline tables for the local benchmark and load-test database, written
+-- from the queries in app.py. bench/seed.py loads this, inserts fixture
+-- data and then applies migrations/*.sql in order, exactly as production
+-- was migrated. This is not the production DDL; keep it in step with the
+-- columns app.py reads and writes.
+CREATE TABLE users (
+    phone_number VARCHAR(20) NOT NULL PRIMARY KEY,
+    camp_id VARCHAR(4) NULL,
+    is_valid VARCHAR(4) NULL,
+    name VARCHAR(100) NULL,
+    pincode VARCHAR(10) NULL,
+    selected_combo VARCHAR(50) NULL,
+    quantity INT NULL,
+    address VARCHAR(255) NULL,
+    payment_method VARCHAR(20) NULL,
+    order_amount DECIMAL(10, 2) NULL,
+    is_info CHAR(1) NOT NULL DEFAULT '0',
+    main_menu CHAR(1) NOT NULL DEFAULT '0',
+    is_main CHAR(1) NOT NULL DEFAULT '0',
+    is_temp CHAR(1) NOT NULL DEFAULT '0',
+    sub_menu CHAR(1) NOT NULL DEFAULT '0',
+    is_submenu CHAR(1) NOT NULL DEFAULT '0',
+    combo_id VARCHAR(50) NULL,
+    is_referral CHAR(1) NOT NULL DEFAULT '0',
+    referral_code VARCHAR(10) NULL,
+    balutedaar_points INT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE combos (
+    combo_id VARCHAR(50) NOT NULL PRIMARY KEY,
+    combo_name VARCHAR(100) NOT NULL,
+    price DECIMAL(10, 2) NOT NULL
+);
+
+CREATE TABLE combo_inventory (
+    combo_id VARCHAR(50) NOT NULL PRIMARY KEY,
+    combo_name VARCHAR(100) NOT NULL,
+    total_boxes INT NOT NULL DEFAULT 0,
+    booked INT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE pincodes (
+    pincode VARCHAR(10) NOT NULL PRIMARY KEY
+);
+
+CREATE TABLE user_cart (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    phone_number VARCHAR(20) NOT NULL,
+    combo_id VARCHAR(50) NOT NULL,
+    combo_name VARCHAR(100) NOT NULL,
+    quantity INT NOT NULL,
+    price DECIMAL(10, 2) NOT NULL,
+    KEY idx_user_cart_phone (phone_number)
+);
+
+CREATE TABLE orders (
+    order_id INT AUTO_INCREMENT PRIMARY KEY,
+    user_phone VARCHAR(20) NOT NULL,
+    customer_name VARCHAR(100) NULL,
+    combo_id VARCHAR(50) NOT NULL,
+    combo_name VARCHAR(100) NOT NULL,
+    price DECIMAL(10, 2) NOT NULL,
+    quantity INT NOT NULL,
+    total_amount DECIMAL(10, 2) NOT NULL,
+    address VARCHAR(255) NULL,
+    pincode VARCHAR(10) NULL,
+    payment_method VARCHAR(20) NULL,
+    payment_status VARCHAR(20) NULL,
+    order_status VARCHAR(20) NULL,
+    reference_id VARCHAR(40) NULL,
+    referral_code VARCHAR(10) NULL,
+    delivery_date DATE NULL,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    KEY idx_orders_user_phone (user_phone),
+    KEY idx_orders_reference_id (reference_id)
+);
+
+CREATE TABLE referral_codes (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_phone VARCHAR(20) NOT NULL,
+    referral_code VARCHAR(10) NOT NULL,
+    month_year CHAR(7) NOT NULL,
+    usage_count INT NOT NULL DEFAULT 0,
+    is_active BOOLEAN NOT NULL DEFAULT TRUE,
+    created_at DATETIME NOT NULL,
+    KEY idx_referral_codes_user (user_phone, month_year)
+);
+
+CREATE TABLE referral_rewards (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_phone VARCHAR(20) NOT NULL,
+    referral_code VARCHAR(10) NOT NULL,
+    friend_phone VARCHAR(20) NOT NULL,
+    points_earned INT NOT NULL,
+    order_id INT NULL,
+    created_at DATETIME NOT NULL,
+    KEY idx_referral_rewards_code_friend (referral_code, friend_phone),
+    KEY idx_referral_rewards_user (user_phone)
+);
+
+CREATE TABLE rewards (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_phone VARCHAR(20) NOT NULL,
+    reward_type VARCHAR(50) NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    created_at DATETIME NOT NULL,
+    KEY idx_rewards_user (user_phone)
+);
+
+CREATE TABLE tbl_logs (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    sender_id VARCHAR(20) NULL,
+    timestamp1 VARCHAR(40) NULL,
+    message_id VARCHAR(128) NULL,
+    status VARCHAR(10) NULL,
+    messagebody VARCHAR(100) NULL
+);
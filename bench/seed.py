@@ -0,0 +1,181 @@
+"""Create and fill the local benchmark database.
+
+    python -m bench.seed --users 5000 --orders 50000 --referrals 20000
+
+Talks to any MySQL-compatible server given by BENCH_MYSQL_HOST / _PORT /
+_USER / _PASSWORD (default root:bench@127.0.0.1:3306, e.g. a throwaway
+``docker run --rm -p 3306:3306 -e MARIADB_ROOT_PASSWORD=bench mariadb``).
+The BENCH_MYSQL_DB database (default balutedaar_bench) is dropped and
+recreated from bench/schema.sql, seeded, and then brought up to date with
+migrations/*.sql so the backfills build the projections from the fixtures.
+"""
+import argparse
+import glob
+import os
+import random
+import string
+from datetime import datetime, timedelta
+
+import pymysql
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+COMBOS = [
+    ("D-9011", "Amaranth Combo", 225.00),
+    ("A-9011", "Methi Combo", 180.00),
+    ("E-9011", "Dill Combo", 111.00),
+    ("B-9011", "Kanda Paat Combo", 150.00),
+    ("C-9011", "Palak Combo", 210.00),
+    ("xzwqdyrcl9", "Spinach - पालक", 400.00),
+    ("7e8sbb1xg8", "Fenugreek - मेथी", 370.00),
+    ("dm4ngkc9xr", "Amaranth - लाल माठ", 380.00),
+]
+SERVICEABLE = ["411038", "411052", "411058", "411041"]
+BATCH = 1000
+
+
+def mysql_settings():
+    return {
+        "host": os.getenv("BENCH_MYSQL_HOST", "127.0.0.1"),
+        "port": int(os.getenv("BENCH_MYSQL_PORT", "3306")),
+        "user": os.getenv("BENCH_MYSQL_USER", "root"),
+        "password": os.getenv("BENCH_MYSQL_PASSWORD", "bench"),
+        "database": os.getenv("BENCH_MYSQL_DB", "balutedaar_bench"),
+    }
+
+
+def phone(i):
+    return f"91{9000000000 + i}"
+
+
+def split_sql(text):
+    lines = [line for line in text.splitlines() if not line.strip().startswith('--')]
+    return [stmt.strip() for stmt in "\n".join(lines).split(';') if stmt.strip()]
+
+
+def run_script(cursor, path):
+    with open(path, encoding='utf-8') as f:
+        for statement in split_sql(f.read()):
+            cursor.execute(statement)
+
+
+def insert_batched(cursor, sql, rows):
+    for i in range(0, len(rows), BATCH):
+        cursor.executemany(sql, rows[i:i + BATCH])
+
+
+def recreate(settings):
+    cnx = pymysql.connect(host=settings["host"], port=settings["port"], user=settings["user"],
+                          password=settings["password"], charset='utf8mb4')
+    with cnx.cursor() as cursor:
+        cursor.execute(f"DROP DATABASE IF EXISTS `{settings['database']}`")
+        cursor.execute(f"CREATE DATABASE `{settings['database']}` CHARACTER SET utf8mb4")
+    cnx.close()
+    return pymysql.connect(charset='utf8mb4', **settings)
+
+
+def seed(cnx, users=5000, orders=50000, referrals=20000, carts=500, stock=1000000, seed=7):
+    rng = random.Random(seed)
+    now = datetime.now()
+    month = now.strftime('%Y-%m')
+    last_month = (now.replace(day=1) - timedelta(days=1)).strftime('%Y-%m')
+    cursor = cnx.cursor()
+
+    cursor.executemany("INSERT INTO combos (combo_id, combo_name, price) VALUES (%s, %s, %s)", COMBOS)
+    cursor.executemany(
+        "INSERT INTO combo_inventory (combo_id, combo_name, total_boxes, booked) VALUES (%s, %s, %s, 0)",
+        [(combo_id, name, stock) for combo_id, name, _ in COMBOS]
+    )
+    others = {str(rng.randint(400000, 499999)) for _ in range(200)} - set(SERVICEABLE)
+    cursor.executemany("INSERT INTO pincodes (pincode) VALUES (%s)", [(p,) for p in SERVICEABLE + sorted(others)])
+
+    user_rows = []
+    for i in range(users):
+        user_rows.append((phone(i), '1', '1', f"User {i}", rng.choice(SERVICEABLE),
+                          f"Flat {i % 400 + 1}, Baner Road, Pune", '1', rng.randint(0, 500)))
+    insert_batched(cursor, "INSERT INTO users (phone_number, camp_id, is_valid, name, pincode, address, main_menu, "
+                           "balutedaar_points) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)", user_rows)
+
+    codes, code_rows = set(), []
+    for i in range(users):
+        for month_year, created in ((month, now - timedelta(days=rng.randint(0, 20))),
+                                    (last_month, now - timedelta(days=rng.randint(31, 55)))):
+            code = ''.join(rng.choices(string.ascii_uppercase + string.digits, k=6))
+            while code in codes:
+                code = ''.join(rng.choices(string.ascii_uppercase + string.digits, k=6))
+            codes.add(code)
+            code_rows.append([phone(i), code, month_year, 0, True, created])
+    reward_rows = []
+    current = [row for row in code_rows if row[2] == month]
+    for _ in range(referrals):
+        row = rng.choice(current)
+        if row[3] >= 4:
+            continue
+        row[3] += 1
+        friend = phone(rng.randrange(users))
+        reward_rows.append((row[0], row[1], friend, 50, None, now - timedelta(days=rng.randint(0, 20))))
+    insert_batched(cursor, "INSERT INTO referral_codes (user_phone, referral_code, month_year, usage_count, is_active, "
+                           "created_at) VALUES (%s, %s, %s, %s, %s, %s)", [tuple(r) for r in code_rows])
+    insert_batched(cursor, "INSERT INTO referral_rewards (user_phone, referral_code, friend_phone, points_earned, "
+                           "order_id, created_at) VALUES (%s, %s, %s, %s, %s, %s)", reward_rows)
+
+    order_rows = []
+    for _ in range(orders):
+        i = rng.randrange(users)
+        combo_id, name, price = rng.choice(COMBOS)
+        quantity = rng.randint(1, 3)
+        order_rows.append((phone(i), f"User {i}", combo_id, name, price, quantity, price * quantity,
+                           f"Flat {i % 400 + 1}, Baner Road, Pune", rng.choice(SERVICEABLE),
+                           rng.choice(("COD", "Pay Now")), "Completed", "Placed", f"q9{rng.getrandbits(32):08x}",
+                           None, (now - timedelta(days=rng.randint(0, 90))).date()))
+    insert_batched(cursor, "INSERT INTO orders (user_phone, customer_name, combo_id, combo_name, price, quantity, "
+                           "total_amount, address, pincode, payment_method, payment_status, order_status, "
+                           "reference_id, referral_code, delivery_date) "
+                           "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", order_rows)
+
+    cart_rows = []
+    for i in rng.sample(range(users), min(carts, users)):
+        for combo_id, name, price in rng.sample(COMBOS, rng.randint(1, 3)):
+            cart_rows.append((phone(i), combo_id, name, rng.randint(1, 3), price))
+    insert_batched(cursor, "INSERT INTO user_cart (phone_number, combo_id, combo_name, quantity, price) "
+                           "VALUES (%s, %s, %s, %s, %s)", cart_rows)
+    cnx.commit()
+    return {
+        "users": users, "orders": len(order_rows), "referral_codes": len(code_rows),
+        "referral_rewards": len(reward_rows), "carts": len({row[0] for row in cart_rows}),
+    }
+
+
+def migrate(cnx):
+    cursor = cnx.cursor()
+    for path in sorted(glob.glob(os.path.join(ROOT, "migrations", "*.sql"))):
+        run_script(cursor, path)
+    cnx.commit()
+
+
+def prepare(users=5000, orders=50000, referrals=20000, carts=500, stock=1000000):
+    settings = mysql_settings()
+    cnx = recreate(settings)
+    try:
+        run_script(cnx.cursor(), os.path.join(HERE, "schema.sql"))
+        sizes = seed(cnx, users=users, orders=orders, referrals=referrals, carts=carts, stock=stock)
+        migrate(cnx)
+    finally:
+        cnx.close()
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--orders", type=int, default=50000)
+    parser.add_argument("--referrals", type=int, default=20000)
+    parser.add_argument("--carts", type=int, default=500)
+    parser.add_argument("--stock", type=int, default=1000000)
+    args = parser.parse_args()
+    print(prepare(args.users, args.orders, args.referrals, args.carts, args.stock))
+
+
+if __name__ == '__main__':
+    main()
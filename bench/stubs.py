@@ -0,0 +1,116 @@
+"""Local stand-ins for rmlconnect and Razorpay used by the benchmarks and the load generator.
+
+    python -m bench.stubs --port 8090 --latency 0.05
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubServer:
+    """Answers rmlconnect sends and Razorpay payment-link creation on 127.0.0.1.
+
+    Point the app at it with RML_BASE_URL=<url> and RAZORPAY_BASE_URL=<url>/v1.
+    ``latency`` seconds are added to every response to stand in for the
+    provider's round trip. Sent messages and created payment links are kept
+    for the load generator to inspect.
+    """
+
+    def __init__(self, latency=0.0, port=0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.sent = []
+        self.payment_links = {}
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    body = {}
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if self.path.startswith('/wba/v1/messages'):
+                    reply = stub._message(body)
+                elif self.path.startswith('/v1/payment_links'):
+                    reply = stub._payment_link(body)
+                else:
+                    self._send(404, {"error": "not found"})
+                    return
+                self._send(200, reply)
+
+            def _send(self, status, payload):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _message(self, body):
+        message_id = f"wamid.{uuid.uuid4().hex}"
+        with self.lock:
+            self.sent.append((body.get("phone"), body.get("extra"), message_id))
+        return {"messages": [{"id": message_id}]}
+
+    def _payment_link(self, body):
+        link_id = f"plink_{uuid.uuid4().hex[:14]}"
+        reference_id = body.get("reference_id")
+        with self.lock:
+            self.payment_links[reference_id] = body
+        return {"id": link_id, "reference_id": reference_id, "status": "created",
+                "short_url": f"{self.url}/pay/{link_id}", "amount": body.get("amount")}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="bench-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def sent_by_type(self):
+        counts = {}
+        with self.lock:
+            for _, extra, _ in self.sent:
+                counts[extra] = counts.get(extra, 0) + 1
+        return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the rmlconnect and Razorpay stand-ins until interrupted.")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    args = parser.parse_args()
+    stub = StubServer(latency=args.latency, port=args.port)
+    print(f"Serving on {stub.url}; RML_BASE_URL={stub.url} RAZORPAY_BASE_URL={stub.url}/v1")
+    try:
+        stub.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
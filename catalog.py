@@ -0,0 +1,122 @@
+import logging
+import os
+import threading
+import time
+
+
+class CatalogSnapshot:
+    __slots__ = ('names', 'prices', 'inventory', 'version', 'loaded_at', 'checked_at')
+
+    def __init__(self, names, prices, inventory, version):
+        self.names = names
+        self.prices = prices
+        self.inventory = inventory
+        self.version = version
+        self.loaded_at = self.checked_at = time.monotonic()
+
+
+class CatalogCache:
+    """Process-local copy of combo names, prices and the stock snapshot.
+
+    The snapshot is reloaded after ``ttl`` seconds, or sooner when the
+    ``catalog_version`` stamp in MySQL moves (checked at most every
+    ``version_check_interval`` seconds), so an admin edit made through any
+    worker reaches all of them. If a reload fails the previous snapshot keeps
+    serving; ``fallback`` is only used when no snapshot was ever loaded.
+    """
+
+    def __init__(self, pool, fallback, ttl=60.0, version_check_interval=5.0):
+        self.pool = pool
+        self.fallback = fallback
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, pool, fallback):
+        return cls(
+            pool, fallback,
+            ttl=float(os.getenv("CATALOG_TTL", "60")),
+            version_check_interval=float(os.getenv("CATALOG_VERSION_CHECK_INTERVAL", "5")),
+        )
+
+    def _read_version(self, cursor):
+        try:
+            cursor.execute("SELECT version FROM catalog_version WHERE id = 1")
+            row = cursor.fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            logging.error(f"Catalog version check failed: {e}")
+            return None
+
+    def _load(self):
+        with self.pool.session() as dbs:
+            cursor = dbs.cursor()
+            version = self._read_version(cursor)
+            cursor.execute("SELECT combo_id, combo_name, price FROM combos")
+            combos = cursor.fetchall()
+            cursor.execute("SELECT combo_id, combo_name, total_boxes FROM combo_inventory")
+            inventory = cursor.fetchall()
+        names = {combo_id: combo_name for combo_id, combo_name, _ in combos}
+        prices = {combo_id: float(price) for combo_id, _, price in combos if price is not None}
+        return CatalogSnapshot(names, prices, list(inventory), version)
+
+    def _stale(self, snap, now):
+        if now - snap.loaded_at > self.ttl:
+            return True
+        if now - snap.checked_at < self.version_check_interval:
+            return False
+        snap.checked_at = now
+        with self.pool.session() as dbs:
+            version = self._read_version(dbs.cursor())
+        return version is not None and version != snap.version
+
+    def snapshot(self):
+        """Current snapshot, or None if the catalog could never be loaded."""
+        snap = self._snapshot
+        try:
+            if snap is not None and not self._stale(snap, time.monotonic()):
+                return snap
+            with self._lock:
+                if self._snapshot is not snap:
+                    return self._snapshot
+                self._snapshot = self._load()
+                return self._snapshot
+        except Exception as e:
+            logging.error(f"Failed to refresh catalog cache: {e}")
+            return snap
+
+    def name(self, combo_id):
+        snap = self.snapshot()
+        if snap is not None and combo_id in snap.names:
+            return snap.names[combo_id]
+        return self.fallback.get(combo_id, {}).get("name", "Unknown Combo")
+
+    def price(self, combo_id):
+        snap = self.snapshot()
+        if snap is not None and combo_id in snap.prices:
+            return snap.prices[combo_id]
+        return float(self.fallback.get(combo_id, {}).get("price", 0))
+
+    def availability(self):
+        """(combo_id, combo_name, total_boxes) rows, or None if unavailable."""
+        snap = self.snapshot()
+        return snap.inventory if snap is not None else None
+
+    def invalidate(self):
+        """Drop the local snapshot and bump the shared version stamp.
+
+        Call inside the session that made the catalog change so the bump
+        commits with it.
+        """
+        try:
+            with self.pool.session() as dbs:
+                dbs.cursor().execute("UPDATE catalog_version SET version = version + 1 WHERE id = 1")
+                dbs.after_commit(self._drop)
+        except Exception as e:
+            logging.error(f"Failed to bump catalog version: {e}")
+            self._drop()
+
+    def _drop(self):
+        self._snapshot = None
@@ -0,0 +1,131 @@
+import logging
+import os
+from enum import Enum
+
+from cache import TTLCache
+
+
+class ConvState(str, Enum):
+    IDLE = 'IDLE'
+    AWAITING_NAME = 'AWAITING_NAME'
+    AWAITING_PINCODE = 'AWAITING_PINCODE'
+    AWAITING_REFERRAL = 'AWAITING_REFERRAL'
+    BROWSING = 'BROWSING'
+    AWAITING_ADDRESS = 'AWAITING_ADDRESS'
+    ORDER_REVIEW = 'ORDER_REVIEW'
+
+
+class StaleConversation(Exception):
+    pass
+
+
+class Conversation:
+    """Compact per-user funnel record: where the user is and what they have told us so far."""
+
+    __slots__ = ('phone', 'state', 'name', 'pincode', 'address', 'referral_code', 'version')
+
+    def __init__(self, phone, state, name=None, pincode=None, address=None, referral_code=None, version=0):
+        self.phone = phone
+        self.state = state
+        self.name = name
+        self.pincode = pincode
+        self.address = address
+        self.referral_code = referral_code
+        self.version = version
+
+    def copy(self, **changes):
+        conv = Conversation(self.phone, self.state, self.name, self.pincode, self.address,
+                            self.referral_code, self.version)
+        for field, value in changes.items():
+            setattr(conv, field, value)
+        return conv
+
+
+class ConversationStore:
+    """Loads and persists Conversation records through a bounded write-through cache.
+
+    Each worker process has its own cache, and consecutive messages from one
+    phone can land on different workers. So a cached conversation is only
+    used after a primary-key read confirms its ``state_version`` is still
+    current; otherwise the row is reloaded. Every transition is one UPDATE
+    guarded by ``state_version``. If another worker moved the conversation
+    first, the UPDATE matches no row, the cached copy is dropped and
+    StaleConversation is raised so the caller can retry from a fresh read.
+    The cache is only updated once the surrounding transaction commits.
+    """
+
+    def __init__(self, pool, maxsize=10000, ttl=900.0):
+        self.pool = pool
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    @classmethod
+    def from_env(cls, pool):
+        return cls(
+            pool,
+            maxsize=int(os.getenv("CONVERSATION_CACHE_SIZE", "10000")),
+            ttl=float(os.getenv("CONVERSATION_CACHE_TTL", "900")),
+        )
+
+    def load(self, phone):
+        conv = self.cache.get(phone)
+        with self.pool.session() as dbs:
+            cursor = dbs.cursor()
+            if conv is not None:
+                cursor.execute("SELECT state_version FROM users WHERE phone_number = %s", (phone,))
+                row = cursor.fetchone()
+                if row is None:
+                    self.cache.pop(phone)
+                    return None
+                if row[0] == conv.version:
+                    return conv.copy()
+                self.cache.pop(phone)
+            cursor.execute(
+                "SELECT conv_state, name, pincode, address, referral_code, state_version FROM users WHERE phone_number = %s",
+                (phone,)
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        state, name, pincode, address, referral_code, version = row
+        try:
+            state = ConvState(state)
+        except ValueError:
+            logging.error(f"Unknown conversation state {state!r} for {phone}, treating as idle")
+            state = ConvState.IDLE
+        conv = Conversation(phone, state, name, pincode, address, referral_code, version)
+        self.cache.set(phone, conv)
+        return conv.copy()
+
+    def create(self, phone, state, name=None):
+        with self.pool.session() as dbs:
+            dbs.cursor().execute(
+                "INSERT INTO users (phone_number, camp_id, is_valid, name, conv_state, state_version, balutedaar_points) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                (phone, '1', '1', name, state.value, 0, 0)
+            )
+            conv = Conversation(phone, state, name)
+            dbs.after_commit(lambda: self.cache.set(phone, conv))
+        return conv.copy()
+
+    def transition(self, conv, state, **changes):
+        new = conv.copy(state=state, version=conv.version + 1, **changes)
+        with self.pool.session() as dbs:
+            updated = dbs.cursor().execute(
+                "UPDATE users SET conv_state = %s, name = %s, pincode = %s, address = %s, referral_code = %s, "
+                "state_version = %s WHERE phone_number = %s AND state_version = %s",
+                (new.state.value, new.name, new.pincode, new.address, new.referral_code, new.version,
+                 conv.phone, conv.version)
+            )
+            if not updated:
+                self.cache.pop(conv.phone)
+                raise StaleConversation(conv.phone)
+            dbs.after_commit(lambda: self.cache.set(new.phone, new))
+        return new.copy()
+
+    def peek_state(self, phone):
+        """Cached state for ``phone`` without touching MySQL, or None if not cached."""
+        conv = self.cache.get(phone)
+        return conv.state if conv is not None else None
+
+    def invalidate(self, phone):
+        self.cache.pop(phone)
@@ -0,0 +1,429 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import pymysql
+from pymysql.constants.ER import LOCK_DEADLOCK, LOCK_WAIT_TIMEOUT
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class LockTimeout(Exception):
+    pass
+
+
+_local = threading.local()
+
+
+def is_transient(error):
+    """True for a deadlock or lock wait timeout: MySQL has rolled back, so the unit of work must be retried."""
+    return isinstance(error, pymysql.err.OperationalError) and error.args[0] in (LOCK_DEADLOCK, LOCK_WAIT_TIMEOUT)
+
+
+def current_session():
+    """Return the DBSession bound to this thread, or None outside a unit of work."""
+    return getattr(_local, 'session', None)
+
+
+_statement_observers = []
+_connection_observers = []
+
+
+def add_statement_observer(observer):
+    """Call ``observer(sql, seconds, rows)`` after every statement run through a DBSession cursor."""
+    _statement_observers.append(observer)
+
+
+def add_connection_observer(observer):
+    """Call ``observer(created)`` whenever a connection is checked out of a pool; ``created`` if it is new."""
+    _connection_observers.append(observer)
+
+
+class ObservedCursor:
+    """pymysql cursor proxy that reports each execute/executemany to the statement observers."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _observe(self, run, sql, args):
+        started = time.perf_counter()
+        try:
+            return run(sql, args)
+        finally:
+            elapsed = time.perf_counter() - started
+            rows = self._cursor.rowcount
+            for observer in _statement_observers:
+                try:
+                    observer(sql, elapsed, rows)
+                except Exception as e:
+                    logging.error(f"Statement observer failed: {e}")
+
+    def execute(self, sql, args=None):
+        return self._observe(self._cursor.execute, sql, args)
+
+    def executemany(self, sql, args):
+        return self._observe(self._cursor.executemany, sql, args)
+
+
+class DBSession:
+    """One pooled connection and the single transaction it carries for a request or job."""
+
+    def __init__(self, cnx):
+        self.cnx = cnx
+        self._savepoints = 0
+        self._after_commit = []
+        self._locks = []
+        # Memoised reads that are valid for the life of this unit of work.
+        self.cache = {}
+
+    def cursor(self):
+        cursor = self.cnx.cursor()
+        return ObservedCursor(cursor) if _statement_observers else cursor
+
+    def commit(self):
+        self.cnx.commit()
+
+    def run_after_commit(self):
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"after_commit callback failed: {e}")
+
+    def rollback(self):
+        self._after_commit = []
+        self.cnx.rollback()
+
+    def after_commit(self, callback):
+        """Run ``callback`` once the transaction commits and the connection is back in the pool; drop it on rollback.
+
+        Callbacks run outside the unit of work, so a slow one (a provider
+        call) holds no row locks, named locks or connection.
+        """
+        self._after_commit.append(callback)
+
+    def lock(self, name, timeout):
+        """Take the MySQL named lock ``name`` for the rest of this unit of work.
+
+        Named locks are not transactional: they are released by the owning
+        session after it commits or rolls back, not by COMMIT itself.
+        """
+        cursor = self.cursor()
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+        if cursor.fetchone()[0] != 1:
+            raise LockTimeout(f"Timed out after {timeout}s waiting for lock {name}")
+        self._locks.append(name)
+
+    def release_locks(self):
+        locks, self._locks = self._locks, []
+        for name in locks:
+            try:
+                self.cursor().execute("SELECT RELEASE_LOCK(%s)", (name,))
+            except Exception as e:
+                logging.error(f"Failed to release lock {name}: {e}")
+
+    @contextmanager
+    def savepoint(self):
+        """Undo only the statements (and after_commit callbacks) issued inside the block if it raises."""
+        self._savepoints += 1
+        name = f"sp_{self._savepoints}"
+        pending = len(self._after_commit)
+        cursor = self.cursor()
+        cursor.execute(f"SAVEPOINT {name}")
+        try:
+            yield
+        except BaseException as e:
+            # A deadlock has already rolled back the whole transaction, savepoint included.
+            if not is_transient(e):
+                cursor.execute(f"ROLLBACK TO SAVEPOINT {name}")
+            del self._after_commit[pending:]
+            raise
+        cursor.execute(f"RELEASE SAVEPOINT {name}")
+
+
+class _PoolEntry:
+    __slots__ = ('raw', 'created_at', 'last_used')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class PooledConnection:
+    """Thin proxy over a pymysql connection. close() hands it back to the pool."""
+
+    def __init__(self, pool, entry):
+        self._pool = pool
+        self._entry = entry
+
+    def __getattr__(self, name):
+        if self._entry is None:
+            raise pymysql.err.InterfaceError(0, "Connection already returned to pool")
+        return getattr(self._entry.raw, name)
+
+    def close(self):
+        if self._entry is not None:
+            entry, self._entry = self._entry, None
+            self._pool.release(entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of MySQL connections.
+
+    Connections are pinged on borrow (unless used within ``ping_interval``
+    seconds), retired after ``max_lifetime`` seconds and reaped when idle
+    for longer than ``idle_timeout`` seconds. The recent wait reported to
+    admission control halves every ``wait_half_life`` seconds without a
+    borrow, so it falls back to zero once callers stop queueing.
+    """
+
+    def __init__(self, connect_kwargs, size=10, timeout=5.0, max_lifetime=1800.0,
+                 idle_timeout=300.0, ping_interval=1.0, wait_half_life=5.0):
+        self.connect_kwargs = connect_kwargs
+        self.size = size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self.wait_half_life = wait_half_life
+        self._cond = threading.Condition()
+        self._idle = []
+        self._open = 0
+        self._in_use = 0
+        self._waiters = 0
+        self._acquired = 0
+        self._created = 0
+        self._closed = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        # Exponentially weighted wait, so admission control sees current pressure rather than the lifetime average.
+        self._wait_recent = 0.0
+        self._wait_recent_at = time.monotonic()
+
+    @classmethod
+    def from_env(cls, **connect_kwargs):
+        connect_kwargs.setdefault('port', int(os.getenv("MYSQL_PORT", "3306")))
+        connect_kwargs.setdefault('connect_timeout', int(os.getenv("MYSQL_CONNECT_TIMEOUT", "5")))
+        return cls(
+            connect_kwargs,
+            size=int(os.getenv("MYSQL_POOL_SIZE", "10")),
+            timeout=float(os.getenv("MYSQL_POOL_TIMEOUT", "5")),
+            max_lifetime=float(os.getenv("MYSQL_POOL_MAX_LIFETIME", "1800")),
+            idle_timeout=float(os.getenv("MYSQL_POOL_IDLE_TIMEOUT", "300")),
+            ping_interval=float(os.getenv("MYSQL_POOL_PING_INTERVAL", "1")),
+            wait_half_life=float(os.getenv("MYSQL_POOL_WAIT_HALF_LIFE", "5")),
+        )
+
+    def _expired(self, entry, now):
+        return now - entry.created_at > self.max_lifetime
+
+    def _reap_idle_locked(self, now):
+        stale = [e for e in self._idle if self._expired(e, now) or now - e.last_used > self.idle_timeout]
+        if stale:
+            self._idle = [e for e in self._idle if e not in stale]
+            self._open -= len(stale)
+            self._closed += len(stale)
+        return stale
+
+    def _close_raw(self, entry):
+        try:
+            entry.raw.close()
+        except Exception:
+            pass
+
+    def _healthy(self, entry):
+        now = time.monotonic()
+        if self._expired(entry, now):
+            return False
+        if now - entry.last_used < self.ping_interval:
+            return True
+        try:
+            entry.raw.ping(reconnect=False)
+            return True
+        except Exception as e:
+            logging.error(f"Pooled connection failed health check: {e}")
+            return False
+
+    def _decayed_wait(self, now):
+        # Decay by elapsed time as well as per borrow: requests shed on this signal never borrow.
+        if self.wait_half_life <= 0:
+            return self._wait_recent
+        return self._wait_recent * 0.5 ** ((now - self._wait_recent_at) / self.wait_half_life)
+
+    def _record_wait(self, waited):
+        now = time.monotonic()
+        recent = self._decayed_wait(now)
+        self._wait_recent = recent + (waited - recent) * 0.2
+        self._wait_recent_at = now
+
+    def recent_wait_ms(self):
+        return self._decayed_wait(time.monotonic()) * 1000
+
+    def connect(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._cond:
+            stale = self._reap_idle_locked(start)
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    entry = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    self._record_wait(self.timeout)
+                    raise PoolTimeout(f"Timed out after {self.timeout}s waiting for a MySQL connection")
+                self._waiters += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiters -= 1
+            self._in_use += 1
+            self._acquired += 1
+            waited = time.monotonic() - start
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            self._record_wait(waited)
+        for old in stale:
+            self._close_raw(old)
+        try:
+            if entry is not None and not self._healthy(entry):
+                self._close_raw(entry)
+                with self._cond:
+                    self._closed += 1
+                entry = None
+            created = entry is None
+            if created:
+                entry = _PoolEntry(pymysql.connect(**self.connect_kwargs))
+                with self._cond:
+                    self._created += 1
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._open -= 1
+                self._cond.notify()
+            raise
+        for observer in _connection_observers:
+            try:
+                observer(created)
+            except Exception as e:
+                logging.error(f"Connection observer failed: {e}")
+        return PooledConnection(self, entry)
+
+    @contextmanager
+    def connection(self):
+        cnx = self.connect()
+        try:
+            yield cnx
+        finally:
+            cnx.close()
+
+    @contextmanager
+    def session(self):
+        """Join the unit of work bound to this thread, or open one.
+
+        The outermost caller owns the transaction: it commits when the block
+        exits cleanly and rolls back if it raises. Nested callers share the
+        same connection and never commit on their own.
+        """
+        active = current_session()
+        if active is not None:
+            yield active
+            return
+        cnx = self.connect()
+        dbs = DBSession(cnx)
+        _local.session = dbs
+        try:
+            yield dbs
+            dbs.commit()
+        except BaseException:
+            try:
+                dbs.rollback()
+            except Exception as e:
+                logging.error(f"Rollback failed: {e}")
+            raise
+        finally:
+            _local.session = None
+            dbs.release_locks()
+            cnx.close()
+        dbs.run_after_commit()
+
+    def release(self, entry):
+        healthy = True
+        try:
+            # Never hand an open transaction (or its snapshot) to the next borrower.
+            entry.raw.rollback()
+        except Exception:
+            healthy = False
+        entry.last_used = time.monotonic()
+        with self._cond:
+            self._in_use -= 1
+            if healthy and not self._expired(entry, entry.last_used):
+                self._idle.append(entry)
+            else:
+                self._open -= 1
+                self._closed += 1
+                healthy = False
+            self._cond.notify()
+        if not healthy:
+            self._close_raw(entry)
+
+    def warm(self, count):
+        """Open up to ``count`` connections now so the first requests do not pay for the handshake."""
+        held = []
+        try:
+            for _ in range(min(count, self.size)):
+                held.append(self.connect())
+        finally:
+            for cnx in held:
+                cnx.close()
+        return len(held)
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._closed += len(idle)
+        for entry in idle:
+            self._close_raw(entry)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "open": self._open,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "waiters": self._waiters,
+                "acquired": self._acquired,
+                "created": self._created,
+                "closed": self._closed,
+                "timeouts": self._timeouts,
+                "wait_time_total_ms": round(self._wait_total * 1000, 3),
+                "wait_time_max_ms": round(self._wait_max * 1000, 3),
+                "wait_time_avg_ms": round(self._wait_total * 1000 / self._acquired, 3) if self._acquired else 0.0,
+                "wait_time_recent_ms": round(self.recent_wait_ms(), 3),
+            }
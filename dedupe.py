@@ -0,0 +1,108 @@
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from pymysql.constants.ER import DUP_ENTRY as ER_DUP_ENTRY
+from pymysql.err import IntegrityError
+
+from cache import TTLCache
+
+
+class MessageDeduplicator:
+    """Drops webhook redeliveries by their WhatsApp ``messages[].id``.
+
+    ``seen()`` answers from a bounded in-memory LRU without touching MySQL.
+    ``claim()`` inserts the id into ``processed_messages`` inside the
+    caller's transaction, so the claim commits or rolls back together with
+    the work it guards and a concurrent redelivery waits on the unique key
+    instead of running twice. Rows older than ``retention`` are purged by a
+    background thread.
+    """
+
+    def __init__(self, pool, maxsize=50000, retention=timedelta(hours=72), purge_interval=3600.0,
+                 purge_batch=1000):
+        self.pool = pool
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self.purge_batch = purge_batch
+        self.recent = TTLCache(maxsize=maxsize, ttl=retention.total_seconds())
+        self._stop = threading.Event()
+        self._thread = None
+        self._claimed = 0
+        self._duplicates = 0
+        self._purged = 0
+
+    @classmethod
+    def from_env(cls, pool):
+        return cls(
+            pool,
+            maxsize=int(os.getenv("DEDUPE_CACHE_SIZE", "50000")),
+            retention=timedelta(hours=float(os.getenv("DEDUPE_RETENTION_HOURS", "72"))),
+            purge_interval=float(os.getenv("DEDUPE_PURGE_INTERVAL", "3600")),
+        )
+
+    def seen(self, message_id):
+        if self.recent.get(message_id) is None:
+            return False
+        self._duplicates += 1
+        return True
+
+    def claim(self, message_id):
+        """Record ``message_id`` as processed; False if it already was."""
+        with self.pool.session() as dbs:
+            try:
+                dbs.cursor().execute(
+                    "INSERT INTO processed_messages (message_id, received_at) VALUES (%s, %s)",
+                    (message_id, datetime.now())
+                )
+            except IntegrityError as e:
+                if e.args[0] != ER_DUP_ENTRY:
+                    raise
+                self.recent.set(message_id, True)
+                self._duplicates += 1
+                return False
+            dbs.after_commit(lambda: self.recent.set(message_id, True))
+        self._claimed += 1
+        return True
+
+    def purge(self):
+        cutoff = datetime.now() - self.retention
+        purged = 0
+        try:
+            while True:
+                with self.pool.session() as dbs:
+                    deleted = dbs.cursor().execute(
+                        "DELETE FROM processed_messages WHERE received_at < %s LIMIT %s",
+                        (cutoff, self.purge_batch)
+                    )
+                purged += deleted
+                if deleted < self.purge_batch:
+                    break
+        except Exception as e:
+            logging.error(f"Failed to purge processed_messages: {e}")
+        self._purged += purged
+        return purged
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="dedupe-purge", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.purge_interval):
+            self.purge()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+    def stats(self):
+        return {
+            "cached": len(self.recent),
+            "claimed": self._claimed,
+            "duplicates": self._duplicates,
+            "purged": self._purged,
+        }
@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class RetryableSendError(Exception):
+    pass
+
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class OutboundQueue:
+    """Durable outbound message queue drained by a pool of worker threads.
+
+    Every job is written to a local SQLite outbox before it is queued and
+    deleted once delivered, so a restart replays whatever was still pending.
+    Jobs are sharded by recipient, so each recipient's messages go out in
+    the order they were enqueued. ``send`` is called with the job dict and
+    should raise RetryableSendError for timeouts and 5xx responses; those
+    are retried with exponential backoff, anything else fails the job.
+    Failed jobs stay in the outbox for inspection and are pruned once they
+    are older than ``failed_retention`` seconds.
+    """
+
+    def __init__(self, send, spool_path='outbox.db', workers=4, max_attempts=5,
+                 backoff_base=1.0, backoff_max=30.0, failed_retention=7 * 86400.0, prune_interval=3600.0):
+        self.send = send
+        self.spool_path = spool_path
+        self.workers = max(1, workers)
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failed_retention = failed_retention
+        self.prune_interval = prune_interval
+        self._last_prune = 0.0
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._shards = []
+        self._threads = []
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._enqueued = 0
+        self._delivered = 0
+        self._retries = 0
+        self._failed = 0
+        self._in_flight = 0
+        self._pruned = 0
+
+    @classmethod
+    def from_env(cls, send):
+        return cls(
+            send,
+            spool_path=os.getenv("OUTBOUND_SPOOL_PATH", "outbox.db"),
+            workers=int(os.getenv("OUTBOUND_WORKERS", "4")),
+            max_attempts=int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "5")),
+            backoff_base=float(os.getenv("OUTBOUND_BACKOFF_BASE", "1")),
+            backoff_max=float(os.getenv("OUTBOUND_BACKOFF_MAX", "30")),
+            failed_retention=float(os.getenv("OUTBOUND_FAILED_RETENTION_HOURS", "168")) * 3600,
+        )
+
+    def _open_spool(self):
+        cnx = sqlite3.connect(self.spool_path, check_same_thread=False, isolation_level=None)
+        cnx.execute("PRAGMA journal_mode=WAL")
+        cnx.execute("PRAGMA synchronous=NORMAL")
+        cnx.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, phone TEXT NOT NULL, job TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL DEFAULT 'pending', "
+            "owner INTEGER NOT NULL, created_at REAL NOT NULL)"
+        )
+        return cnx
+
+    def _spool(self, sql, params=()):
+        with self._db_lock:
+            return self._db.execute(sql, params)
+
+    def _shard(self, phone):
+        return self._shards[zlib.crc32(phone.encode('utf-8')) % self.workers]
+
+    def start(self):
+        if self._threads:
+            return
+        if self._db is None:
+            self._db = self._open_spool()
+        self._stopping.clear()
+        self._shards = [queue.Queue() for _ in range(self.workers)]
+        for i, shard in enumerate(self._shards):
+            t = threading.Thread(target=self._run, args=(shard,), name=f"outbound-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        self._replay()
+        self.prune_failed()
+
+    def _replay(self):
+        me = os.getpid()
+        owners = [row[0] for row in self._spool("SELECT DISTINCT owner FROM outbox WHERE status = 'pending'")]
+        for owner in owners:
+            if owner != me and not _pid_alive(owner):
+                self._spool("UPDATE outbox SET owner = ? WHERE owner = ? AND status = 'pending'", (me, owner))
+        rows = self._spool(
+            "SELECT id, phone, job FROM outbox WHERE owner = ? AND status = 'pending' ORDER BY id", (me,)
+        ).fetchall()
+        for row_id, phone, job in rows:
+            self._put(row_id, phone, json.loads(job))
+        if rows:
+            logging.info(f"Replayed {len(rows)} undelivered outbound messages from {self.spool_path}")
+
+    def _put(self, row_id, phone, job):
+        with self._stats_lock:
+            self._enqueued += 1
+        self._shard(phone).put((row_id, phone, job))
+
+    def enqueue(self, phone, job):
+        if not self._threads:
+            self.start()
+        cur = self._spool(
+            "INSERT INTO outbox (phone, job, owner, created_at) VALUES (?, ?, ?, ?)",
+            (phone, json.dumps(job), os.getpid(), time.time())
+        )
+        self._put(cur.lastrowid, phone, job)
+
+    def _run(self, shard):
+        while True:
+            item = shard.get()
+            if item is None:
+                return
+            with self._stats_lock:
+                self._in_flight += 1
+            try:
+                if not self._deliver(*item):
+                    # Stopping mid-retry: leave this and everything behind it in
+                    # the outbox so the next start replays them in order.
+                    return
+            finally:
+                with self._stats_lock:
+                    self._in_flight -= 1
+
+    def _deliver(self, row_id, phone, job):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self.send(job)
+                self._spool("DELETE FROM outbox WHERE id = ?", (row_id,))
+                with self._stats_lock:
+                    self._delivered += 1
+                return True
+            except RetryableSendError as e:
+                if attempt >= self.max_attempts:
+                    logging.error(f"Giving up on outbound message {row_id} to {phone} after {attempt} attempts: {e}")
+                    self._fail(row_id, attempt)
+                    return True
+                delay = min(self.backoff_base * (2 ** (attempt - 1)), self.backoff_max)
+                logging.error(f"Outbound message {row_id} to {phone} failed (attempt {attempt}), retrying in {delay}s: {e}")
+                with self._stats_lock:
+                    self._retries += 1
+                self._spool("UPDATE outbox SET attempts = ? WHERE id = ?", (attempt, row_id))
+                if self._stopping.wait(delay):
+                    return False
+            except Exception as e:
+                logging.error(f"Outbound message {row_id} to {phone} failed permanently: {e}")
+                self._fail(row_id, attempt)
+                return True
+
+    def _fail(self, row_id, attempts):
+        self._spool("UPDATE outbox SET status = 'failed', attempts = ? WHERE id = ?", (attempts, row_id))
+        with self._stats_lock:
+            self._failed += 1
+        if time.monotonic() - self._last_prune >= self.prune_interval:
+            self.prune_failed()
+
+    def prune_failed(self):
+        """Delete failed jobs older than the retention period; returns how many were removed."""
+        self._last_prune = time.monotonic()
+        try:
+            pruned = self._spool(
+                "DELETE FROM outbox WHERE status = 'failed' AND created_at < ?",
+                (time.time() - self.failed_retention,)
+            ).rowcount
+        except sqlite3.Error as e:
+            logging.error(f"Failed to prune failed outbound messages from {self.spool_path}: {e}")
+            return 0
+        if pruned:
+            logging.info(f"Pruned {pruned} failed outbound messages from {self.spool_path}")
+            with self._stats_lock:
+                self._pruned += pruned
+        return pruned
+
+    def failed_backlog(self):
+        """Failed jobs still stored in the outbox, across all processes sharing it."""
+        if self._db is None:
+            return 0
+        return self._spool("SELECT COUNT(*) FROM outbox WHERE status = 'failed'").fetchone()[0]
+
+    def stop(self, timeout=10.0):
+        """Drain queued messages, then stop the workers."""
+        if not self._threads:
+            return
+        for shard in self._shards:
+            shard.put(None)
+        deadline = time.monotonic() + timeout
+        for t in self._threads:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._stopping.set()
+                remaining = 1.0
+            t.join(remaining)
+        self._stopping.set()
+        self._threads = []
+
+    def depth(self):
+        return sum(shard.qsize() for shard in self._shards)
+
+    def stats(self):
+        with self._stats_lock:
+            counters = {
+                "workers": self.workers,
+                "depth": self.depth(),
+                "in_flight": self._in_flight,
+                "enqueued": self._enqueued,
+                "delivered": self._delivered,
+                "retries": self._retries,
+                "failed": self._failed,
+                "failed_pruned": self._pruned,
+            }
+        return dict(counters, failed_stored=self.failed_backlog())
@@ -0,0 +1,28 @@
+"""gunicorn settings for serving wsgi:app.
+
+Every value can be overridden from the environment. On SIGTERM each worker
+stops accepting requests, finishes the ones in flight and then drains its
+inbound shards, outbound queue and log buffers before exiting; keep
+``graceful_timeout`` above INBOUND_TIMEOUT so that drain is not cut short.
+"""
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "45"))
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "0"))
+
+
+def post_fork(server, worker):
+    from app import init_worker
+    init_worker()
+
+
+def worker_exit(server, worker):
+    from app import shutdown
+    shutdown()
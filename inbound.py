@@ -0,0 +1,104 @@
+import logging
+import os
+import queue
+import threading
+import zlib
+from concurrent.futures import Future
+
+_STOP = object()
+
+
+class ShardedExecutor:
+    """Runs inbound work on a fixed set of worker threads, sharded by key.
+
+    Every call submitted for the same key (a phone number) lands on the same
+    worker, so one user's messages are handled strictly one at a time and in
+    arrival order, while different users are spread across ``workers``
+    threads. ``submit`` returns a Future for the caller to wait on.
+    """
+
+    def __init__(self, workers=8, name='inbound'):
+        self.workers = max(1, workers)
+        self.name = name
+        self._shards = []
+        self._threads = []
+        self._stats_lock = threading.Lock()
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._in_flight = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(workers=int(os.getenv("INBOUND_WORKERS", "8")))
+
+    def start(self):
+        if self._threads:
+            return
+        self._shards = [queue.Queue() for _ in range(self.workers)]
+        for i, shard in enumerate(self._shards):
+            t = threading.Thread(target=self._run, args=(shard,), name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, key, fn, *args):
+        if not self._threads:
+            raise RuntimeError(f"{self.name} executor is not running")
+        future = Future()
+        with self._stats_lock:
+            self._submitted += 1
+        self._shards[zlib.crc32(key.encode('utf-8')) % self.workers].put((future, fn, args))
+        return future
+
+    def _run(self, shard):
+        while True:
+            item = shard.get()
+            if item is _STOP:
+                return
+            future, fn, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self._stats_lock:
+                self._in_flight += 1
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                with self._stats_lock:
+                    self._failed += 1
+                future.set_exception(e)
+            else:
+                with self._stats_lock:
+                    self._completed += 1
+                future.set_result(result)
+            finally:
+                with self._stats_lock:
+                    self._in_flight -= 1
+
+    def stop(self, timeout=10.0):
+        """Finish everything already queued, then stop the workers. Returns False if any worker is still running."""
+        if not self._threads:
+            return True
+        for shard in self._shards:
+            shard.put(_STOP)
+        drained = True
+        for t in self._threads:
+            t.join(timeout)
+            if t.is_alive():
+                logging.warning(f"{t.name} did not drain within {timeout}s")
+                drained = False
+        self._threads = []
+        return drained
+
+    def depth(self):
+        return sum(shard.qsize() for shard in self._shards)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "workers": self.workers,
+                "depth": self.depth(),
+                "in_flight": self._in_flight,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+            }
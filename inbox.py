@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from dispatch import _pid_alive
+
+
+class Inbox:
+    """Durable local inbox behind the fast-ack webhook mode.
+
+    ``accept`` writes the raw payload to a SQLite inbox and hands it to the
+    sharded inbound executor, so the webhook can answer before any MySQL or
+    provider work runs. ``handle`` is called with the payload on the
+    phone's shard; the row is deleted once it returns. Failures are retried
+    with backoff and then parked as 'failed'; failed rows are pruned once
+    they are older than ``failed_retention`` seconds. Rows left behind by a
+    crashed process are taken over and replayed, in arrival order, on
+    ``start``.
+    """
+
+    def __init__(self, handle, executor, path='inbox.db', max_attempts=3, backoff_base=0.5, backoff_max=5.0,
+                 failed_retention=7 * 86400.0, prune_interval=3600.0):
+        self.handle = handle
+        self.executor = executor
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failed_retention = failed_retention
+        self.prune_interval = prune_interval
+        self._last_prune = 0.0
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._accepted = 0
+        self._processed = 0
+        self._retries = 0
+        self._failed = 0
+        self._replayed = 0
+        self._pruned = 0
+
+    @classmethod
+    def from_env(cls, handle, executor):
+        return cls(
+            handle, executor,
+            path=os.getenv("INBOX_PATH", "inbox.db"),
+            max_attempts=int(os.getenv("INBOX_MAX_ATTEMPTS", "3")),
+            backoff_base=float(os.getenv("INBOX_BACKOFF_BASE", "0.5")),
+            backoff_max=float(os.getenv("INBOX_BACKOFF_MAX", "5")),
+            failed_retention=float(os.getenv("INBOX_FAILED_RETENTION_HOURS", "168")) * 3600,
+        )
+
+    def _open(self):
+        cnx = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        cnx.execute("PRAGMA journal_mode=WAL")
+        # The webhook is acknowledged as soon as this write returns, so it must reach disk.
+        cnx.execute("PRAGMA synchronous=FULL")
+        cnx.execute(
+            "CREATE TABLE IF NOT EXISTS inbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, phone TEXT NOT NULL, payload TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL DEFAULT 'pending', "
+            "owner INTEGER NOT NULL, created_at REAL NOT NULL)"
+        )
+        return cnx
+
+    def _sql(self, sql, params=()):
+        with self._db_lock:
+            if self._db is None:
+                # Closed under a worker that outlived shutdown; its row stays pending for the next start.
+                return None
+            return self._db.execute(sql, params)
+
+    def start(self):
+        if self._db is None:
+            self._db = self._open()
+        self._stopping.clear()
+        self._replay()
+        self.prune_failed()
+
+    def _replay(self):
+        me = os.getpid()
+        owners = [row[0] for row in self._sql("SELECT DISTINCT owner FROM inbox WHERE status = 'pending'")]
+        for owner in owners:
+            if owner != me and not _pid_alive(owner):
+                self._sql("UPDATE inbox SET owner = ? WHERE owner = ? AND status = 'pending'", (me, owner))
+        rows = self._sql(
+            "SELECT id, phone, payload FROM inbox WHERE owner = ? AND status = 'pending' ORDER BY id", (me,)
+        ).fetchall()
+        for row_id, phone, payload in rows:
+            self.executor.submit(phone, self._process, row_id, phone, json.loads(payload))
+        if rows:
+            with self._stats_lock:
+                self._replayed += len(rows)
+            logging.info(f"Replayed {len(rows)} unprocessed inbound messages from {self.path}")
+
+    def accept(self, phone, payload):
+        """Persist ``payload`` and queue it; returns once it is durable."""
+        if self._db is None:
+            self.start()
+        cur = self._sql(
+            "INSERT INTO inbox (phone, payload, owner, created_at) VALUES (?, ?, ?, ?)",
+            (phone, json.dumps(payload), os.getpid(), time.time())
+        )
+        with self._stats_lock:
+            self._accepted += 1
+        self.executor.submit(phone, self._process, cur.lastrowid, phone, payload)
+
+    def _process(self, row_id, phone, payload):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self.handle(payload)
+                self._sql("DELETE FROM inbox WHERE id = ?", (row_id,))
+                with self._stats_lock:
+                    self._processed += 1
+                return
+            except Exception as e:
+                if attempt >= self.max_attempts:
+                    logging.error(f"Giving up on inbound message {row_id} from {phone} after {attempt} attempts: {e}")
+                    self._sql("UPDATE inbox SET status = 'failed', attempts = ? WHERE id = ?", (attempt, row_id))
+                    with self._stats_lock:
+                        self._failed += 1
+                    if time.monotonic() - self._last_prune >= self.prune_interval:
+                        self.prune_failed()
+                    return
+                delay = min(self.backoff_base * (2 ** (attempt - 1)), self.backoff_max)
+                logging.error(f"Inbound message {row_id} from {phone} failed (attempt {attempt}), retrying in {delay}s: {e}")
+                with self._stats_lock:
+                    self._retries += 1
+                self._sql("UPDATE inbox SET attempts = ? WHERE id = ?", (attempt, row_id))
+                if self._stopping.wait(delay):
+                    # Leave it pending for the next start to replay.
+                    return
+
+    def prune_failed(self):
+        """Delete failed messages older than the retention period; returns how many were removed."""
+        self._last_prune = time.monotonic()
+        try:
+            cur = self._sql(
+                "DELETE FROM inbox WHERE status = 'failed' AND created_at < ?",
+                (time.time() - self.failed_retention,)
+            )
+        except sqlite3.Error as e:
+            logging.error(f"Failed to prune failed inbound messages from {self.path}: {e}")
+            return 0
+        pruned = cur.rowcount if cur is not None else 0
+        if pruned:
+            logging.info(f"Pruned {pruned} failed inbound messages from {self.path}")
+            with self._stats_lock:
+                self._pruned += pruned
+        return pruned
+
+    def failed_backlog(self):
+        """Failed messages still stored in the inbox, across all processes sharing it."""
+        cur = self._sql("SELECT COUNT(*) FROM inbox WHERE status = 'failed'")
+        return cur.fetchone()[0] if cur is not None else 0
+
+    def stop(self):
+        """Stop retrying failed messages; they stay pending for the next start to replay."""
+        self._stopping.set()
+
+    def close(self):
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+                self._db = None
+
+    def depth(self):
+        if self._db is None:
+            return 0
+        return self._sql("SELECT COUNT(*) FROM inbox WHERE status = 'pending' AND owner = ?", (os.getpid(),)).fetchone()[0]
+
+    def lag(self):
+        """Age in seconds of the oldest message this process has not processed yet."""
+        if self._db is None:
+            return 0.0
+        oldest = self._sql(
+            "SELECT MIN(created_at) FROM inbox WHERE status = 'pending' AND owner = ?", (os.getpid(),)
+        ).fetchone()[0]
+        return round(time.time() - oldest, 3) if oldest is not None else 0.0
+
+    def stats(self):
+        with self._stats_lock:
+            counters = {
+                "accepted": self._accepted,
+                "processed": self._processed,
+                "retries": self._retries,
+                "failed": self._failed,
+                "replayed": self._replayed,
+                "failed_pruned": self._pruned,
+            }
+        return dict(counters, depth=self.depth(), lag_seconds=self.lag(), failed_stored=self.failed_backlog())
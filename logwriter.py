@@ -0,0 +1,209 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from dispatch import _pid_alive
+
+INSERT_LOG = (
+    "INSERT INTO tbl_logs(sender_id, timestamp1, message_id, status, messagebody) VALUES (%s, %s, %s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE sender_id = VALUES(sender_id), timestamp1 = VALUES(timestamp1), "
+    "status = VALUES(status), messagebody = VALUES(messagebody)"
+)
+
+# Receipts can arrive out of order and more than once; a status only ever
+# moves forward along this ranking. delivery_updated_at is assigned first
+# because MySQL evaluates the assignments left to right.
+DELIVERY_STATUSES = ('sent', 'delivered', 'read', 'failed')
+_RANKED = "'" + "', '".join(DELIVERY_STATUSES) + "'"
+UPSERT_STATUS = (
+    "INSERT INTO tbl_logs(sender_id, message_id, delivery_status, delivery_updated_at) VALUES (%s, %s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE "
+    f"delivery_updated_at = IF(FIELD(VALUES(delivery_status), {_RANKED}) >= FIELD(delivery_status, {_RANKED}), "
+    "VALUES(delivery_updated_at), delivery_updated_at), "
+    f"delivery_status = IF(FIELD(VALUES(delivery_status), {_RANKED}) >= FIELD(delivery_status, {_RANKED}), "
+    "VALUES(delivery_status), delivery_status)"
+)
+
+
+class LogWriter:
+    """Buffers tbl_logs rows and writes them in multi-row batches off the send path.
+
+    A background thread flushes whenever ``batch_size`` rows are waiting or
+    ``flush_interval`` seconds have passed. If MySQL is unreachable the batch
+    is appended to a local JSON-lines spool file, which is replayed on the
+    next successful flush. Each process spools to its own
+    ``<spool_path>.<pid>`` file; files left by processes that have exited
+    are taken over (renamed, so only one survivor gets them) and replayed.
+    """
+
+    statement = INSERT_LOG
+    thread_name = "tbl-logs-writer"
+
+    def __init__(self, pool, batch_size=100, flush_interval=2.0, spool_path='tbl_logs.spool'):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self._cond = threading.Condition()
+        self._rows = []
+        self._stopping = False
+        self._thread = None
+        self._written = 0
+        self._spooled = 0
+        self._batches = 0
+
+    @classmethod
+    def from_env(cls, pool):
+        return cls(
+            pool,
+            batch_size=int(os.getenv("LOG_BATCH_SIZE", "100")),
+            flush_interval=float(os.getenv("LOG_FLUSH_INTERVAL", "2")),
+            spool_path=os.getenv("LOG_SPOOL_PATH", "tbl_logs.spool"),
+        )
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+        self._thread.start()
+
+    def add(self, row):
+        with self._cond:
+            self._rows.append(row)
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._stopping and len(self._rows) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                rows, self._rows = self._rows, []
+                stopping = self._stopping
+            if rows:
+                self._flush(rows)
+            if stopping:
+                return
+
+    def _write(self, rows):
+        with self.pool.session() as dbs:
+            dbs.cursor().executemany(self.statement, rows)
+
+    def _flush(self, rows):
+        try:
+            self._replay_spool()
+            self._write(rows)
+            self._written += len(rows)
+            self._batches += 1
+        except Exception as e:
+            logging.error(f"Failed to write {len(rows)} log rows, spooling to {self._own_spool()}: {e}")
+            self._spool(rows)
+
+    def _own_spool(self):
+        return f"{self.spool_path}.{os.getpid()}"
+
+    def _spool(self, rows):
+        try:
+            with open(self._own_spool(), 'a', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(json.dumps(row) + '\n')
+            self._spooled += len(rows)
+        except OSError as e:
+            logging.error(f"Failed to spool {len(rows)} log rows: {e}")
+
+    def _take_over_spools(self):
+        """Rename spool files of exited processes (and a pre-pid spool_path) into this process's name."""
+        me = os.getpid()
+        own = self._own_spool()
+        for path in [self.spool_path] + glob.glob(glob.escape(self.spool_path) + ".*"):
+            owner = path[len(self.spool_path) + 1:].split('.')[0]
+            if path != self.spool_path and (not owner.isdigit() or int(owner) == me or _pid_alive(int(owner))):
+                continue
+            try:
+                os.rename(path, f"{own}.from-{owner or 'legacy'}-{time.time_ns()}")
+            except FileNotFoundError:
+                # Already taken over by another process, or never existed.
+                continue
+
+    def _replay_spool(self):
+        self._take_over_spools()
+        own = self._own_spool()
+        for path in sorted(glob.glob(glob.escape(own) + ".*")) + [own]:
+            if os.path.exists(path):
+                self._replay_file(path)
+
+    def _replay_file(self, path):
+        # Only this process's writer thread appends to or replays files under its own name.
+        with open(path, encoding='utf-8') as f:
+            rows = [tuple(json.loads(line)) for line in f if line.strip()]
+        for i in range(0, len(rows), self.batch_size):
+            try:
+                self._write(rows[i:i + self.batch_size])
+            except Exception:
+                # Keep only what has not been written yet so nothing is inserted twice.
+                with open(path, 'w', encoding='utf-8') as f:
+                    for row in rows[i:]:
+                        f.write(json.dumps(row) + '\n')
+                raise
+        os.remove(path)
+        self._written += len(rows)
+        logging.info(f"Replayed {len(rows)} spooled log rows from {path}")
+
+    def stop(self, timeout=10.0):
+        """Flush everything still buffered, then stop the writer thread."""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._rows)
+        return {
+            "pending": pending,
+            "written": self._written,
+            "batches": self._batches,
+            "spooled": self._spooled,
+        }
+
+
+class StatusWriter(LogWriter):
+    """Buffers WhatsApp delivery receipts and upserts them into tbl_logs by message_id.
+
+    Rows are ``(recipient, message_id, status, timestamp)``. Each batch is
+    collapsed to the furthest status per message before it is written, so
+    a burst of sent/delivered/read receipts costs one row per message.
+    """
+
+    statement = UPSERT_STATUS
+    thread_name = "tbl-logs-status-writer"
+
+    @classmethod
+    def from_env(cls, pool):
+        return cls(
+            pool,
+            batch_size=int(os.getenv("STATUS_BATCH_SIZE", "500")),
+            flush_interval=float(os.getenv("STATUS_FLUSH_INTERVAL", "2")),
+            spool_path=os.getenv("STATUS_SPOOL_PATH", "tbl_logs_status.spool"),
+        )
+
+    def _write(self, rows):
+        latest = {}
+        for row in rows:
+            recipient, message_id, status, timestamp = row
+            rank = DELIVERY_STATUSES.index(status) if status in DELIVERY_STATUSES else -1
+            current = latest.get(message_id)
+            if current is None or rank >= current[0]:
+                latest[message_id] = (rank, row)
+        super()._write([row for _, row in latest.values()])
@@ -0,0 +1,125 @@
+import logging
+import re
+import threading
+from bisect import bisect_left
+from functools import lru_cache
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_STATEMENTS = (
+    re.compile(r"^\s*(SELECT|DELETE)\b.*?\bFROM\s+`?(\w+)", re.IGNORECASE | re.DOTALL),
+    re.compile(r"^\s*(INSERT|REPLACE)\s+(?:IGNORE\s+)?INTO\s+`?(\w+)", re.IGNORECASE),
+    re.compile(r"^\s*(UPDATE)\s+`?(\w+)", re.IGNORECASE),
+)
+_LOCK = re.compile(r"^\s*SELECT\s+(GET_LOCK|RELEASE_LOCK)\s*\(", re.IGNORECASE)
+_VERB = re.compile(r"^\s*(\w+)")
+
+
+@lru_cache(maxsize=1024)
+def statement_family(sql):
+    """'SELECT users', 'UPDATE combo_inventory', 'GET_LOCK', ... -- bounded by the number of tables."""
+    match = _LOCK.match(sql)
+    if match:
+        return match.group(1).upper()
+    for pattern in _STATEMENTS:
+        match = pattern.match(sql)
+        if match:
+            return f"{match.group(1).upper()} {match.group(2).lower()}"
+    match = _VERB.match(sql)
+    return match.group(1).upper() if match else "OTHER"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{_escape(v)}"' for n, v in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram; ``observe`` is one bisect and a short critical section."""
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *labels):
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Registry:
+    """Metric families plus component ``stats()`` callbacks, rendered in the Prometheus text format.
+
+    Every numeric value in a registered stats dict (nested dicts are
+    flattened with '.') is exported as
+    ``<prefix>_component{component="...",stat="..."}``, so pools and
+    queues are read only when /metrics is scraped.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._metrics = []
+        self._stats = []
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(f"{self.prefix}_{name}", help, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, component, stats):
+        self._stats.append((component, stats))
+
+    def _flatten(self, prefix, value, out):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                self._flatten(f"{prefix}.{key}" if prefix else str(key), item, out)
+        elif isinstance(value, bool):
+            out.append((prefix, int(value)))
+        elif isinstance(value, (int, float)):
+            out.append((prefix, value))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        name = f"{self.prefix}_component"
+        lines.append(f"# HELP {name} Point-in-time values from component stats().")
+        lines.append(f"# TYPE {name} gauge")
+        for component, stats in self._stats:
+            try:
+                values = []
+                self._flatten("", stats(), values)
+            except Exception as e:
+                logging.error(f"Failed to collect {component} stats for metrics: {e}")
+                continue
+            for stat, value in values:
+                lines.append(f"{name}{_labels(('component', 'stat'), (component, stat))} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,8 @@
+-- Shared version stamp for the in-process catalog cache (catalog.py).
+-- Bumped whenever combos or combo_inventory are edited from the admin UI.
+CREATE TABLE IF NOT EXISTS catalog_version (
+    id TINYINT NOT NULL PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT IGNORE INTO catalog_version (id, version) VALUES (1, 0);
@@ -0,0 +1,3 @@
+-- generate_referral_code relies on this key to reject colliding candidates
+-- instead of checking each one with SELECT COUNT(*) first.
+ALTER TABLE referral_codes ADD UNIQUE KEY uq_referral_codes_code (referral_code);
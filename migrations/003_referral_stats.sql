@@ -0,0 +1,17 @@
+-- Per-user monthly referral counter behind get_tiered_discount. month_year is
+-- the month of the referral code that was used, matching the old
+-- COUNT(*) ... IN (SELECT referral_code ... WHERE month_year = ?) query.
+-- Maintained by assign_referral_rewards; `flask rebuild-referral-stats`
+-- recomputes it from referral_rewards.
+CREATE TABLE IF NOT EXISTS referral_stats (
+    user_phone VARCHAR(20) NOT NULL,
+    month_year CHAR(7) NOT NULL,
+    referral_count INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_phone, month_year)
+);
+
+INSERT INTO referral_stats (user_phone, month_year, referral_count)
+SELECT rr.user_phone, rc.month_year, COUNT(*) FROM referral_rewards rr
+JOIN referral_codes rc ON rc.referral_code = rr.referral_code
+GROUP BY rr.user_phone, rc.month_year
+ON DUPLICATE KEY UPDATE referral_count = VALUES(referral_count);
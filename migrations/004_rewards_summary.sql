@@ -0,0 +1,30 @@
+-- Projection behind the "my rewards" reply. One row per user and month
+-- (month of the referral code), maintained by generate_referral_code and
+-- assign_referral_rewards; `flask rebuild-referral-stats` recomputes it.
+CREATE TABLE IF NOT EXISTS rewards_summary (
+    user_phone VARCHAR(20) NOT NULL,
+    month_year CHAR(7) NOT NULL,
+    current_code VARCHAR(10) NULL,
+    usage_count INT NOT NULL DEFAULT 0,
+    points_month INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_phone, month_year)
+);
+
+-- Lifetime counters live next to balutedaar_points on the user row.
+ALTER TABLE users ADD COLUMN pending_free_boxes INT NOT NULL DEFAULT 0;
+
+UPDATE users u SET pending_free_boxes = (
+    SELECT COUNT(*) FROM rewards r
+    WHERE r.user_phone = u.phone_number AND r.reward_type = 'Free Veggie Box' AND r.status = 'Pending'
+);
+
+INSERT INTO rewards_summary (user_phone, month_year, current_code, usage_count, points_month)
+SELECT rc.user_phone, rc.month_year, rc.referral_code, rc.usage_count,
+       (SELECT COALESCE(SUM(rr.points_earned), 0) FROM referral_rewards rr
+        JOIN referral_codes m ON m.referral_code = rr.referral_code
+        WHERE rr.user_phone = rc.user_phone AND m.month_year = rc.month_year)
+FROM referral_codes rc
+WHERE rc.created_at = (SELECT MAX(l.created_at) FROM referral_codes l
+                       WHERE l.user_phone = rc.user_phone AND l.month_year = rc.month_year)
+ON DUPLICATE KEY UPDATE current_code = VALUES(current_code), usage_count = VALUES(usage_count),
+                        points_month = VALUES(points_month);
@@ -0,0 +1,18 @@
+-- Explicit conversation state replacing the is_info / is_main / is_referral /
+-- main_menu / is_temp / is_submenu flags. state_version guards every
+-- transition so a worker holding a stale cached record cannot overwrite a
+-- newer one. The old flag columns are no longer written and can be dropped
+-- once this has been live for a release.
+ALTER TABLE users
+    ADD COLUMN conv_state VARCHAR(24) NOT NULL DEFAULT 'IDLE',
+    ADD COLUMN state_version INT NOT NULL DEFAULT 0;
+
+UPDATE users SET conv_state = CASE
+    WHEN is_submenu = '1' AND payment_method IS NULL THEN 'ORDER_REVIEW'
+    WHEN is_temp = '1' AND address IS NULL THEN 'AWAITING_ADDRESS'
+    WHEN is_referral = '1' THEN 'AWAITING_REFERRAL'
+    WHEN main_menu = '1' AND pincode IS NOT NULL THEN 'BROWSING'
+    WHEN is_main = '1' AND pincode IS NULL THEN 'AWAITING_PINCODE'
+    WHEN is_info = '1' AND pincode IS NULL THEN 'AWAITING_NAME'
+    ELSE 'IDLE'
+END;
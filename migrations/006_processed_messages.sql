@@ -0,0 +1,8 @@
+-- Inbound webhook idempotency: one row per WhatsApp message id we have
+-- processed. Rows older than DEDUPE_RETENTION_HOURS are purged by the app.
+CREATE TABLE IF NOT EXISTS processed_messages (
+    message_id VARCHAR(128) NOT NULL,
+    received_at DATETIME NOT NULL,
+    PRIMARY KEY (message_id),
+    KEY idx_processed_messages_received_at (received_at)
+);
@@ -0,0 +1,10 @@
+-- Delivery receipts are upserted into tbl_logs by message_id, so it needs a
+-- unique key. Sends whose response carried no id were logged as 'unknown';
+-- those become NULL, which the key allows any number of.
+ALTER TABLE tbl_logs MODIFY message_id VARCHAR(128) NULL;
+UPDATE tbl_logs SET message_id = NULL WHERE message_id IN ('unknown', '');
+
+ALTER TABLE tbl_logs
+    ADD COLUMN delivery_status VARCHAR(16) NULL,
+    ADD COLUMN delivery_updated_at DATETIME NULL,
+    ADD UNIQUE KEY uq_tbl_logs_message_id (message_id);
@@ -0,0 +1,62 @@
+import logging
+import os
+import threading
+
+
+class PincodeIndex:
+    """In-memory set of serviceable pincodes loaded from the ``pincodes`` table.
+
+    Lookups never touch MySQL. A background thread reloads the set every
+    ``refresh_interval`` seconds; ``refresh()`` reloads it on demand. Until
+    the first successful load, ``fallback`` (SUPPORTED_PINCODES) is served.
+    """
+
+    def __init__(self, pool, fallback=(), refresh_interval=300.0):
+        self.pool = pool
+        self.refresh_interval = refresh_interval
+        self._pincodes = frozenset(p.strip() for p in fallback if p.strip())
+        self._loaded = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, pool, fallback=()):
+        return cls(pool, fallback, refresh_interval=float(os.getenv("PINCODE_REFRESH_INTERVAL", "300")))
+
+    def refresh(self):
+        try:
+            with self.pool.session() as dbs:
+                cursor = dbs.cursor()
+                cursor.execute("SELECT pincode FROM pincodes")
+                rows = cursor.fetchall()
+            self._pincodes = frozenset(str(row[0]).strip() for row in rows)
+            self._loaded = True
+            return True
+        except Exception as e:
+            logging.error(f"Failed to load pincodes, keeping {len(self._pincodes)} known pincodes: {e}")
+            return False
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.refresh()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="pincode-refresh", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.refresh_interval):
+            self.refresh()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+    def __contains__(self, pincode):
+        return pincode in self._pincodes
+
+    def sorted(self):
+        return sorted(self._pincodes)
+
+    def stats(self):
+        return {"pincodes": len(self._pincodes), "loaded_from_db": self._loaded}
@@ -0,0 +1,159 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+_local = threading.local()
+
+
+def current_scope():
+    return getattr(_local, 'scope', None)
+
+
+class QueryScope:
+    __slots__ = ('name', 'parent', 'queries', 'connections', 'rows', 'own', 'statements')
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.queries = 0
+        self.connections = 0
+        self.rows = 0
+        # Statement text -> executions issued directly in this scope, and including child scopes.
+        self.own = {}
+        self.statements = {}
+
+    def repeated(self, threshold, nested=False):
+        counts = self.statements if nested else self.own
+        return {sql: n for sql, n in counts.items() if n >= threshold}
+
+
+class QueryBudget:
+    """Counts MySQL round trips, connection checkouts and rows per webhook and per funnel step.
+
+    ``scope(name)`` opens a counting scope on this thread; nested scopes
+    roll their totals up into the enclosing one. When a scope closes, any
+    statement text it issued ``n_plus_one_threshold`` or more times is
+    reported as a likely N+1, and totals above the ``budgets`` configured
+    for that scope name are reported as over budget. ``assert_within`` turns
+    a budget into an AssertionError; bench/run.py uses it to fail the run
+    when the catalog-order or checkout step goes over its budget.
+    """
+
+    def __init__(self, n_plus_one_threshold=3, budgets=None, report=None):
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.budgets = budgets or {}
+        self.report = report
+        self.n_plus_one = 0
+        self.over_budget = 0
+
+    @classmethod
+    def from_env(cls, report=None):
+        budgets = {}
+        for item in os.getenv("QUERY_BUDGETS", "").split(","):
+            name, _, limit = item.partition("=")
+            if name.strip() and limit.strip().isdigit():
+                budgets[name.strip()] = int(limit)
+        return cls(n_plus_one_threshold=int(os.getenv("QUERY_N_PLUS_ONE_THRESHOLD", "3")), budgets=budgets,
+                   report=report)
+
+    def on_statement(self, sql, seconds, rows):
+        scope = current_scope()
+        if scope is None:
+            return
+        scope.queries += 1
+        if rows and rows > 0:
+            scope.rows += rows
+        scope.own[sql] = scope.own.get(sql, 0) + 1
+        scope.statements[sql] = scope.statements.get(sql, 0) + 1
+
+    def on_connection(self, created=False):
+        scope = current_scope()
+        if scope is not None:
+            scope.connections += 1
+
+    @contextmanager
+    def scope(self, name):
+        parent = current_scope()
+        scope = QueryScope(name, parent)
+        _local.scope = scope
+        try:
+            yield scope
+        finally:
+            _local.scope = parent
+            if parent is not None:
+                parent.queries += scope.queries
+                parent.connections += scope.connections
+                parent.rows += scope.rows
+                for sql, count in scope.statements.items():
+                    parent.statements[sql] = parent.statements.get(sql, 0) + count
+            self._close(scope)
+
+    def rename(self, name):
+        """Relabel the active scope once the step it covers is known."""
+        scope = current_scope()
+        if scope is not None:
+            scope.name = name
+
+    def _close(self, scope):
+        for sql, count in scope.repeated(self.n_plus_one_threshold).items():
+            self.n_plus_one += 1
+            logging.warning(f"Possible N+1 in {scope.name}: statement ran {count} times: {' '.join(sql.split())[:200]}")
+        limit = self.budgets.get(scope.name)
+        if limit is not None and scope.queries > limit:
+            self.over_budget += 1
+            logging.warning(f"{scope.name} issued {scope.queries} queries, over its budget of {limit}")
+        if self.report is not None:
+            try:
+                self.report(scope)
+            except Exception as e:
+                logging.error(f"Query budget report failed: {e}")
+
+    def scoped(self, fn):
+        @wraps(fn)
+        def run(*args, **kwargs):
+            with self.scope(fn.__name__):
+                return fn(*args, **kwargs)
+        return run
+
+    def wrap(self, fn):
+        """Bind ``fn`` to the active scope so queries it runs on another thread are counted here."""
+        parent = current_scope()
+        if parent is None:
+            return fn
+
+        @wraps(fn)
+        def run(*args, **kwargs):
+            previous = current_scope()
+            _local.scope = parent
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _local.scope = previous
+        return run
+
+    @contextmanager
+    def assert_within(self, max_queries=None, max_connections=None, max_rows=None, allow_n_plus_one=False):
+        """Fail with AssertionError if the block exceeds the given budget.
+
+            with query_budget.assert_within(max_queries=6, max_connections=1):
+                handle_message(phone, 'text', 'Hi', payload)
+        """
+        with self.scope("assert_within") as scope:
+            yield scope
+        repeated = scope.repeated(self.n_plus_one_threshold, nested=True)
+        problems = []
+        if max_queries is not None and scope.queries > max_queries:
+            problems.append(f"{scope.queries} queries (budget {max_queries})")
+        if max_connections is not None and scope.connections > max_connections:
+            problems.append(f"{scope.connections} connection checkouts (budget {max_connections})")
+        if max_rows is not None and scope.rows > max_rows:
+            problems.append(f"{scope.rows} rows (budget {max_rows})")
+        if not allow_n_plus_one and repeated:
+            problems.extend(f"N+1: {count}x {' '.join(sql.split())[:120]}" for sql, count in repeated.items())
+        if problems:
+            raise AssertionError("Query budget exceeded: " + "; ".join(problems))
+
+    def stats(self):
+        return {"n_plus_one": self.n_plus_one, "over_budget": self.over_budget}
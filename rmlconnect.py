@@ -0,0 +1,114 @@
+import json
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RML_BASE_URL = "https://apis.rmlconnect.net"
+MESSAGES_URL = f"{RML_BASE_URL}/wba/v1/messages?source=UI"
+CATALOG_URL = f"{RML_BASE_URL}/wba/v1/messages"
+
+
+def normalize_phone(phone):
+    if phone.startswith('+'):
+        return phone
+    return f"+91{phone.strip()[-10:]}"
+
+
+class RMLClient:
+    """rmlconnect WhatsApp API client backed by one keep-alive requests.Session.
+
+    The session's connection pool is shared by every thread, so concurrent
+    senders reuse warm TLS connections instead of handshaking per message.
+    Only connection failures are retried by the adapter; a POST that may
+    have reached the provider is never replayed here. ``base_url`` points
+    the client at another host (a local stub for benchmarks and load tests).
+    """
+
+    def __init__(self, auth_key, pool_size=10, connect_timeout=3.0, read_timeout=10.0, retries=2, verify=False,
+                 base_url=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.headers.update({
+            'Content-Type': 'application/json',
+            'Authorization': auth_key,
+            'referer': 'https://myaccount.rmlconnect.net/'
+        })
+        retry = Retry(total=retries, connect=retries, read=0, status=0, redirect=0, backoff_factor=0.2)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @classmethod
+    def from_env(cls, auth_key):
+        return cls(
+            auth_key,
+            pool_size=int(os.getenv("RML_POOL_SIZE", "10")),
+            connect_timeout=float(os.getenv("RML_CONNECT_TIMEOUT", "3")),
+            read_timeout=float(os.getenv("RML_READ_TIMEOUT", "10")),
+            retries=int(os.getenv("RML_CONNECT_RETRIES", "2")),
+            verify=os.getenv("RML_VERIFY_TLS", "0") == "1",
+            base_url=os.getenv("RML_BASE_URL") or None,
+        )
+
+    @staticmethod
+    def text_message(phone, body, extra):
+        return {
+            "phone": normalize_phone(phone),
+            "text": body,
+            "enable_acculync": True,
+            "extra": extra
+        }
+
+    @staticmethod
+    def interactive_list(phone, body, button_text, sections, extra):
+        """``sections`` is a list of (section_title, [(row_id, title, description), ...])."""
+        return {
+            "phone": normalize_phone(phone),
+            "enable_acculync": False,
+            "extra": extra,
+            "media": {
+                "type": "interactive_list",
+                "body": body,
+                "button_text": button_text,
+                "button": [
+                    {
+                        "section_title": section_title,
+                        "row": [{"id": row_id, "title": title, "description": description}
+                                for row_id, title, description in rows]
+                    }
+                    for section_title, rows in sections
+                ]
+            }
+        }
+
+    @staticmethod
+    def product_list(phone, catalog_id, header, body, section_title, product_ids):
+        return {
+            "phone": normalize_phone(phone),
+            "catalog": {
+                "type": "product_list",
+                "header": {"type": "text", "text": header},
+                "body": {"text": body},
+                "action": {
+                    "catalog_id": catalog_id,
+                    "sections": [
+                        {
+                            "title": section_title,
+                            "product_items": [{"product_retailer_id": pid} for pid in product_ids]
+                        }
+                    ]
+                }
+            }
+        }
+
+    def post(self, payload, url=MESSAGES_URL):
+        if self.base_url and url.startswith(RML_BASE_URL):
+            url = self.base_url + url[len(RML_BASE_URL):]
+        return self.session.post(url, data=json.dumps(payload).encode('utf-8'), timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,203 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+
+_local = threading.local()
+
+
+def current_span():
+    return getattr(_local, 'span', None)
+
+
+class Span:
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'root', 'attrs', 'children',
+                 'start', 'end', 'tid', 'span_count', 'dropped')
+
+    def __init__(self, name, trace_id, parent_id, root, attrs, start=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.root = root or self
+        self.attrs = attrs
+        self.children = []
+        self.start = time.perf_counter() if start is None else start
+        self.end = None
+        self.tid = threading.get_ident()
+        self.span_count = 1
+        self.dropped = 0
+
+    @property
+    def duration(self):
+        return ((self.end if self.end is not None else time.perf_counter()) - self.start)
+
+
+class Tracer:
+    """In-process span trees for webhooks, payment callbacks and outbound sends.
+
+    A span opened with no active parent starts a trace; spans opened (or
+    recorded) while it is active become its children, including from other
+    threads via ``wrap``. When a root span ends it is logged as a full tree
+    if it took longer than ``slow_threshold`` seconds, and, when
+    ``export_path`` is set, a ``sample_rate`` share of traces is appended
+    to that file as Chrome trace events (open it in Perfetto or
+    chrome://tracing).
+    """
+
+    def __init__(self, enabled=True, slow_threshold=2.0, export_path=None, sample_rate=1.0, max_spans=2000):
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold
+        self.export_path = export_path
+        self.sample_rate = sample_rate
+        self.max_spans = max_spans
+        self._export_lock = threading.Lock()
+        self._epoch = time.time() - time.perf_counter()
+        self.traces = 0
+        self.slow = 0
+        self.exported = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.getenv("TRACE_ENABLED", "1") == "1",
+            slow_threshold=float(os.getenv("TRACE_SLOW_MS", "2000")) / 1000,
+            export_path=os.getenv("TRACE_EXPORT_PATH") or None,
+            sample_rate=float(os.getenv("TRACE_EXPORT_SAMPLE", "1")),
+            max_spans=int(os.getenv("TRACE_MAX_SPANS", "2000")),
+        )
+
+    def _child(self, parent, name, attrs, start=None):
+        root = parent.root
+        if root.span_count >= self.max_spans:
+            root.dropped += 1
+            return None
+        root.span_count += 1
+        span = Span(name, parent.trace_id, parent.span_id, root, attrs, start)
+        parent.children.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name, context=None, **attrs):
+        """Time the block as a span. ``context`` (from ``context()``) links a new root to an earlier trace."""
+        if not self.enabled:
+            yield None
+            return
+        parent = current_span()
+        if parent is not None:
+            span = self._child(parent, name, attrs)
+            if span is None:
+                yield None
+                return
+        elif context:
+            span = Span(name, context["trace_id"], context["span_id"], None, attrs)
+        else:
+            span = Span(name, uuid.uuid4().hex, None, None, attrs)
+        _local.span = span
+        try:
+            yield span
+        except BaseException as e:
+            span.attrs["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end = time.perf_counter()
+            _local.span = parent
+            if parent is None:
+                self._finish(span)
+
+    def record(self, name, seconds, **attrs):
+        """Add an already finished child span (e.g. a SQL statement) to the active span."""
+        parent = current_span()
+        if parent is None:
+            return
+        end = time.perf_counter()
+        span = self._child(parent, name, attrs, start=end - seconds)
+        if span is not None:
+            span.end = end
+
+    def annotate(self, **attrs):
+        span = current_span()
+        if span is not None:
+            span.attrs.update(attrs)
+
+    def context(self):
+        span = current_span()
+        return {"trace_id": span.trace_id, "span_id": span.span_id} if span is not None else None
+
+    def wrap(self, fn):
+        """Bind ``fn`` to the active span so work it does on another thread joins this trace."""
+        parent = current_span()
+        if parent is None:
+            return fn
+
+        @wraps(fn)
+        def run(*args, **kwargs):
+            previous = current_span()
+            _local.span = parent
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _local.span = previous
+        return run
+
+    def traced(self, fn):
+        @wraps(fn)
+        def run(*args, **kwargs):
+            with self.span(fn.__name__):
+                return fn(*args, **kwargs)
+        return run
+
+    def _finish(self, root):
+        self.traces += 1
+        if root.duration >= self.slow_threshold:
+            self.slow += 1
+            logging.warning(f"Slow {root.name} ({root.duration * 1000:.1f} ms, trace {root.trace_id}):\n{self.render(root)}")
+        if self.export_path and random.random() < self.sample_rate:
+            self._export(root)
+
+    def render(self, root):
+        lines = []
+
+        def walk(span, depth):
+            attrs = " ".join(f"{k}={v}" for k, v in span.attrs.items())
+            offset = (span.start - root.start) * 1000
+            lines.append(f"{'  ' * depth}{span.name} {span.duration * 1000:.1f} ms (+{offset:.1f}) {attrs}".rstrip())
+            for child in span.children:
+                walk(child, depth + 1)
+        walk(root, 0)
+        if root.dropped:
+            lines.append(f"... {root.dropped} spans dropped")
+        return "\n".join(lines)
+
+    def _events(self, root):
+        pid = os.getpid()
+        stack = [root]
+        while stack:
+            span = stack.pop()
+            args = dict(span.attrs, trace_id=span.trace_id, span_id=span.span_id, parent_id=span.parent_id)
+            yield {
+                "name": span.name, "ph": "X", "pid": pid, "tid": span.tid,
+                "ts": round((self._epoch + span.start) * 1e6), "dur": round(span.duration * 1e6),
+                "args": {k: v if isinstance(v, (int, float, bool)) or v is None else str(v) for k, v in args.items()},
+            }
+            stack.extend(span.children)
+
+    def _export(self, root):
+        try:
+            # Chrome's JSON array format tolerates the missing closing bracket, so events can be appended.
+            with self._export_lock, open(self.export_path, 'a', encoding='utf-8') as f:
+                if f.tell() == 0:
+                    f.write("[\n")
+                for event in self._events(root):
+                    f.write(json.dumps(event) + ",\n")
+            self.exported += 1
+        except OSError as e:
+            logging.error(f"Failed to export trace {root.trace_id}: {e}")
+
+    def stats(self):
+        return {"enabled": self.enabled, "traces": self.traces, "slow": self.slow, "exported": self.exported}
@@ -0,0 +1,18 @@
+"""Production entry point.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app module is imported once in the gunicorn master (``preload_app``)
+so workers fork with the code already loaded; each worker then starts its
+own pool, queues and caches in the ``post_fork`` hook. Measure import cost
+with ``python -X importtime -c "import wsgi"``; the import and per-worker
+init times are also reported by /admin/pool_stats.
+"""
+import time
+
+_started = time.perf_counter()
+
+from app import create_app, startup_stats  # noqa: E402
+
+app = create_app()
+startup_stats["import_ms"] = round((time.perf_counter() - _started) * 1000, 1)